@@ -3,12 +3,18 @@
 
 Audio Builder
 
-using edge-tts to generate audio
+using edge-tts (or another TTS backend, see tts_backends.py) to generate audio
 
 Usage: build_audio(gen())
     gen() is an async generator you implement that provides text segments
     each segment is a TextSegment object or a WhiteSpace object
 
+build_audio_stream(gen()) yields the mp3 progressively while the rest is still rendering
+
+Trimmed segments are cached under cache_dir (see segment_cache.py),
+rerunning an unchanged book makes no TTS calls.
+
+CPU-bound post-processing runs in a process pool, see offload.configure()
 
 """
 
@@ -16,65 +22,276 @@ Usage: build_audio(gen())
 from typing import (
     Any,
     AsyncGenerator,
+    AsyncIterator,
     Dict,
+    List,
+    Optional,
     Union,
 )
 
 import asyncio
+import functools
 import os, shutil
 import subprocess
 import logging
+import json
+import time
 
-import edge_tts
-
+from .. import metrics
+from .. import profiling
 from . import audio_utils
+from . import offload
 from .segments import (
     TextSegment,
     WhiteSpace,
 )
+from .segment_cache import (
+    SegmentCache,
+    KVSegmentCache,
+    segment_key,
+    whitespace_key,
+)
+from .pcm_spool import (
+    PcmSpool,
+    compact_spool,
+    install_compacted,
+)
+from .manifest import BuildManifest
+from . import splice
+from . import timing
+from .scheduler import AdaptiveScheduler
+from .segmenter import Segmenter
+from .tts_backends import (
+    BACKEND_VERSION,
+    TTSBackend,
+    EdgeTTSBackend,
+    ToneBackend,
+    build_audio_segment,
+    float_to_percent,
+)
 
 logger = logging.getLogger(__name__)
 
+FAILED_SEGMENT_SILENCE = 0.5 # seconds
 
-
-def float_to_percent(f: float):
-    ''' convert to edge-tts format
-
-    1.1 -> "+10%"
-
-    0.9 -> "-10%"
-    '''
-    assert f > 0
-    d = f - 1
-    if (d >= 0):
-        return f'+{round(d * 100)}%'
-    else:
-        return f'-{round(-d * 100)}%'
-
+_SEGMENTS = metrics.counter('segments_total', 'segments by source: tts, stretch, cache, resume, silence, failed')
+_MERGE_SECONDS = metrics.histogram('merge_seconds', 'final encoding / splicing of out.mp3', buckets=(1, 5, 15, 60, 300, 900, 3600))
 
 
 async def build_whitespace(temp_file: str, segment: WhiteSpace):
-    audio_utils.make_empty_mp3(temp_file, segment.time)
-
-async def build_audio_segment(temp_file: str, segment: TextSegment):
-    ''' generate one segment with edge-tts. remove whitespace '''
-    rate_str = float_to_percent(segment.rate)
-    volume_str = float_to_percent(segment.volume)
-    communicate = edge_tts.Communicate(segment.text, segment.voice, rate=rate_str, volume=volume_str)
-    with open(temp_file, "wb") as file:
-        async for chunk in communicate.stream():
-            if chunk["type"] == "audio":
-                file.write(chunk["data"])
-    # remove whitespace
-    audio_utils.trim_mp3(temp_file, temp_file)
-
+    await offload.run_cpu(audio_utils.make_empty_wav, temp_file, segment.time)
+
+
+
+class SegmentRenderer():
+    ''' text segment -> trimmed wav by the TTS backend, through the segment cache if there is one.
+    with a batching backend, the segments requested while a batch is collected are rendered in one call.
+    with local_variants=True, segments at another rate or volume are time stretched locally from the
+    rendering at rate 1.0 and volume 1.0 (see audio_utils.time_stretch), which is synthesized once '''
+
+    def __init__(self, cache_dir: Optional[str], *, cache_max_bytes: int=2 * 1024 ** 3, normalize: Optional[str]=None,
+                 cache_backend: str='files', backend: Optional[TTSBackend]=None, close_backend: bool=True,
+                 batch_delay: float=0.005, local_variants: bool=False):
+        '''
+        backend: EdgeTTSBackend() by default
+        close_backend: close() closes the backend too
+        batch_delay: seconds a batch waits for more segments after its first one
+        '''
+        self.normalize = normalize
+        self.local_variants = local_variants
+        self._bases: Dict[str, tuple] = {} # base rendering key -> (wav, rendering task), without a cache
+        self.backend = backend if backend is not None else EdgeTTSBackend()
+        self.close_backend = close_backend
+        self.batch_delay = batch_delay
+        self._batch: List[tuple] = [] # (path, segment, future) waiting for the next synthesize_batch
+        self._batch_timer: Optional[asyncio.TimerHandle] = None
+        self._batch_tasks = set()
+        self.cache = None
+        if (cache_dir is not None):
+            if (cache_backend == 'kv'):
+                # the size cap is the one of the kv cache (kv_cache.set_default_cache)
+                self.cache = KVSegmentCache(cache_dir)
+            elif (cache_backend == 'files'):
+                self.cache = SegmentCache(cache_dir, max_bytes=cache_max_bytes)
+            else:
+                raise ValueError(f'unknown cache backend {cache_backend!r}')
+
+    def is_variant(self, segment: TextSegment) -> bool:
+        ''' rendered locally from the base segment '''
+        return self.local_variants and (segment.rate != 1.0 or segment.volume != 1.0)
+
+    def source(self, segment: TextSegment) -> str:
+        ''' segments_total label of a segment rendered by render() '''
+        return 'stretch' if self.is_variant(segment) else 'tts'
+
+    def key(self, segment: TextSegment) -> str:
+        processing = str(self.normalize)
+        if (self.is_variant(segment)):
+            processing += f'|stretch-{audio_utils.STRETCH_VERSION}'
+        return segment_key(segment, self.backend.version, processing=processing)
+
+    def cached(self, segment: TextSegment) -> Optional[str]:
+        ''' wav file of segment if it is cached '''
+        if (self.cache is None):
+            return None
+        return self.cache.try_get(self.key(segment))
+
+    async def _synthesize(self, path: str, segment: TextSegment):
+        if (not self.backend.supports_rate(segment.rate)):
+            logger.warning(f'{self.backend.name} can\'t speak at rate {segment.rate}, clamped')
+            segment = TextSegment(segment.text, segment.voice, rate=self.backend.clamp_rate(segment.rate), volume=segment.volume)
+        if (not self.backend.supports_batch):
+            await self.backend.synthesize(path, segment, normalize=self.normalize)
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._batch.append((path, segment, future))
+        if (len(self._batch) >= self.backend.max_batch):
+            self._flush_batch()
+        elif (self._batch_timer is None):
+            self._batch_timer = asyncio.get_running_loop().call_later(self.batch_delay, self._flush_batch)
+        await future
+
+    def _flush_batch(self):
+        if (self._batch_timer is not None):
+            self._batch_timer.cancel()
+            self._batch_timer = None
+        # jobs cancelled while waiting are left out
+        batch = [item for item in self._batch if not item[2].done()]
+        self._batch = []
+        if (len(batch) == 0):
+            return
+        task = asyncio.get_running_loop().create_task(self._run_batch(batch))
+        self._batch_tasks.add(task)
+        task.add_done_callback(self._batch_tasks.discard)
+
+    async def _run_batch(self, batch: List[tuple]):
+        try:
+            errors = await self.backend.synthesize_batch(
+                [(path, segment) for path, segment, _ in batch], normalize=self.normalize)
+        except Exception as e:
+            errors = [e] * len(batch)
+        for (_, _, future), error in zip(batch, errors):
+            if (future.done()):
+                continue
+            if (error is None):
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+    async def _render_base(self, fname: str, base: TextSegment) -> str:
+        ''' wav of a base segment, concurrent requests share one synthesis '''
+        if (self.cache is not None):
+            return await self.cache.fetch(self.key(base), lambda path: self._synthesize(path, base))
+        key = self.key(base)
+        if (key not in self._bases):
+            path = os.path.join(os.path.dirname(fname), f'base_{key[:16]}.wav')
+            self._bases[key] = (path, asyncio.ensure_future(self._synthesize(path, base)))
+        path, task = self._bases[key]
+        try:
+            await asyncio.shield(task)
+        except Exception:
+            # the next request tries again
+            if (self._bases.get(key, (None, None))[1] is task):
+                del self._bases[key]
+            raise
+        return path
+
+    async def _derive(self, path: str, segment: TextSegment):
+        base_file = await self._render_base(path, TextSegment(segment.text, segment.voice))
+        # read at once, a cache entry may be evicted while the stretch runs
+        samples, frame_rate = audio_utils.load_wav(base_file)
+        base_words = timing.load_words(base_file)
+        rate = min(max(segment.rate, 0.25), 4.0)
+        duration = await offload.run_cpu(audio_utils.stretch_to_wav, samples, frame_rate, path, rate, segment.volume)
+        if (len(base_words) > 0):
+            timing.save_words(path, [
+                dict(word, start=round(min(word['start'] / rate, duration), 4), end=round(min(word['end'] / rate, duration), 4))
+                for word in base_words
+            ])
+
+    async def render(self, fname: str, segment: TextSegment) -> str:
+        ''' returns a wav file holding the trimmed segment, fname or a cache entry '''
+        build = self._derive if self.is_variant(segment) else self._synthesize
+        if (self.cache is None):
+            await build(fname, segment)
+            return fname
+        return await self.cache.fetch(self.key(segment), lambda path: build(path, segment))
+
+    async def close(self):
+        logger.info(f'TTS backend: {self.backend.report()}')
+        if (self.close_backend):
+            await self.backend.close()
+
+
+
+def write_timing_index(temp_dir: str, seg_count: int, texts: Dict[int, TextSegment],
+                       durations: Dict[int, float], words: Dict[int, List[dict]],
+                       starts: Optional[Dict[int, float]]=None):
+    ''' starts: segment offsets in the output, by default the segments are laid out back to back
+    in index order (one encoding pass), their offsets are the running sum of durations '''
+    index = timing.TimingIndex(os.path.join(temp_dir, 'timing.sqlite'), overwrite=True)
+    offset = 0.0
+    for i in range(seg_count):
+        duration = durations.get(i, 0.0)
+        if (starts is not None):
+            offset = starts.get(i, offset)
+        if (i in texts):
+            index.add_segment(i, texts[i].text, texts[i].voice, offset, duration, words.get(i, []))
+        offset += duration
+    timing.export_srt(index, os.path.join(temp_dir, 'out.srt'))
+    timing.export_vtt(index, os.path.join(temp_dir, 'out.vtt'))
+    index.close()
+    logger.debug(f'Timing index written, {offset:.1f}s')
 
 
 async def build_audio(
         gen: AsyncGenerator[Union[TextSegment, WhiteSpace], None], *, 
-        max_concurrent_generations: int=5, temp_dir: str='./temp'):
+        max_concurrent_generations: int=5, temp_dir: str='./temp',
+        cache_dir: Optional[str]='cache/tts_segments', cache_max_bytes: int=2 * 1024 ** 3,
+        normalize: Optional[str]=None, bitrate: str='64k', spool: bool=False,
+        max_concurrency: int=32, max_retries: int=4, incremental: bool=False, timing_index: bool=True,
+        cache_backend: str='files', segmenter: Optional[Segmenter]=None, pooled: bool=True,
+        backend: Optional[TTSBackend]=None, local_variants: bool=False):
     ''' build audio by generator output
+
+    max_concurrent_generations is only the starting point, the number of concurrent TTS requests
+    adapts to the endpoint's latency and errors, up to max_concurrency (see scheduler.py).
+    a segment failing max_retries + 1 times is replaced by silence and listed in temp/build_report.json
+
+    cache_dir=None disables the segment cache
+    cache_backend: 'files' (one file per segment in cache_dir) or 'kv' (segments are stored in the
+    shared SQLite cache, see kv_cache.py, cache_dir/kv_scratch only holds the recently used ones)
+    segmenter: repacks the provider's lines into sentence aligned chunks of a few hundred characters,
+    far fewer TTS requests (see segmenter.py)
+    backend: the TTS backend (see tts_backends.py), by default edge-tts:
+    pooled=True sends its requests over a pool of reused websocket sessions, one per worker at most
+    (see tts_transport.py), pooled=False opens a connection per segment.
+    ToneBackend() renders locally without network, for tests
+    local_variants=True synthesizes every text and voice once, at rate 1.0 and volume 1.0, and derives
+    the other rates and volumes from it by time stretching and gain (see audio_utils.time_stretch)
+    normalize: None, 'peak' or 'loudness', applied to every text segment
+    spool=True collects all PCM in one memory mapped file (temp/spool.pcm) instead of one wav per segment
+
+    every finished segment is appended to temp/manifest.jsonl, rerunning with the same inputs and temp_dir
+    after a crash only renders the missing or failed segments
+
+    incremental=True (implies spool) diffs the segments against the previous build in temp_dir by content hash:
+    only new or changed segments are synthesized, out.mp3 is spliced from the unchanged encoded chunks of
+    the previous out.mp3 and newly encoded chunks around the edits (see splice.py)
+
+    timing_index=True writes temp/timing.sqlite with the start / end of every segment, sentence and word
+    in out.mp3, and subtitles temp/out.srt, temp/out.vtt (see timing.py)
+
+    metrics (see auto_podcast/metrics.py) are reset when the build starts, so they cover this run including
+    the LLM calls of the generator. they are written to temp/metrics.json and temp/metrics.prom,
+    their summary goes to build_report.json and the log
     '''
+    metrics.REGISTRY.reset()
+    profiling.ensure_monitor()
+    gen = profiling.profile_agen('provider', gen)
+    if (segmenter is not None):
+        gen = segmenter(gen)
+    spool = spool or incremental
     # if (os.path.exists(temp_dir)):
     #     shutil.rmtree(temp_dir)
     os.makedirs(temp_dir, exist_ok=True)
@@ -83,67 +300,362 @@ async def build_audio(
     paths_file = os.path.join(temp_dir, 'paths.txt')
     script_file = os.path.join(temp_dir, 'script.txt')
     output_file = os.path.join(temp_dir, 'out.mp3')
-    
-    if (os.path.isfile(output_file)):
-        os.remove(output_file)
-    
-    # run segment processing in parallel with segment generation
-    segment_queue = asyncio.Queue(maxsize=100)
-    async def segment_queue_processing():
-            while (True):
-                item = await segment_queue.get()
-                if (item is None):
-                    # signal of the end
-                    break
-                fname, segment = item
-
-                logger.debug(f'Generating segment {fname} <= {segment}')
-                
-                if (isinstance(segment, TextSegment)):
-                    await build_audio_segment(fname, segment)
-                elif (isinstance(segment, WhiteSpace)):
-                    await build_whitespace(fname, segment)
-                else:
-                    logger.warning(f'Not a valid segment, ignoring: {segment}')
-                    continue
 
-    segment_queue_processing_tasks = [
-        asyncio.create_task(segment_queue_processing()) for _ in range(max_concurrent_generations)
-    ]
+    renderer = SegmentRenderer(
+        cache_dir, cache_max_bytes=cache_max_bytes, normalize=normalize, cache_backend=cache_backend,
+        backend=backend or EdgeTTSBackend(pooled=pooled, max_sessions=max_concurrency), close_backend=backend is None,
+        local_variants=local_variants)
+    # segments finished by an earlier (crashed) build with the same inputs are reused
+    manifest = BuildManifest(os.path.join(temp_dir, 'manifest.jsonl'), mode='spool' if spool else 'files')
+
+    pcm_spool = None
+    if (spool):
+        spool_file = os.path.join(temp_dir, 'spool.pcm')
+        if (len(manifest.previous) > 0):
+            # regions of replaced segments pile up build after build
+            moves = compact_spool(spool_file, manifest.spool_regions())
+            if (moves is not None):
+                manifest.relocate(moves, functools.partial(install_compacted, spool_file))
+        pcm_spool = PcmSpool(spool_file, resume=len(manifest.previous) > 0)
+
+    def try_resume(index: int, fname: str, content_hash: str) -> bool:
+        if (incremental):
+            # spool regions never move, reuse them wherever the segment is now
+            record = manifest.reusable_by_hash(content_hash)
+        else:
+            record = manifest.reusable(index, content_hash)
+        if (record is None):
+            return False
+        if (pcm_spool is not None):
+            if (record['offset'] is None):
+                return False
+            pcm_spool.adopt(index, record['offset'], record['length'])
+        elif (not os.path.isfile(fname)):
+            return False
+        if (record['index'] != index):
+            # moved by an edit, keep the manifest in sync with the new position
+            manifest.record(
+                index, content_hash, 'done', record['duration'], record['offset'], record['length'], record.get('words'))
+        durations[index] = record['duration']
+        words[index] = record.get('words', [])
+        manifest.reused += 1
+        _SEGMENTS.inc(source='resume')
+        return True
+
+    def write_silence(index: int, fname: str, content_hash: str, seconds: float, status: str='done'):
+        offset = length = None
+        if (pcm_spool is not None):
+            offset = pcm_spool.write_silence(index, seconds)
+            length = pcm_spool.index[index][1]
+        else:
+            audio_utils.make_empty_wav(fname, seconds)
+        durations[index] = seconds
+        manifest.record(index, content_hash, status, seconds, offset, length)
+        _SEGMENTS.inc(source='silence' if status == 'done' else status)
+
+    def store_text_segment(index: int, fname: str, content_hash: str, wav_file: str):
+        offset = length = None
+        segment_words = timing.load_words(wav_file)
+        if (pcm_spool is not None):
+            samples, _ = audio_utils.load_wav(wav_file)
+            offset = pcm_spool.write(index, samples)
+            length = pcm_spool.index[index][1]
+            duration = pcm_spool.duration(index)
+            if (wav_file == fname):
+                os.remove(fname)
+                if (os.path.isfile(timing.words_file(fname))):
+                    os.remove(timing.words_file(fname))
+        else:
+            if (wav_file != fname):
+                shutil.copyfile(wav_file, fname)
+            duration = audio_utils.wav_duration(fname)
+        durations[index] = duration
+        words[index] = segment_words
+        manifest.record(index, content_hash, 'done', duration, offset, length, segment_words)
+
+    async def process_text_segment(index: int, fname: str, segment: TextSegment):
+        logger.debug(f'Generating segment {fname} <= {segment}')
+        store_text_segment(index, fname, renderer.key(segment), await renderer.render(fname, segment))
+        _SEGMENTS.inc(source=renderer.source(segment))
+
+    # run segment processing in parallel with segment generation
+    scheduler = AdaptiveScheduler(
+        initial_concurrency=max_concurrent_generations, max_concurrency=max_concurrency, max_retries=max_retries)
+    submitted_hashes: Dict[int, str] = {}
+    build_hashes: List[str] = []
+    is_pause: List[bool] = []
+    # per segment index, for the timing index
+    texts: Dict[int, TextSegment] = {}
+    durations: Dict[int, float] = {}
+    words: Dict[int, List[dict]] = {}
 
     # segment generation
     with open(paths_file, 'w', encoding='utf-8') as paths_f, open(script_file, 'w', encoding='utf-8') as script_f:
 
         async for segment in gen:
 
-            fname = os.path.join(temp_dir, f'{seg_count:04d}.mp3')
+            fname = os.path.join(temp_dir, f'{seg_count:04d}.wav')
             logger.debug(f'Got segment from generator: {fname} <= {segment}')
 
-            await segment_queue.put((fname, segment))
-
-            paths_f.write(f"file '{os.path.abspath(fname)}'\n")
+            if (isinstance(segment, TextSegment)):
+                texts[seg_count] = segment
+                content_hash = renderer.key(segment)
+                resumed = try_resume(seg_count, fname, content_hash)
+                cached_file = None if resumed else renderer.cached(segment)
+                if (resumed):
+                    pass
+                elif (cached_file is not None):
+                    # cache hits don't need a worker, and would skew the latency the scheduler adapts to
+                    store_text_segment(seg_count, fname, content_hash, cached_file)
+                    _SEGMENTS.inc(source='cache')
+                else:
+                    submitted_hashes[seg_count] = content_hash
+                    await scheduler.submit(
+                        seg_count,
+                        lambda index=seg_count, fname=fname, segment=segment: process_text_segment(index, fname, segment),
+                        cost=len(segment.text), description=str(segment))
+            elif (isinstance(segment, WhiteSpace)):
+                content_hash = whitespace_key(segment)
+                if (not try_resume(seg_count, fname, content_hash)):
+                    write_silence(seg_count, fname, content_hash, segment.time)
+            else:
+                logger.warning(f'Not a valid segment, ignoring: {segment}')
+                continue
+
+            build_hashes.append(content_hash)
+            is_pause.append(isinstance(segment, WhiteSpace))
+            if (pcm_spool is None):
+                paths_f.write(f"file '{os.path.abspath(fname)}'\n")
             script_f.write(str((fname, segment)) + '\n')
             seg_count += 1
     
-    # signal of the end
-    for _ in range(max_concurrent_generations):
-        await segment_queue.put(None)
     # wait til processing is done
-    await asyncio.gather(*segment_queue_processing_tasks)
-    
-    logger.debug('Start ffmpeg merging')
-    cmd = f'ffmpeg -f concat -safe 0 -i {paths_file} -c copy {output_file}'
-    logger.debug(cmd)
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,universal_newlines=True)
-    ret = process.wait() # wait til finished
-    
-    with open(os.path.join(temp_dir, 'ffmpeg.log'), 'w', encoding='utf-8') as ffmpeg_log_f:
-        for line in process.stdout:
-            ffmpeg_log_f.write(line)
+    await scheduler.join()
+    await renderer.close()
+
+    for failure in scheduler.failures:
+        # keep the merge going, the gap is listed in build_report.json.
+        # recorded as failed, a restarted build tries it again
+        write_silence(
+            failure.index, os.path.join(temp_dir, f'{failure.index:04d}.wav'),
+            submitted_hashes[failure.index], FAILED_SEGMENT_SILENCE, status='failed')
+    if (len(scheduler.failures) > 0):
+        logger.warning(f'{len(scheduler.failures)} segments failed, replaced by silence')
+    manifest.close(seg_count)
+    report = {**scheduler.report(), 'reused': manifest.reused}
+    logger.info(f'Scheduler: {report}')
+
+    if (renderer.cache is not None):
+        logger.info(f'Segment cache: {renderer.cache.stats}')
+        with open(os.path.join(temp_dir, 'cache_stats.json'), 'w', encoding='utf-8') as stats_f:
+            json.dump(renderer.cache.report(), stats_f, indent=2)
+
+    out_index_file = os.path.join(temp_dir, 'out_index.json')
+    previous_output_file = os.path.join(temp_dir, 'out.prev.mp3')
+    if (os.path.isfile(output_file)):
+        if (incremental):
+            os.replace(output_file, previous_output_file)
+        else:
+            os.remove(output_file)
+
+    ffmpeg_log_file = os.path.join(temp_dir, 'ffmpeg.log')
+    returncode = 0
+    starts = None
+    merge_started = time.perf_counter()
+    with profiling.stage('merge'):
+        if (incremental):
+            logger.debug('Start splicing')
+            pcm_spool.save_index(os.path.join(temp_dir, 'spool_index.json'))
+            def encode_chunk(start: int, end: int) -> bytes:
+                return audio_utils.encode_pcm_chunk(
+                    b''.join(pcm_spool.iter_pcm(range(start, end))),
+                    frame_rate=pcm_spool.frame_rate, channels=pcm_spool.channels, bitrate=bitrate)
+            report['splice'] = splice.splice_output(
+                output_file, out_index_file, build_hashes, splice.plan_chunks(build_hashes, is_pause),
+                encode_chunk, previous_file=previous_output_file, previous_index=splice.load_output_index(out_index_file))
+            # every chunk adds its encoder delay and padding, the segments are shifted accordingly
+            starts = splice.segment_starts(out_index_file, durations, pcm_spool.frame_rate)
+            pcm_spool.close()
+            if (os.path.isfile(previous_output_file)):
+                os.remove(previous_output_file)
+        elif (pcm_spool is not None):
+            # one sequential pass over the spool, piped into a single encoder
+            logger.debug('Start encoding spool')
+            pcm_spool.save_index(os.path.join(temp_dir, 'spool_index.json'))
+            returncode = audio_utils.encode_pcm(
+                pcm_spool.iter_pcm(range(seg_count)), output_file,
+                frame_rate=pcm_spool.frame_rate, channels=pcm_spool.channels, bitrate=bitrate, log_file=ffmpeg_log_file)
+            pcm_spool.close()
+        else:
+            # segments are wav, this is the only encoding pass
+            logger.debug('Start ffmpeg merging')
+            cmd = ['ffmpeg', '-f', 'concat', '-safe', '0', '-i', paths_file, '-c:a', 'libmp3lame', '-b:a', bitrate, output_file]
+            logger.debug(cmd)
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,universal_newlines=True)
+            ffmpeg_output, _ = process.communicate() # wait til finished
+        
+            with open(ffmpeg_log_file, 'w', encoding='utf-8') as ffmpeg_log_f:
+                ffmpeg_log_f.write(ffmpeg_output)
+            returncode = process.returncode
     
-    if (process.returncode != 0):
-        logger.warning(f'non zero returncode: {process.returncode}')
+    _MERGE_SECONDS.observe(time.perf_counter() - merge_started)
+    if (returncode != 0):
+        logger.warning(f'non zero returncode: {returncode}')
+
+    if (timing_index):
+        write_timing_index(temp_dir, seg_count, texts, durations, words, starts=starts)
+
+    report['metrics'] = metrics.summary()
+    metrics.REGISTRY.write(os.path.join(temp_dir, 'metrics.json'), os.path.join(temp_dir, 'metrics.prom'))
+    logger.info(f'Run summary:\n{metrics.format_summary(report["metrics"])}')
+    with open(os.path.join(temp_dir, 'build_report.json'), 'w', encoding='utf-8') as report_f:
+        json.dump(report, report_f, indent=2, ensure_ascii=False)
     
     return output_file
 
 
+async def build_audio_stream(
+        gen: AsyncGenerator[Union[TextSegment, WhiteSpace], None], *,
+        max_concurrent_generations: int=5, temp_dir: str='./temp',
+        cache_dir: Optional[str]='cache/tts_segments', cache_max_bytes: int=2 * 1024 ** 3,
+        normalize: Optional[str]=None, bitrate: str='64k',
+        max_concurrency: int=32, max_retries: int=4,
+        reorder_window: int=64, output_file: Optional[str]=None, chunk_size: int=16 * 1024,
+        cache_backend: str='files', segmenter: Optional[Segmenter]=None, pooled: bool=True,
+        backend: Optional[TTSBackend]=None, local_variants: bool=False) -> AsyncIterator[bytes]:
+    ''' like build_audio, but yields mp3 chunks as soon as a prefix of the segments is ready
+
+    usage: async for chunk in build_audio_stream(gen()): ...
+
+    segments finishing out of order wait in a reorder buffer of at most reorder_window segments,
+    the generator is not read further ahead than that. the scheduler always picks the
+    earliest unfinished segment, so playback can start after the first few segments.
+    output_file: if given, the mp3 is also written there as it grows
+    '''
+    metrics.REGISTRY.reset()
+    profiling.ensure_monitor()
+    gen = profiling.profile_agen('provider', gen)
+    if (segmenter is not None):
+        gen = segmenter(gen)
+    os.makedirs(temp_dir, exist_ok=True)
+    renderer = SegmentRenderer(
+        cache_dir, cache_max_bytes=cache_max_bytes, normalize=normalize, cache_backend=cache_backend,
+        backend=backend or EdgeTTSBackend(pooled=pooled, max_sessions=max_concurrency), close_backend=backend is None,
+        local_variants=local_variants)
+    frame_rate = audio_utils.DEFAULT_FRAME_RATE
+    bytes_per_second = frame_rate * audio_utils.SAMPLE_WIDTH
+
+    progress = asyncio.Condition()
+    finished: Dict[int, bytes] = {} # reorder buffer, index -> PCM
+    state = {'next': 0, 'total': None} # next index to encode, number of segments once gen is exhausted
+
+    async def set_finished(index: int, pcm: bytes):
+        async with progress:
+            finished[index] = pcm
+            progress.notify_all()
+
+    def silence(seconds: float) -> bytes:
+        return bytes(int(seconds * frame_rate) * audio_utils.SAMPLE_WIDTH)
+
+    async def process_text_segment(index: int, segment: TextSegment):
+        fname = os.path.join(temp_dir, f'stream_{index:04d}.wav')
+        wav_file = await renderer.render(fname, segment)
+        samples, _ = audio_utils.load_wav(wav_file)
+        if (wav_file == fname):
+            os.remove(fname)
+        await set_finished(index, samples.tobytes())
+        _SEGMENTS.inc(source=renderer.source(segment))
+
+    wakeups = set()
+    def on_failure(failure):
+        logger.warning(f'segment {failure.index} failed, replaced by silence')
+        _SEGMENTS.inc(source='failed')
+        # called under the scheduler's lock, hand over to a task
+        task = asyncio.get_running_loop().create_task(set_finished(failure.index, silence(FAILED_SEGMENT_SILENCE)))
+        wakeups.add(task)
+        task.add_done_callback(wakeups.discard)
+
+    scheduler = AdaptiveScheduler(
+        initial_concurrency=max_concurrent_generations, max_concurrency=max_concurrency,
+        max_retries=max_retries, on_failure=on_failure)
+
+    async def produce():
+        index = 0
+        try:
+            async for segment in gen:
+                async with progress:
+                    # bounded reorder buffer: never run more than reorder_window ahead of the encoder
+                    await progress.wait_for(lambda: index < state['next'] + reorder_window)
+                logger.debug(f'Got segment from generator: {index} <= {segment}')
+                if (isinstance(segment, TextSegment)):
+                    cached_file = renderer.cached(segment)
+                    if (cached_file is not None):
+                        samples, _ = audio_utils.load_wav(cached_file)
+                        await set_finished(index, samples.tobytes())
+                        _SEGMENTS.inc(source='cache')
+                    else:
+                        await scheduler.submit(
+                            index, lambda index=index, segment=segment: process_text_segment(index, segment),
+                            cost=len(segment.text), description=str(segment))
+                elif (isinstance(segment, WhiteSpace)):
+                    await set_finished(index, silence(segment.time))
+                    _SEGMENTS.inc(source='silence')
+                else:
+                    logger.warning(f'Not a valid segment, ignoring: {segment}')
+                    continue
+                index += 1
+            await scheduler.join()
+        finally:
+            async with progress:
+                state['total'] = index
+                progress.notify_all()
+
+    async def feed_encoder(stdin: asyncio.StreamWriter):
+        try:
+            while (True):
+                async with progress:
+                    await progress.wait_for(
+                        lambda: state['next'] in finished or (state['total'] is not None and state['next'] >= state['total']))
+                    if (state['next'] not in finished):
+                        break
+                    pcm = finished.pop(state['next'])
+                stdin.write(pcm)
+                await stdin.drain()
+                async with progress:
+                    state['next'] += 1
+                    progress.notify_all()
+        finally:
+            stdin.close()
+
+    encoder = await asyncio.create_subprocess_exec(
+        *audio_utils.mp3_encoder_cmd('pipe:1', frame_rate=frame_rate, bitrate=bitrate),
+        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+    producer_task = asyncio.create_task(produce())
+    feeder_task = asyncio.create_task(feed_encoder(encoder.stdin))
+    out_f = open(output_file, 'wb') if output_file is not None else None
+    try:
+        while (True):
+            chunk = await encoder.stdout.read(chunk_size)
+            if (len(chunk) == 0):
+                break
+            if (out_f is not None):
+                out_f.write(chunk)
+                out_f.flush()
+            yield chunk
+        # surface errors of the generator
+        await producer_task
+        await feeder_task
+        returncode = await encoder.wait()
+        if (returncode != 0):
+            logger.warning(f'non zero returncode: {returncode}')
+        logger.info(f'Streamed {state["next"]} segments, scheduler: {scheduler.report()}')
+        logger.info(f'Run summary:\n{metrics.format_summary()}')
+    finally:
+        for task in (producer_task, feeder_task):
+            task.cancel()
+        await renderer.close()
+        if (encoder.returncode is None):
+            encoder.kill()
+            await encoder.wait()
+        if (out_f is not None):
+            out_f.close()
@@ -1,31 +1,281 @@
 
+from typing import (
+    Iterable,
+    Optional,
+    Tuple,
+    Union,
+)
+
 from pydub import AudioSegment
+import numpy as np
+import io
 import os
+import subprocess
+import wave
+
+# edge-tts produces 24kHz mono
+DEFAULT_FRAME_RATE = 24000
+SAMPLE_WIDTH = 2 # int16 PCM everywhere
+INT16_FULL_SCALE = 32768.0
+
 
 def make_empty_mp3(output_file: str, seconds: float):
     num_segments = int(seconds * 1000)
     silence = AudioSegment.silent(duration=num_segments, frame_rate=24000)
     silence.export(output_file, format="mp3")
 
+def make_empty_wav(output_file: str, seconds: float, frame_rate: int=DEFAULT_FRAME_RATE):
+    save_wav(output_file, np.zeros((int(seconds * frame_rate), 1), dtype=np.int16), frame_rate)
+
+
+def load_pcm(source: Union[str, bytes], *, format: str='mp3',
+             frame_rate: Optional[int]=None, channels: Optional[int]=None) -> Tuple[np.ndarray, int]:
+    ''' decode a file (path or in-memory bytes) to int16 samples, shape (n_frames, n_channels) '''
+    if (isinstance(source, (bytes, bytearray))):
+        source = io.BytesIO(source)
+    audio = AudioSegment.from_file(source, format=format).set_sample_width(SAMPLE_WIDTH)
+    if (frame_rate is not None):
+        audio = audio.set_frame_rate(frame_rate)
+    if (channels is not None):
+        audio = audio.set_channels(channels)
+    samples = np.frombuffer(audio.raw_data, dtype=np.int16).reshape(-1, audio.channels)
+    return samples, audio.frame_rate
+
+def save_wav(output_file: str, samples: np.ndarray, frame_rate: int):
+    ''' write int16 samples as wav, no encoding involved '''
+    samples = np.asarray(samples, dtype=np.int16)
+    if (samples.ndim == 1):
+        samples = samples[:, None]
+    with wave.open(output_file, 'wb') as f:
+        f.setnchannels(samples.shape[1])
+        f.setsampwidth(SAMPLE_WIDTH)
+        f.setframerate(frame_rate)
+        f.writeframes(np.ascontiguousarray(samples).tobytes())
+
+
+def load_wav(input_file: str) -> Tuple[np.ndarray, int]:
+    ''' read a wav written by save_wav '''
+    with wave.open(input_file, 'rb') as f:
+        assert f.getsampwidth() == SAMPLE_WIDTH
+        data = f.readframes(f.getnframes())
+        return np.frombuffer(data, dtype=np.int16).reshape(-1, f.getnchannels()), f.getframerate()
 
-def trim_mp3(input_file: str, output_file: str, window_size: int = 50, window_interval: int = 20, silence_thr: float = -50):
+def wav_duration(input_file: str) -> float:
+    ''' seconds, from the header only '''
+    with wave.open(input_file, 'rb') as f:
+        return f.getnframes() / f.getframerate()
+
+def mp3_encoder_cmd(output: str, *, frame_rate: int=DEFAULT_FRAME_RATE, channels: int=1, bitrate: str='64k'):
+    ''' ffmpeg command reading raw int16 PCM from stdin. output='pipe:1' writes mp3 to stdout '''
+    return [
+        'ffmpeg', '-y', '-f', 's16le', '-ar', str(frame_rate), '-ac', str(channels), '-i', 'pipe:0',
+        '-c:a', 'libmp3lame', '-b:a', bitrate, '-f', 'mp3', '-flush_packets', '1', output,
+    ]
+
+def encode_pcm_chunk(pcm: bytes, *, frame_rate: int=DEFAULT_FRAME_RATE, channels: int=1, bitrate: str='64k') -> bytes:
+    ''' encode PCM to bare mp3 frames (no ID3 / Xing header), so encoded chunks can be concatenated '''
+    cmd = mp3_encoder_cmd('pipe:1', frame_rate=frame_rate, channels=channels, bitrate=bitrate)
+    cmd[-1:-1] = ['-write_xing', '0', '-id3v2_version', '0']
+    result = subprocess.run(cmd, input=pcm, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if (result.returncode != 0):
+        raise RuntimeError(f'ffmpeg failed: {result.stderr.decode("utf-8", errors="replace")[-500:]}')
+    return result.stdout
+
+def encode_pcm(chunks: Iterable[bytes], output_file: str, *, frame_rate: int=DEFAULT_FRAME_RATE, channels: int=1,
+               bitrate: str='64k', log_file: Optional[str]=None) -> int:
+    ''' pipe raw int16 PCM through one ffmpeg process into an mp3. returns ffmpeg's returncode '''
+    cmd = mp3_encoder_cmd(output_file, frame_rate=frame_rate, channels=channels, bitrate=bitrate)
+    log_f = open(log_file, 'w', encoding='utf-8') if log_file is not None else subprocess.DEVNULL
+    try:
+        process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=log_f, stderr=subprocess.STDOUT)
+        try:
+            for chunk in chunks:
+                process.stdin.write(chunk)
+        finally:
+            process.stdin.close()
+        return process.wait()
+    finally:
+        if (log_file is not None):
+            log_f.close()
+
+
+def window_dbfs(samples: np.ndarray, frame_rate: int, window_size: int=50, window_interval: int=20):
     '''
-    Silence detection with sliding window
+    loudness of every window, windows start every window_interval ms and are window_size ms long.
+    same definition as pydub's AudioSegment.dBFS, computed for all windows at once from a
+    cumulative sum of the per-frame energy.
+
+    returns (window start frames, window length in frames, dBFS array)
     '''
+    n = samples.shape[0]
+    win = max(1, frame_rate * window_size // 1000)
+    hop = max(1, frame_rate * window_interval // 1000)
+    x = samples.reshape(n, -1).astype(np.int32)
+    # int64 running sum of squares is exact, no float conversion of the whole signal
+    energy = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum((x * x).sum(axis=1, dtype=np.int64), out=energy[1:])
+    starts = np.arange(0, max(n - win, 0) + 1, hop)
+    ends = np.minimum(starts + win, n)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_square = (energy[ends] - energy[starts]) / ((ends - starts) * x.shape[1] * INT16_FULL_SCALE ** 2)
+        dbfs = 10 * np.log10(mean_square)
+    return starts, win, np.nan_to_num(dbfs, nan=-np.inf)
 
-    audio = AudioSegment.from_mp3(input_file)
+def first_loud_frame(samples: np.ndarray, frame_rate: int, window_size: int=50,
+                     window_interval: int=20, silence_thr: float=-50) -> Optional[int]:
+    ''' start of the first window louder than silence_thr, None if there is none.
+    only looks at a growing prefix, the middle of a long segment is never touched '''
+    n = samples.shape[0]
+    span = frame_rate # 1s first, grows 4x
+    while (True):
+        starts, win, dbfs = window_dbfs(samples[:span], frame_rate, window_size, window_interval)
+        loud = np.flatnonzero(dbfs >= silence_thr)
+        if (len(loud) > 0):
+            return int(starts[loud[0]])
+        if (span >= n):
+            return None
+        # windows are recomputed from 0, geometric growth keeps the total work linear
+        span *= 4
 
-    start_trim = 0
-    end_trim = 0
+def find_trim_bounds(samples: np.ndarray, frame_rate: int, window_size: int=50,
+                     window_interval: int=20, silence_thr: float=-50) -> Tuple[int, int]:
+    ''' [start, end) frames of the non silent part. (0, 0) if everything is silent '''
+    start = first_loud_frame(samples, frame_rate, window_size, window_interval, silence_thr)
+    if (start is None):
+        return 0, 0
+    # same search on the reversed signal, windows are anchored at the end
+    end_offset = first_loud_frame(samples[::-1], frame_rate, window_size, window_interval, silence_thr)
+    return start, samples.shape[0] - end_offset
 
-    # Detect silence at the beginning
-    while audio[start_trim:start_trim+window_size].dBFS < silence_thr:
-        start_trim += window_interval
+def normalize_gain(samples: np.ndarray, normalize: str, target_dbfs: Optional[float]=None) -> float:
+    ''' linear gain that brings the peak ('peak') or rms ('loudness') to target_dbfs '''
+    if (samples.size == 0):
+        return 1.0
+    x = samples.astype(np.float64) / INT16_FULL_SCALE
+    if (normalize == 'peak'):
+        target_dbfs = -1.0 if target_dbfs is None else target_dbfs
+        level = np.abs(x).max()
+    elif (normalize == 'loudness'):
+        target_dbfs = -20.0 if target_dbfs is None else target_dbfs
+        level = np.sqrt(np.mean(x * x))
+    else:
+        raise ValueError(f'unknown normalization: {normalize}')
+    if (level <= 0):
+        return 1.0
+    return 10 ** (target_dbfs / 20) / level
 
-    # Detect silence at the end
-    while audio[-end_trim-window_size:].dBFS < silence_thr:
-        end_trim += window_interval
+def trim_pcm_bounds(samples: np.ndarray, frame_rate: int, window_size: int=50, window_interval: int=20,
+                    silence_thr: float=-50, normalize: Optional[str]=None,
+                    target_dbfs: Optional[float]=None) -> Tuple[np.ndarray, int]:
+    ''' trim_pcm, also returns the number of frames removed at the start '''
+    start, end = find_trim_bounds(samples, frame_rate, window_size, window_interval, silence_thr)
+    trimmed = samples[start:end]
+    if (normalize is not None):
+        gain = normalize_gain(trimmed, normalize, target_dbfs)
+        trimmed = np.clip(np.rint(trimmed * gain), -INT16_FULL_SCALE, INT16_FULL_SCALE - 1).astype(np.int16)
+    return trimmed, start
 
-    trimmed_audio = audio[start_trim:-end_trim]
-    trimmed_audio.export(output_file, format="mp3")
+def trim_pcm(samples: np.ndarray, frame_rate: int, window_size: int=50, window_interval: int=20,
+             silence_thr: float=-50, normalize: Optional[str]=None, target_dbfs: Optional[float]=None) -> np.ndarray:
+    '''
+    Remove leading and trailing silence, optionally normalize ('peak' or 'loudness') the remaining part
+    '''
+    return trim_pcm_bounds(samples, frame_rate, window_size, window_interval, silence_thr, normalize, target_dbfs)[0]
+
+
+def decode_tts_audio(mp3_data: bytes, frame_rate: int=DEFAULT_FRAME_RATE, **trim_kwargs) -> np.ndarray:
+    ''' decode TTS output to mono PCM at frame_rate and trim it '''
+    samples, frame_rate = load_pcm(mp3_data, frame_rate=frame_rate, channels=1)
+    return trim_pcm(samples, frame_rate, **trim_kwargs)
+
+def process_tts_audio(mp3_data: bytes, output_file: str, frame_rate: int=DEFAULT_FRAME_RATE, **trim_kwargs) -> Tuple[float, float]:
+    ''' decode TTS output, trim and store as wav. returns (duration, seconds trimmed at the start) '''
+    samples, frame_rate = load_pcm(mp3_data, frame_rate=frame_rate, channels=1)
+    trimmed, start = trim_pcm_bounds(samples, frame_rate, **trim_kwargs)
+    save_wav(output_file, trimmed, frame_rate)
+    return trimmed.shape[0] / frame_rate, start / frame_rate
+
+def trim_mp3(input_file: str, output_file: str, window_size: int = 50, window_interval: int = 20, silence_thr: float = -50,
+             normalize: Optional[str]=None, target_dbfs: Optional[float]=None):
+    '''
+    Silence detection with sliding window
+
+    output is encoded as mp3 unless output_file ends with .wav
+    '''
+    samples, frame_rate = load_pcm(input_file)
+    trimmed = trim_pcm(samples, frame_rate, window_size, window_interval, silence_thr, normalize, target_dbfs)
+    if (os.path.splitext(output_file)[1].lower() == '.wav'):
+        save_wav(output_file, trimmed, frame_rate)
+    else:
+        AudioSegment(
+            trimmed.tobytes(), frame_rate=frame_rate, sample_width=SAMPLE_WIDTH, channels=trimmed.shape[1]
+        ).export(output_file, format="mp3")
+
+
+# bump when time_stretch output changes, it is part of the cache keys of derived segments
+STRETCH_VERSION = 3
+
+def time_stretch(samples: np.ndarray, frame_rate: int, rate: float, *, gain: float=1.0,
+                 window_ms: int=30, tolerance_ms: int=10) -> np.ndarray:
+    '''
+    WSOLA (waveform similarity overlap-add): int16 samples played rate times faster at the same pitch,
+    multiplied by gain in the same pass. shape (n_frames, n_channels) -> (about n_frames / rate, n_channels)
+
+    output frames are 50% overlapping Hann windows, the input frame of each one is searched within
+    tolerance_ms of its nominal position for the best match with the continuation of the previous frame.
+    the similarity of every candidate of every frame is one batch of FFT cross correlations, taken against
+    the continuation of the previous frame's nominal position over twice the tolerance: a previous frame
+    moved by d is matched by reading the scores d further (the signal is about the same a few ms apart).
+    only that pick, which depends on the previous one, is a loop, an argmax over precomputed scores.
+    the overlap-add itself is a single reshape
+    '''
+    x = samples.reshape(samples.shape[0], -1).astype(np.float64)
+    n = x.shape[0]
+    if (rate == 1.0 or n == 0):
+        y = x * gain
+    else:
+        win = max(4, frame_rate * window_ms // 1000) // 2 * 2
+        hop = win // 2 # synthesis hop
+        tol = frame_rate * tolerance_ms // 1000
+        window = np.hanning(win + 1)[:win] # periodic, 50% overlapping copies sum to 1
+        mono = x.mean(axis=1)
+        out_frames = int(np.ceil(n / rate / hop)) + 1
+        # frame 0 starts hop before the input: its second half, the first output block, is the input onset
+        # and overlaps with frame 1 like every other block
+        lead = 2 * tol + win # padding before the input, so every candidate exists
+        start = lead - hop
+        nominal = start + np.rint(np.arange(out_frames) * hop * rate).astype(np.int64) # in padded
+        anchors = nominal[:-1] + hop # continuation of the nominal previous frame
+        lo = nominal[1:] - 2 * tol # first candidate considered for frame k
+        span = 4 * tol + win
+        padded = np.zeros(max(int(lo[-1]) + span, int(anchors[-1]) + win, lead + n) + 1)
+        padded[lead:lead + n] = mono
+        regions = padded[lo[:, None] + np.arange(span)[None, :]] # (out_frames - 1, span)
+        templates = padded[anchors[:, None] + np.arange(win)[None, :]] # (out_frames - 1, win)
+        size = 1 << int(np.ceil(np.log2(span + win)))
+        # scores[k - 1, j]: candidate nominal[k] - 2 tol + j against the nominal continuation of frame k - 1
+        scores = np.fft.irfft(np.fft.rfft(regions, size) * np.conj(np.fft.rfft(templates, size)), size)[:, :4 * tol + 1]
+        offsets = np.zeros(out_frames, dtype=np.int64) # chosen position - nominal position
+        for k in range(1, out_frames):
+            # candidates nominal[k] - tol .. + tol, shifted by the offset of the previous frame
+            first = tol - offsets[k - 1]
+            offsets[k] = int(np.argmax(scores[k - 1, first:first + 2 * tol + 1])) - tol
+        positions = nominal + offsets
+        # frames of every channel at the chosen positions, windowed and scaled
+        xp = np.zeros((padded.shape[0] + win, x.shape[1]))
+        xp[lead:lead + n] = x
+        index = positions[:, None] + np.arange(win)[None, :] # (out_frames, win)
+        frames = xp[index] * (window * gain)[None, :, None] # (out_frames, win, channels)
+        # overlap-add with hop = win / 2: first halves land on blocks k, second halves on blocks k + 1
+        y = np.zeros((out_frames + 1, hop, x.shape[1]))
+        y[:-1] += frames[:, :hop]
+        y[1:] += frames[:, hop:]
+        # block 0 is the first half of frame 0, only padding
+        y = y.reshape(-1, x.shape[1])[hop:hop + int(round(n / rate))]
+    return np.clip(np.rint(y), -INT16_FULL_SCALE, INT16_FULL_SCALE - 1).astype(np.int16)
 
+def stretch_to_wav(samples: np.ndarray, frame_rate: int, output_file: str, rate: float, gain: float=1.0) -> float:
+    ''' time_stretch samples into a wav, returns its duration '''
+    stretched = time_stretch(samples, frame_rate, rate, gain=gain)
+    save_wav(output_file, stretched, frame_rate)
+    return stretched.shape[0] / frame_rate
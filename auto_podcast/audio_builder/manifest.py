@@ -0,0 +1,158 @@
+
+"""
+
+Build Manifest
+
+append-only record of the segments of one build (temp/manifest.jsonl),
+one json object per line:
+
+    {"index": 12, "hash": "...", "status": "done", "duration": 1.52, "offset": 1048576, "length": 72960}
+
+offset/length locate the PCM in the spool (spool mode only), text segments
+with word timings also carry "words".
+a restarted build with the same inputs reuses every "done" segment whose
+index and hash still match, and only renders the rest. an incremental
+build (spool mode) reuses spool regions by hash alone, wherever they moved.
+
+"""
+
+from typing import (
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+import json
+import os
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+MANIFEST_VERSION = 1
+
+
+class BuildManifest():
+
+    def __init__(self, path: str, *, mode: str):
+        '''
+        mode: how the segments are stored ('files' or 'spool'),
+            records of a build in another mode are not reused
+        '''
+        self.path = path
+        self.mode = mode
+        # index -> latest record of the previous builds
+        self.previous: Dict[int, dict] = {}
+        self.reused = 0
+        # index -> record written by this build
+        self.current: Dict[int, dict] = {}
+        self._load()
+        self._by_hash: Dict[str, dict] = {
+            record['hash']: record for record in self.previous.values() if record['status'] == 'done'
+        }
+        self._compact()
+        self._f = open(path, 'a', encoding='utf-8')
+
+    def _load(self):
+        if (not os.path.isfile(self.path)):
+            return
+        header = None
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # truncated by a crash, everything before it is still good
+                    logger.debug(f'skipping broken manifest line: {repr(line)}')
+                    continue
+                if ('index' not in record):
+                    header = record
+                    continue
+                self.previous[record['index']] = record
+        if (header is None or header.get('version') != MANIFEST_VERSION or header.get('mode') != self.mode):
+            logger.info(f'manifest {self.path} is from an incompatible build, starting over')
+            self.previous = {}
+        logger.debug(f'loaded {len(self.previous)} segment records from {self.path}')
+
+    def _compact(self):
+        ''' rewrite as header + one record per index, atomically '''
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'version': MANIFEST_VERSION, 'mode': self.mode, 'started': time.time()}) + '\n')
+            for index in sorted(self.previous):
+                f.write(json.dumps(self.previous[index], ensure_ascii=False) + '\n')
+        os.replace(tmp_path, self.path)
+
+    def reusable(self, index: int, content_hash: str) -> Optional[dict]:
+        ''' the record of a finished segment with the same content at the same index '''
+        record = self.previous.get(index)
+        if (record is None or record['status'] != 'done' or record['hash'] != content_hash):
+            return None
+        return record
+
+    def reusable_by_hash(self, content_hash: str) -> Optional[dict]:
+        ''' the record of a finished segment with the same content at any index '''
+        record = self._by_hash.get(content_hash)
+        if (record is None or record['status'] != 'done'):
+            return None
+        return record
+
+    def spool_regions(self) -> Set[Tuple[int, int]]:
+        ''' (offset, length) of the spool regions a finished segment of the previous builds refers to '''
+        return {
+            (record['offset'], record['length']) for record in self.previous.values()
+            if record['status'] == 'done' and record.get('offset') is not None
+        }
+
+    def relocate(self, moves: Dict[int, int], swap: Callable[[], None]):
+        '''
+        the spool was compacted: offsets of the previous records move (old -> new), records of
+        dropped regions lose theirs. swap() installs the compacted spool, the manifest is removed
+        meanwhile, so a crash in between costs a full rebuild instead of pointing into the wrong spool
+        '''
+        self._f.close()
+        os.remove(self.path)
+        swap()
+        for record in self.previous.values():
+            if (record.get('offset') is not None):
+                record['offset'] = moves.get(record['offset'])
+        self._compact()
+        self._f = open(self.path, 'a', encoding='utf-8')
+
+    def record(self, index: int, content_hash: str, status: str, duration: float,
+               offset: Optional[int]=None, length: Optional[int]=None, words: Optional[List[dict]]=None):
+        ''' words: word timings of the segment (see timing.py), kept so resumed segments still have them '''
+        record = {
+            'index': index,
+            'hash': content_hash,
+            'status': status,
+            'duration': duration,
+            'offset': offset,
+            'length': length,
+        }
+        if (words):
+            record['words'] = words
+        # one line per write, a crash can only truncate the last record
+        self._f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self._f.flush()
+        self.current[index] = record
+
+    def close(self, segment_count: Optional[int]=None):
+        '''
+        segment_count: segments of the finished build. records at indexes past it (the book got shorter)
+        are dropped, so their spool regions are not kept alive by later builds. a segment of theirs
+        that moved to a smaller index was recorded there again
+        '''
+        self._f.close()
+        if (segment_count is None):
+            return
+        records = {**self.previous, **self.current}
+        kept = {index: record for index, record in records.items() if index < segment_count}
+        if (len(kept) < len(records)):
+            logger.debug(f'dropped {len(records) - len(kept)} records past segment {segment_count}')
+            self.previous = kept
+            self._compact()
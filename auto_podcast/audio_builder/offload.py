@@ -0,0 +1,74 @@
+
+"""
+
+Offload
+
+runs CPU-bound audio post-processing (mp3 decoding, trimming, wav writing)
+outside of the event loop, so in-flight TTS streams are never stalled by it.
+
+by default a process pool with one worker per CPU is created on first use.
+configure(max_workers=0) runs everything inline (debugging),
+configure(kind='thread') uses threads instead of processes.
+
+"""
+
+from typing import (
+    Any,
+    Callable,
+    Optional,
+)
+
+import asyncio
+import concurrent.futures
+import functools
+import os
+import logging
+
+from .. import profiling
+
+logger = logging.getLogger(__name__)
+
+
+_executor: Optional[concurrent.futures.Executor] = None
+_max_workers: Optional[int] = None
+_kind = 'process'
+
+
+def configure(max_workers: Optional[int]=None, *, kind: str='process'):
+    ''' max_workers=None: one per CPU, 0: run inline. kind: 'process' or 'thread' '''
+    global _max_workers, _kind
+    if (kind not in ('process', 'thread')):
+        raise ValueError(f'unknown executor kind: {kind}')
+    shutdown()
+    _max_workers = max_workers
+    _kind = kind
+
+def get_executor() -> Optional[concurrent.futures.Executor]:
+    global _executor
+    if (_max_workers == 0):
+        return None
+    if (_executor is None):
+        max_workers = _max_workers or os.cpu_count() or 1
+        if (_kind == 'process'):
+            _executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+        else:
+            _executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='offload')
+        logger.debug(f'started {_kind} pool with {max_workers} workers')
+    return _executor
+
+async def run_cpu(fn: Callable[..., Any], *args, **kwargs) -> Any:
+    ''' await fn(*args, **kwargs) in the pool. with processes fn and its arguments must be picklable '''
+    if (profiling.enabled()):
+        # workers inherit the environment and sample themselves
+        args = (fn,) + args
+        fn = functools.partial(profiling.sampled_call, 'postprocess')
+    executor = get_executor()
+    if (executor is None):
+        return fn(*args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+
+def shutdown():
+    global _executor
+    if (_executor is not None):
+        _executor.shutdown(wait=True)
+        _executor = None
@@ -0,0 +1,180 @@
+
+"""
+
+PCM Spool
+
+a single memory mapped file holding the raw PCM of every segment,
+replacing one file per segment.
+
+each segment gets a region reserved at the end of the spool when it is
+finished, an offset index maps segment index -> (offset, nbytes).
+the spool file only ever grows by truncation, so reserved but unwritten
+regions are zero, which is exactly silence: WhiteSpace never touches the disk.
+
+regions are never freed while the spool is open. an incremental build appends
+the changed segments, so before a build compact_spool rewrites the spool with
+only the regions the manifest still references, once they are less than half of it.
+
+"""
+
+from typing import (
+    Collection,
+    Dict,
+    Iterable,
+    Iterator,
+    Optional,
+    Tuple,
+)
+
+import json
+import mmap
+import os
+import logging
+
+import numpy as np
+
+from .audio_utils import (
+    DEFAULT_FRAME_RATE,
+    SAMPLE_WIDTH,
+)
+
+logger = logging.getLogger(__name__)
+
+
+# compact when more than this fraction of the spool file is not referenced any more
+MAX_DEAD_RATIO = 0.5
+COMPACT_SUFFIX = '.compact'
+
+
+class PcmSpool():
+
+    def __init__(self, path: str, *, frame_rate: int=DEFAULT_FRAME_RATE, channels: int=1,
+                 grow_bytes: int=64 * 1024 * 1024, resume: bool=False):
+        ''' resume=True keeps the content of an existing spool file, regions can be taken over with adopt() '''
+        self.path = path
+        self.frame_rate = frame_rate
+        self.channels = channels
+        self.grow_bytes = grow_bytes
+        self.bytes_per_frame = SAMPLE_WIDTH * channels
+        # segment index -> (offset, nbytes)
+        self.index: Dict[int, Tuple[int, int]] = {}
+        self._end = 0 # first free byte
+        self._capacity = 0
+        if (resume and os.path.isfile(path)):
+            self._file = open(path, 'r+b')
+            self._end = self._capacity = os.path.getsize(path)
+        else:
+            self._file = open(path, 'w+b') # starts empty
+        self._mm: Optional[mmap.mmap] = None
+        self._grow(self._capacity + grow_bytes)
+
+    def _grow(self, min_capacity: int):
+        capacity = max(min_capacity, self._capacity + self.grow_bytes)
+        if (self._mm is not None):
+            self._mm.flush()
+            self._mm.close()
+        self._file.truncate(capacity) # new bytes are zero
+        self._mm = mmap.mmap(self._file.fileno(), capacity)
+        self._capacity = capacity
+
+    def reserve(self, index: int, nbytes: int) -> int:
+        ''' reserve a zero filled region for segment index, returns its offset '''
+        if (index in self.index):
+            raise ValueError(f'segment {index} is already spooled')
+        offset = self._end
+        if (offset + nbytes > self._capacity):
+            self._grow(offset + nbytes)
+        self._end += nbytes
+        self.index[index] = (offset, nbytes)
+        return offset
+
+    def adopt(self, index: int, offset: int, nbytes: int):
+        ''' register a region written by a previous build '''
+        if (offset + nbytes > self._end):
+            raise ValueError(f'region {offset}+{nbytes} is outside of the spool')
+        self.index[index] = (offset, nbytes)
+
+    def write(self, index: int, samples: np.ndarray) -> int:
+        ''' copy int16 samples of segment index into the spool '''
+        data = np.ascontiguousarray(samples, dtype=np.int16).tobytes()
+        offset = self.reserve(index, len(data))
+        self._mm[offset:offset + len(data)] = data
+        return offset
+
+    def write_silence(self, index: int, seconds: float) -> int:
+        ''' silence is a reserved region, nothing is written '''
+        return self.reserve(index, int(seconds * self.frame_rate) * self.bytes_per_frame)
+
+    def duration(self, index: int) -> float:
+        return self.index[index][1] / self.bytes_per_frame / self.frame_rate
+
+    def iter_pcm(self, indices: Optional[Iterable[int]]=None, chunk_bytes: int=1024 * 1024) -> Iterator[bytes]:
+        ''' raw PCM of the given segments (all, in index order by default), in chunks '''
+        if (indices is None):
+            indices = sorted(self.index)
+        self._mm.flush()
+        for index in indices:
+            if (index not in self.index):
+                logger.warning(f'segment {index} is missing in the spool, skipped')
+                continue
+            offset, nbytes = self.index[index]
+            for start in range(offset, offset + nbytes, chunk_bytes):
+                yield self._mm[start:min(start + chunk_bytes, offset + nbytes)]
+
+    def save_index(self, index_file: str):
+        with open(index_file, 'w', encoding='utf-8') as f:
+            json.dump({
+                'frame_rate': self.frame_rate,
+                'channels': self.channels,
+                'sample_width': SAMPLE_WIDTH,
+                'segments': [[i, offset, nbytes] for i, (offset, nbytes) in sorted(self.index.items())],
+            }, f)
+
+    def close(self):
+        if (self._mm is not None):
+            self._mm.flush()
+            self._mm.close()
+            self._mm = None
+            # drop the unused tail of the last growth step
+            self._file.truncate(self._end)
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def compact_spool(path: str, regions: Collection[Tuple[int, int]], *, max_dead_ratio: float=MAX_DEAD_RATIO,
+                  copy_bytes: int=1024 * 1024) -> Optional[Dict[int, int]]:
+    '''
+    writes the (offset, nbytes) regions of the spool file at path back to back into path + COMPACT_SUFFIX,
+    if more than max_dead_ratio of the file is outside of them. returns old offset -> new offset,
+    None when the spool is left as it is. install_compacted(path) swaps the new file in
+    '''
+    if (not os.path.isfile(path)):
+        return None
+    size = os.path.getsize(path)
+    live = dict(regions) # same region referenced twice (a moved segment) is copied once
+    live_bytes = sum(live.values())
+    if (size == 0 or size - live_bytes <= max_dead_ratio * size):
+        return None
+    moves = {}
+    with open(path, 'rb') as src, open(path + COMPACT_SUFFIX, 'wb') as dst:
+        for offset, nbytes in sorted(live.items()):
+            if (offset + nbytes > size):
+                raise ValueError(f'region {offset}+{nbytes} is outside of the spool')
+            moves[offset] = dst.tell()
+            src.seek(offset)
+            remaining = nbytes
+            while (remaining > 0):
+                data = src.read(min(copy_bytes, remaining))
+                dst.write(data)
+                remaining -= len(data)
+    logger.info(f'Spool compacted: {size} -> {live_bytes} bytes, {len(moves)} regions kept')
+    return moves
+
+def install_compacted(path: str):
+    ''' replace the spool file by the one written by compact_spool '''
+    os.replace(path + COMPACT_SUFFIX, path)
@@ -0,0 +1,221 @@
+
+"""
+
+Adaptive Scheduler
+
+runs segment jobs with a concurrency limit that follows the TTS endpoint:
+AIMD (additive increase, multiplicative decrease) on observed latency and errors.
+
+- pending jobs are a heap ordered by segment index, the earliest segment goes first
+- a failed job is retried with capped, jittered exponential backoff
+- a job that fails max_retries times is recorded in failures instead of dropped
+
+"""
+
+from typing import (
+    Awaitable,
+    Callable,
+    List,
+    Optional,
+)
+
+import asyncio
+import heapq
+import itertools
+import random
+import logging
+
+from .. import metrics
+
+logger = logging.getLogger(__name__)
+
+_QUEUE_DEPTH = metrics.gauge('segment_queue_depth', 'segments waiting for a worker, including retries')
+_IN_FLIGHT = metrics.gauge('segment_in_flight', 'segments being rendered')
+_CONCURRENCY = metrics.gauge('segment_concurrency_limit', 'current AIMD concurrency limit')
+_RETRIES = metrics.counter('segment_retries_total', 'segment jobs retried after an error')
+_FAILURES = metrics.counter('segment_failures_total', 'segment jobs that failed permanently')
+_JOB_SECONDS = metrics.histogram('segment_job_seconds', 'one attempt of a segment job, queueing excluded')
+
+
+class SegmentFailure():
+
+    def __init__(self, index: int, description: str, attempts: int, error: str):
+        self.index = index
+        self.description = description
+        self.attempts = attempts
+        self.error = error
+
+    def to_dict(self) -> dict:
+        return {
+            'index': self.index,
+            'description': self.description,
+            'attempts': self.attempts,
+            'error': self.error,
+        }
+
+    def __str__(self) -> str:
+        return repr(self)
+
+    def __repr__(self) -> str:
+        return f'SegmentFailure(index={self.index}, attempts={self.attempts}, error={repr(self.error)})'
+
+
+class AdaptiveScheduler():
+
+    def __init__(self, *, initial_concurrency: int=5, min_concurrency: int=1, max_concurrency: int=32,
+                 max_retries: int=4, backoff_base: float=1.0, backoff_max: float=30.0,
+                 latency_tolerance: float=3.0, max_queued: int=100,
+                 on_failure: Optional[Callable[['SegmentFailure'], None]]=None):
+        '''
+        latency_tolerance: a job slower than latency_tolerance x the best recent latency (per unit cost)
+            counts as congestion and halves the concurrency
+        max_queued: submit() blocks while this many jobs are waiting
+        on_failure: called as soon as a job failed permanently
+        '''
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.latency_tolerance = latency_tolerance
+        self.max_queued = max_queued
+        self.on_failure = on_failure
+
+        self.concurrency = float(min(max(initial_concurrency, min_concurrency), max_concurrency))
+        self.peak_concurrency = self.concurrency
+        self.failures: List[SegmentFailure] = []
+        self.completed = 0
+        self.retries = 0
+        self.errors = 0
+        self.decreases = 0
+
+        self._heap = []
+        self._seq = itertools.count() # tie breaker, keeps heap entries comparable
+        self._cond = asyncio.Condition()
+        self._in_flight = 0
+        self._pending = 0 # submitted and not yet finished, including jobs waiting for a retry
+        self._closed = False
+        self._baseline: Optional[float] = None # best recent latency per unit cost
+        self._last_decrease = float('-inf')
+        self._tasks = set()
+        self._dispatcher: Optional[asyncio.Task] = None
+
+    @property
+    def limit(self) -> int:
+        return max(self.min_concurrency, int(self.concurrency))
+
+    def start(self):
+        if (self._dispatcher is None):
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def submit(self, index: int, job: Callable[[], Awaitable[None]], *, cost: float=1.0, description: str=''):
+        ''' queue job for segment index. cost (e.g. text length) normalizes its latency '''
+        self.start()
+        async with self._cond:
+            await self._cond.wait_for(lambda: len(self._heap) < self.max_queued)
+            heapq.heappush(self._heap, (index, next(self._seq), 0, job, cost, description))
+            self._pending += 1
+            _QUEUE_DEPTH.set(len(self._heap))
+            self._cond.notify_all()
+
+    async def join(self):
+        ''' no more submissions, wait til every job succeeded or permanently failed '''
+        self.start()
+        async with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        await self._dispatcher
+
+    async def _dispatch(self):
+        while (True):
+            async with self._cond:
+                await self._cond.wait_for(
+                    lambda: (len(self._heap) > 0 and self._in_flight < self.limit) or (self._closed and self._pending == 0))
+                if (len(self._heap) == 0):
+                    return
+                item = heapq.heappop(self._heap)
+                self._in_flight += 1
+                _QUEUE_DEPTH.set(len(self._heap))
+                _IN_FLIGHT.set(self._in_flight)
+                self._cond.notify_all() # submitters waiting for space
+            task = asyncio.create_task(self._run(*item))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, index, seq, attempt, job, cost, description):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        error = None
+        try:
+            await job()
+        except Exception as e:
+            logger.debug(f'segment {index} failed (attempt {attempt + 1}): {e!r}')
+            error = e
+        elapsed = loop.time() - started
+        latency = elapsed / max(cost, 1.0)
+        _JOB_SECONDS.observe(elapsed, result='ok' if error is None else 'error')
+
+        async with self._cond:
+            self._in_flight -= 1
+            _IN_FLIGHT.set(self._in_flight)
+            if (error is None):
+                self.completed += 1
+                self._pending -= 1
+                self._on_success(latency, started)
+            else:
+                self.errors += 1
+                self._decrease(started)
+                if (attempt >= self.max_retries):
+                    logger.warning(f'segment {index} failed permanently after {attempt + 1} attempts: {error!r}')
+                    failure = SegmentFailure(index, description, attempt + 1, repr(error))
+                    self.failures.append(failure)
+                    self._pending -= 1
+                    _FAILURES.inc()
+                    if (self.on_failure is not None):
+                        self.on_failure(failure)
+            self._cond.notify_all()
+
+        if (error is not None and attempt < self.max_retries):
+            # full jitter: spread retries so they don't hit the endpoint together
+            await asyncio.sleep(random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt)))
+            self.retries += 1
+            _RETRIES.inc()
+            async with self._cond:
+                heapq.heappush(self._heap, (index, seq, attempt + 1, job, cost, description))
+                _QUEUE_DEPTH.set(len(self._heap))
+                self._cond.notify_all()
+
+    def _on_success(self, latency: float, started: float):
+        if (self._baseline is None):
+            self._baseline = latency
+        # decaying minimum, slowly forgets a lucky fast sample
+        self._baseline = min(latency, self._baseline * 1.01)
+        if (latency > self._baseline * self.latency_tolerance):
+            self._decrease(started)
+        else:
+            # +1 per "round trip" worth of completions
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+            self.peak_concurrency = max(self.peak_concurrency, self.concurrency)
+        _CONCURRENCY.set(self.concurrency)
+
+    def _decrease(self, started: float):
+        # react once per window: jobs started before the last decrease reflect the old concurrency
+        if (started <= self._last_decrease):
+            return
+        self._last_decrease = asyncio.get_running_loop().time()
+        self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+        self.decreases += 1
+        _CONCURRENCY.set(self.concurrency)
+        logger.debug(f'concurrency decreased to {self.concurrency:.1f}')
+
+    def report(self) -> dict:
+        return {
+            'completed': self.completed,
+            'failed': len(self.failures),
+            'errors': self.errors,
+            'retries': self.retries,
+            'decreases': self.decreases,
+            'concurrency': self.concurrency,
+            'peak_concurrency': self.peak_concurrency,
+            'failures': [f.to_dict() for f in self.failures],
+        }
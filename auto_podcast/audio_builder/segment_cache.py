@@ -0,0 +1,338 @@
+
+"""
+
+Segment Cache
+
+persistent, content-addressed cache of trimmed TTS audio
+
+each entry is stored as one file named by the hash of
+(text, voice, rate, volume, backend version), so an unchanged segment
+is never synthesized twice, neither within a run nor across runs.
+file mtime is used as the LRU clock, the cache is trimmed to max_bytes.
+word timings of an entry are kept in a sidecar file next to it.
+
+KVSegmentCache keeps the same entries in the kv_cache backend (one SQLite file) instead.
+
+"""
+
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Optional,
+)
+
+import asyncio
+import collections
+import hashlib
+import json
+import os
+import shutil
+import logging
+
+from .. import metrics
+from .. import kv_cache
+from ..kv_cache import CacheBackend
+
+from .segments import (
+    TextSegment,
+    WhiteSpace,
+)
+
+logger = logging.getLogger(__name__)
+
+_REQUESTS = metrics.counter('cache_requests_total', 'cache lookups by result: hit, miss, dedup (shared in-flight build)')
+_EVICTIONS = metrics.counter('cache_evictions_total', 'entries evicted to stay under the size cap')
+
+
+# bump this when the stored audio changes (e.g. trimming parameters)
+CACHE_FORMAT_VERSION = 3
+# optional file stored next to an entry (word timings), evicted with it
+SIDECAR_EXT = '.words.json'
+# subdirectory of cache_dir where KVSegmentCache writes the entries it hands out
+SCRATCH_DIR = 'kv_scratch'
+
+
+def segment_key(segment: TextSegment, backend_version: str, processing: str='') -> str:
+    ''' stable content hash of a text segment. processing describes post-processing (e.g. normalization) '''
+    identifier = json.dumps(
+        [CACHE_FORMAT_VERSION, backend_version, processing, segment.text, segment.voice, segment.rate, segment.volume],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(identifier.encode('utf-8')).hexdigest()
+
+
+def whitespace_key(segment: WhiteSpace) -> str:
+    return hashlib.sha256(f'whitespace:{segment.time!r}'.encode('utf-8')).hexdigest()
+
+
+class CacheStats():
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.dedups = 0 # identical segments within the same run
+        self.evictions = 0
+
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses + self.dedups
+        if (total == 0):
+            return 0.0
+        return (self.hits + self.dedups) / total
+
+    def to_dict(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'dedups': self.dedups,
+            'evictions': self.evictions,
+            'hit_ratio': self.hit_ratio(),
+        }
+
+    def __str__(self) -> str:
+        return repr(self)
+
+    def __repr__(self) -> str:
+        return f'CacheStats(hits={self.hits}, misses={self.misses}, dedups={self.dedups}, evictions={self.evictions})'
+
+
+class SegmentCache():
+
+    def __init__(self, cache_dir: str='cache/tts_segments', *, max_bytes: int=2 * 1024 ** 3, ext: str='.wav'):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ext = ext
+        self.stats = CacheStats()
+        self.name = os.path.basename(os.path.normpath(cache_dir)) # metrics label
+        # key -> size, ordered from least to most recently used
+        self._entries: 'collections.OrderedDict[str, int]' = collections.OrderedDict()
+        self._total_bytes = 0
+        self._inflight: Dict[str, asyncio.Future] = {}
+        os.makedirs(cache_dir, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        ''' rebuild LRU order from the files on disk '''
+        found = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if (entry.is_file() and entry.name.endswith(self.ext)):
+                    st = entry.stat()
+                    found.append((st.st_mtime, entry.name[:-len(self.ext)], st.st_size))
+        found.sort()
+        for _, key, size in found:
+            self._entries[key] = size
+            self._total_bytes += size
+        logger.debug(f'Segment cache {self.cache_dir}: {len(self._entries)} entries, {self._total_bytes} bytes')
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + self.ext)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def lookup(self, key: str) -> Optional[str]:
+        ''' path of the cached entry (marked as recently used), None on miss '''
+        if (key not in self._entries):
+            return None
+        path = self._path(key)
+        try:
+            os.utime(path) # touch for LRU
+        except FileNotFoundError:
+            # removed behind our back
+            self._total_bytes -= self._entries.pop(key)
+            return None
+        self._entries.move_to_end(key)
+        return path
+
+    def try_get(self, key: str) -> Optional[str]:
+        ''' lookup() that counts towards the hit stats '''
+        path = self.lookup(key)
+        if (path is not None):
+            self.stats.hits += 1
+            _REQUESTS.inc(cache=self.name, result='hit')
+        return path
+
+    def get(self, key: str, output_file: str) -> bool:
+        ''' copy cached audio to output_file. returns False on miss '''
+        path = self.lookup(key)
+        if (path is None):
+            return False
+        shutil.copyfile(path, output_file)
+        if (os.path.isfile(path + SIDECAR_EXT)):
+            shutil.copyfile(path + SIDECAR_EXT, output_file + SIDECAR_EXT)
+        return True
+
+    def put(self, key: str, source_file: str):
+        ''' store a copy of source_file under key '''
+        tmp_path = self._tmp_path(key)
+        shutil.copyfile(source_file, tmp_path)
+        if (os.path.isfile(source_file + SIDECAR_EXT)):
+            shutil.copyfile(source_file + SIDECAR_EXT, tmp_path + SIDECAR_EXT)
+        self._commit(key, tmp_path)
+
+    def _tmp_path(self, key: str) -> str:
+        # does not end with ext, ignored by _scan
+        return f'{self._path(key)}.{os.getpid()}.tmp'
+
+    def _commit(self, key: str, tmp_path: str):
+        path = self._path(key)
+        if (os.path.isfile(tmp_path + SIDECAR_EXT)):
+            # sidecar first, the entry only becomes visible with its audio
+            os.replace(tmp_path + SIDECAR_EXT, path + SIDECAR_EXT)
+        os.replace(tmp_path, path) # atomic, never leaves a truncated entry
+        size = os.path.getsize(path)
+        if (key in self._entries):
+            self._total_bytes -= self._entries.pop(key)
+        self._entries[key] = size
+        self._total_bytes += size
+        self._evict()
+
+    def _evict(self):
+        # the newest entry is kept even if it alone exceeds max_bytes, the caller is about to read it
+        while (self._total_bytes > self.max_bytes and len(self._entries) > 1):
+            key, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            self.stats.evictions += 1
+            _EVICTIONS.inc(cache=self.name)
+            for path in (self._path(key), self._path(key) + SIDECAR_EXT):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            logger.debug(f'Evicted cached segment {key}')
+
+    async def fetch(self, key: str, build: Callable[[str], Awaitable[Any]]) -> str:
+        ''' path of the cached audio of key, calling build(path) to create it only on a miss.
+        concurrent fetches of the same key share one build.
+        the path stays valid until the next entry is stored '''
+        path = self.try_get(key)
+        if (path is not None):
+            return path
+
+        while (key in self._inflight):
+            ok = await asyncio.shield(self._inflight[key])
+            path = self.lookup(key)
+            if (ok and path is not None):
+                self.stats.dedups += 1
+                _REQUESTS.inc(cache=self.name, result='dedup')
+                return path
+            # the other build failed or got evicted, do it ourselves
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        ok = False
+        tmp_path = self._tmp_path(key)
+        try:
+            self.stats.misses += 1
+            _REQUESTS.inc(cache=self.name, result='miss')
+            await build(tmp_path)
+            self._commit(key, tmp_path)
+            ok = True
+        finally:
+            del self._inflight[key]
+            future.set_result(ok)
+            if (not ok):
+                for path in (tmp_path, tmp_path + SIDECAR_EXT):
+                    if (os.path.exists(path)):
+                        os.remove(path)
+        return self._path(key)
+
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    def report(self) -> dict:
+        return {
+            **self.stats.to_dict(),
+            'entries': len(self._entries),
+            'total_bytes': self._total_bytes,
+            'max_bytes': self.max_bytes,
+        }
+
+
+class KVSegmentCache(SegmentCache):
+    '''
+    SegmentCache whose entries live in a kv_cache backend (the shared cache.sqlite by default)
+    instead of one file per entry. the backend owns eviction and the size cap.
+
+    callers still get file paths: an entry is written to the scratch directory (cache_dir/kv_scratch)
+    when it is looked up, at most scratch_entries of those are kept (the path stays valid until the
+    next lookups). cache_dir itself may hold the entries of a SegmentCache, they are left alone
+    '''
+
+    def __init__(self, cache_dir: str='cache/tts_segments', *, backend: Optional[CacheBackend]=None,
+                 namespace: str='audio:tts_segments', ext: str='.wav', scratch_entries: int=64):
+        self.backend = backend or kv_cache.default_cache()
+        self.namespace = namespace
+        self.scratch_entries = scratch_entries
+        # max_bytes only bounds the scratch files here
+        super().__init__(os.path.join(cache_dir, SCRATCH_DIR), max_bytes=0, ext=ext)
+        self.name = namespace.split(':')[-1]
+
+    def _scan(self):
+        # scratch files of an earlier run may be stale, the backend is the source of truth.
+        # the scratch directory only ever holds files written by lookup()
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if (entry.is_file() and (entry.name.endswith(self.ext) or entry.name.endswith(SIDECAR_EXT))):
+                    os.remove(entry.path)
+
+    def __contains__(self, key: str) -> bool:
+        return self.backend.contains(self.namespace, key)
+
+    def __len__(self) -> int:
+        return sum(1 for key in self.backend.keys(self.namespace) if not key.endswith(SIDECAR_EXT))
+
+    def lookup(self, key: str) -> Optional[str]:
+        if (key in self._entries and os.path.isfile(self._path(key))):
+            self._entries.move_to_end(key)
+            return self._path(key)
+        value = self.backend.get(self.namespace, key)
+        if (value is None):
+            return None
+        path = self._path(key)
+        with open(path, 'wb') as f:
+            f.write(value)
+        words = self.backend.get(self.namespace, key + SIDECAR_EXT)
+        if (words is not None):
+            with open(path + SIDECAR_EXT, 'wb') as f:
+                f.write(words)
+        self._add_scratch(key, len(value))
+        return path
+
+    def _commit(self, key: str, tmp_path: str):
+        with open(tmp_path, 'rb') as f:
+            self.backend.put(self.namespace, key, f.read())
+        if (os.path.isfile(tmp_path + SIDECAR_EXT)):
+            with open(tmp_path + SIDECAR_EXT, 'rb') as f:
+                self.backend.put(self.namespace, key + SIDECAR_EXT, f.read())
+            os.replace(tmp_path + SIDECAR_EXT, self._path(key) + SIDECAR_EXT)
+        # the freshly built file doubles as the scratch copy
+        os.replace(tmp_path, self._path(key))
+        self._add_scratch(key, os.path.getsize(self._path(key)))
+
+    def _add_scratch(self, key: str, size: int):
+        if (key in self._entries):
+            self._total_bytes -= self._entries.pop(key)
+        self._entries[key] = size
+        self._total_bytes += size
+        while (len(self._entries) > self.scratch_entries):
+            old, old_size = self._entries.popitem(last=False)
+            self._total_bytes -= old_size
+            for path in (self._path(old), self._path(old) + SIDECAR_EXT):
+                if (os.path.exists(path)):
+                    os.remove(path)
+
+    def _evict(self):
+        pass # the backend evicts
+
+    def report(self) -> dict:
+        return {
+            **self.stats.to_dict(),
+            'backend': self.backend.report(),
+            'scratch_entries': len(self._entries),
+        }
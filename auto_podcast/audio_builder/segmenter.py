@@ -0,0 +1,179 @@
+
+"""
+
+Segmenter
+
+repacks the segments of a provider into chunks that suit the TTS service, between the
+provider and build_audio:
+
+    build_audio(gen(), segmenter=Segmenter(max_chars=400))
+
+- consecutive TextSegments of the same voice, rate and volume are joined (hard wrapped
+  lines are glued back, without a space between CJK characters) and cut at sentence
+  ends (see sentences.py), sentences are packed up to max_chars per segment
+- a sentence longer than max_chars is cut at clause punctuation, else at spaces, else hard
+- a WhiteSpace (paragraph pause) ends the current chunk and is kept, consecutive pauses
+  become one pause of the longest time
+- a sentence still open at the end of a segment waits for the next one, so a sentence
+  running over a line break stays in one request
+
+"""
+
+from typing import (
+    AsyncGenerator,
+    AsyncIterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+import re
+import logging
+
+from .. import metrics
+from .segments import (
+    TextSegment,
+    WhiteSpace,
+)
+from .sentences import split_sentences
+
+logger = logging.getLogger(__name__)
+
+_SEGMENTER = metrics.counter('segmenter_segments_total', 'text segments into (in) and out of (out) the segmenter')
+
+_CJK = re.compile(r'[　-〿぀-ヿ㐀-鿿豈-﫿＀-￯]')
+# places to cut an overlong sentence, best first
+_CLAUSE_END = re.compile(r'''[，、；：,;:—–][”’"'）)\]」』]*\s*''')
+_SPACE = re.compile(r'\s+')
+
+Segment = Union[TextSegment, WhiteSpace]
+
+
+def join_text(left: str, right: str) -> str:
+    ''' text of two consecutive lines, as one '''
+    if (left == '' or right == ''):
+        return left + right
+    if (_CJK.match(left[-1]) and _CJK.match(right[0])):
+        return left + right
+    if (len(left) >= 2 and left.endswith('-') and left[-2].isalpha() and right[0].islower()):
+        # hyphenation
+        return left[:-1] + right
+    return left + ' ' + right
+
+def _cut(text: str, max_chars: int, pattern: re.Pattern) -> Optional[int]:
+    ''' end of the last match of pattern within the first max_chars characters of text '''
+    best = None
+    for m in pattern.finditer(text, 0, max_chars + 1):
+        if (0 < m.end() <= max_chars):
+            best = m.end()
+    return best
+
+def split_long(sentence: str, max_chars: int) -> List[str]:
+    ''' pieces of at most max_chars characters '''
+    pieces = []
+    while (len(sentence) > max_chars):
+        end = _cut(sentence, max_chars, _CLAUSE_END) or _cut(sentence, max_chars, _SPACE) or max_chars
+        pieces.append(sentence[:end].strip())
+        sentence = sentence[end:].strip()
+    if (sentence != ''):
+        pieces.append(sentence)
+    return pieces
+
+def pack(sentences: List[str], max_chars: int) -> List[str]:
+    ''' sentences joined greedily into chunks of at most max_chars characters '''
+    chunks: List[str] = []
+    current = ''
+    for sentence in sentences:
+        for piece in split_long(sentence, max_chars):
+            joined = join_text(current, piece)
+            if (current != '' and len(joined) > max_chars):
+                chunks.append(current)
+                current = piece
+            else:
+                current = joined
+    if (current != ''):
+        chunks.append(current)
+    return chunks
+
+
+class Segmenter():
+
+    def __init__(self, *, max_chars: int=400, max_pause: Optional[float]=None):
+        '''
+        max_chars: characters per TTS request, at most
+        max_pause: caps the merged paragraph pauses, None keeps the longest one
+        '''
+        if (max_chars <= 0):
+            raise ValueError(f'max_chars must be positive, got {max_chars}')
+        self.max_chars = max_chars
+        self.max_pause = max_pause
+
+    def _take(self, text: str, final: bool) -> Tuple[List[str], str]:
+        ''' chunks ready to be sent, text left for later '''
+        spans = split_sentences(text)
+        if (len(spans) == 0):
+            return [], ''
+        rest = ''
+        if (not final):
+            # the last sentence may continue in the next segment
+            start = spans[-1][0]
+            spans = spans[:-1]
+            rest = text[start:]
+        chunks = pack([text[s:e] for s, e in spans], self.max_chars)
+        if (not final and len(chunks) > 0):
+            # the last chunk may still take more sentences
+            rest = join_text(chunks.pop(), rest)
+        if (len(rest) > self.max_chars and len(split_sentences(rest)) == 1):
+            # no sentence end for a long time, don't wait for one
+            pieces = split_long(rest, self.max_chars)
+            chunks += pieces[:-1]
+            rest = pieces[-1]
+        return chunks, rest
+
+    async def segment(self, gen: AsyncIterator[Segment]) -> AsyncGenerator[Segment, None]:
+        pending = '' # text not sent yet
+        style: Optional[Tuple[str, float, float]] = None # voice, rate, volume of pending
+        pause: Optional[float] = None # merged WhiteSpace not sent yet
+
+        def emit(chunks):
+            for chunk in chunks:
+                _SEGMENTER.inc(kind='out')
+                yield TextSegment(chunk, style[0], rate=style[1], volume=style[2])
+
+        async for segment in gen:
+            if (isinstance(segment, WhiteSpace)):
+                if (pending != ''):
+                    for out in emit(self._take(pending, final=True)[0]):
+                        yield out
+                    pending = ''
+                pause = segment.time if pause is None else max(pause, segment.time)
+                continue
+            if (not isinstance(segment, TextSegment)):
+                raise TypeError(f'unexpected segment {segment!r}')
+            _SEGMENTER.inc(kind='in')
+            key = (segment.voice, segment.rate, segment.volume)
+            if (pending != '' and key != style):
+                for out in emit(self._take(pending, final=True)[0]):
+                    yield out
+                pending = ''
+            if (pause is not None):
+                yield WhiteSpace(pause if self.max_pause is None else min(pause, self.max_pause))
+                pause = None
+            style = key
+            pending = join_text(pending, segment.text.strip())
+            chunks, pending = self._take(pending, final=False)
+            for out in emit(chunks):
+                yield out
+        if (pending != ''):
+            for out in emit(self._take(pending, final=True)[0]):
+                yield out
+        if (pause is not None):
+            yield WhiteSpace(pause if self.max_pause is None else min(pause, self.max_pause))
+
+    __call__ = segment
+
+
+def segment(gen: AsyncIterator[Segment], **kwargs) -> AsyncGenerator[Segment, None]:
+    ''' Segmenter(**kwargs).segment(gen) '''
+    return Segmenter(**kwargs).segment(gen)
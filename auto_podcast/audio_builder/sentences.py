@@ -0,0 +1,32 @@
+
+import re
+
+from typing import List, Tuple
+
+# sentence ending punctuation, CJK full width forms end a sentence without a following space
+_SENTENCE_END = re.compile(
+    r'''(?:[。！？!?]+|\.{3}|…+)[”’"'）)\]」』]*'''
+    # latin full stop followed by a space, not after initials or common abbreviations
+    r'''|(?<![A-Z])(?<!\b(?:Mr|Ms|Dr|St|Jr|Sr|vs))(?<!\bMrs)(?<!\bProf)\.[”’"')\]]*(?=\s|$)'''
+)
+
+
+def split_sentences(text: str) -> List[Tuple[int, int]]:
+    ''' [start, end) character spans of the sentences in text, whitespace between them excluded '''
+    spans = []
+    start = 0
+    for m in _SENTENCE_END.finditer(text):
+        end = m.end()
+        if (text[start:end].strip() != ''):
+            spans.append(_strip_span(text, start, end))
+        start = end
+    if (text[start:].strip() != ''):
+        spans.append(_strip_span(text, start, len(text)))
+    return spans
+
+def _strip_span(text: str, start: int, end: int) -> Tuple[int, int]:
+    while (start < end and text[start].isspace()):
+        start += 1
+    while (end > start and text[end - 1].isspace()):
+        end -= 1
+    return start, end
@@ -0,0 +1,189 @@
+
+"""
+
+Splice
+
+incremental output: out.mp3 is a sequence of independently encoded chunks of
+segments, temp/out_index.json remembers each chunk's segment hashes and byte range.
+
+chunk boundaries are content defined (a pause after a text segment whose hash
+hits a modulus, like rsync / CDC), so an edit only changes the boundaries next
+to it. a rebuild copies every chunk that already exists in the previous output
+byte for byte and only encodes chunks that contain changed segments.
+
+the chunks are bare mp3 frames without a gapless header, so a player plays all of
+every chunk: the encoder delay before its audio and the padding of its last frame.
+the index keeps each chunk's decoded sample count, segment_starts places the segments
+on that timeline (for the timing index).
+
+"""
+
+from typing import (
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+import hashlib
+import json
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# samples of silence before the first PCM sample of an mp3 decoded without a gapless header:
+# libmp3lame's encoder delay plus the decoder's delay
+MP3_ENCODER_DELAY = 576
+MP3_DECODER_DELAY = 529
+
+# layer III bitrates (kbit/s) by bitrate index, MPEG-1 and MPEG-2 / 2.5
+_BITRATES = {
+    1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+# sample rates by version bits (0: MPEG-2.5, 2: MPEG-2, 3: MPEG-1) and sample rate index
+_SAMPLE_RATES = {
+    0: (11025, 12000, 8000),
+    2: (22050, 24000, 16000),
+    3: (44100, 48000, 32000),
+}
+
+
+def _frame_header(data: bytes, pos: int) -> Optional[Tuple[int, int]]:
+    ''' (frame length in bytes, samples per frame) of the layer III frame header at pos, None if there is none '''
+    if (pos + 4 > len(data) or data[pos] != 0xFF or (data[pos + 1] & 0xE0) != 0xE0):
+        return None
+    version = (data[pos + 1] >> 3) & 0x3
+    layer = (data[pos + 1] >> 1) & 0x3
+    bitrate_index = data[pos + 2] >> 4
+    rate_index = (data[pos + 2] >> 2) & 0x3
+    padding = (data[pos + 2] >> 1) & 0x1
+    if (version == 1 or layer != 1 or bitrate_index in (0, 15) or rate_index == 3):
+        return None
+    bitrate = _BITRATES[1 if version == 3 else 2][bitrate_index] * 1000
+    sample_rate = _SAMPLE_RATES[version][rate_index]
+    if (version == 3):
+        return 144 * bitrate // sample_rate + padding, 1152
+    return 72 * bitrate // sample_rate + padding, 576
+
+def mp3_samples(data: bytes) -> int:
+    ''' samples a decoder outputs for bare layer III frames (padding and delays included) '''
+    samples = 0
+    pos = 0
+    while (pos < len(data)):
+        header = _frame_header(data, pos)
+        if (header is None):
+            pos += 1 # not a frame, resync
+            continue
+        length, frame_samples = header
+        samples += frame_samples
+        pos += length
+    return samples
+
+
+def plan_chunks(hashes: Sequence[str], is_pause: Sequence[bool], *,
+                target_segments: int=32, min_segments: int=8, max_segments: int=256) -> List[Tuple[int, int]]:
+    '''
+    split segments into [start, end) chunks.
+    a chunk ends after a pause that follows a text segment whose hash % target_segments == 0,
+    so boundaries depend on the content around them, not on absolute positions.
+    ending on a pause also hides the encoder padding between chunks.
+    '''
+    chunks = []
+    start = 0
+    last_text_hash = None
+    for i, (h, pause) in enumerate(zip(hashes, is_pause)):
+        size = i + 1 - start
+        if (not pause):
+            last_text_hash = h
+        boundary = (
+            pause and last_text_hash is not None and size >= min_segments
+            and int(last_text_hash[:8], 16) % target_segments == 0
+        )
+        if (boundary or size >= max_segments):
+            chunks.append((start, i + 1))
+            start = i + 1
+    if (start < len(hashes)):
+        chunks.append((start, len(hashes)))
+    return chunks
+
+def chunk_hash(hashes: Sequence[str]) -> str:
+    return hashlib.sha256('\n'.join(hashes).encode('utf-8')).hexdigest()
+
+
+def load_output_index(index_file: str) -> Dict[str, dict]:
+    ''' chunk hash -> {"offset", "length", ...} of the previous output, empty if there is none '''
+    if (not os.path.isfile(index_file)):
+        return {}
+    try:
+        with open(index_file, 'r', encoding='utf-8') as f:
+            return {chunk['hash']: chunk for chunk in json.load(f)['chunks']}
+    except (json.JSONDecodeError, KeyError):
+        logger.warning(f'broken output index {index_file}, rebuilding everything')
+        return {}
+
+def splice_output(output_file: str, index_file: str, hashes: Sequence[str], chunks: Sequence[Tuple[int, int]],
+                  encode_chunk: Callable[[int, int], bytes], previous_file: Optional[str]=None,
+                  previous_index: Optional[Dict[str, dict]]=None) -> dict:
+    '''
+    write output_file chunk by chunk: bytes of previous_file for chunks listed in previous_index,
+    encode_chunk(start, end) for the others. returns stats
+    '''
+    previous_index = previous_index or {}
+    stats = {'chunks': len(chunks), 'reused_chunks': 0, 'encoded_chunks': 0, 'reused_bytes': 0, 'encoded_bytes': 0}
+    new_chunks = []
+    prev_f = open(previous_file, 'rb') if (previous_file is not None and os.path.isfile(previous_file)) else None
+    try:
+        with open(output_file, 'wb') as out_f:
+            for start, end in chunks:
+                h = chunk_hash(hashes[start:end])
+                old = previous_index.get(h) if prev_f is not None else None
+                if (old is not None):
+                    prev_f.seek(old['offset'])
+                    data = prev_f.read(old['length'])
+                    if (len(data) != old['length']):
+                        old = None # previous output is shorter than its index says
+                if (old is not None):
+                    stats['reused_chunks'] += 1
+                    stats['reused_bytes'] += len(data)
+                else:
+                    data = encode_chunk(start, end)
+                    stats['encoded_chunks'] += 1
+                    stats['encoded_bytes'] += len(data)
+                new_chunks.append({
+                    'hash': h, 'start': start, 'end': end, 'offset': out_f.tell(), 'length': len(data),
+                    'samples': mp3_samples(data),
+                })
+                out_f.write(data)
+    finally:
+        if (prev_f is not None):
+            prev_f.close()
+
+    tmp_path = index_file + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'chunks': new_chunks}, f)
+    os.replace(tmp_path, index_file)
+    logger.info(f'Spliced output: {stats}')
+    return stats
+
+def segment_starts(index_file: str, durations: Dict[int, float], frame_rate: int) -> Dict[int, float]:
+    '''
+    segment index -> start in seconds in the spliced output of index_file.
+    a chunk starts where the decoded samples of the chunks before it end, its first segment
+    after the encoder / decoder delay, the others after the durations of the ones before them
+    '''
+    with open(index_file, 'r', encoding='utf-8') as f:
+        chunks = json.load(f)['chunks']
+    starts = {}
+    chunk_start = 0
+    for chunk in chunks:
+        offset = (chunk_start + MP3_ENCODER_DELAY + MP3_DECODER_DELAY) / frame_rate
+        for i in range(chunk['start'], chunk['end']):
+            starts[i] = offset
+            offset += durations.get(i, 0.0)
+        chunk_start += chunk['samples']
+    return starts
@@ -0,0 +1,182 @@
+
+"""
+
+Timing Index
+
+start / end time of every segment, sentence and word of the merged output,
+stored in SQLite so seeking to a passage or showing a transcript is an
+indexed lookup instead of re-decoding the audio.
+
+word times come from edge-tts WordBoundary events. they are shifted by the
+silence trimmed at the start of the segment (stored next to the segment wav
+as <wav>.words.json, so cached segments keep them) and then by the segment's
+offset in the merged output.
+
+"""
+
+from typing import (
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+)
+
+import json
+import os
+import sqlite3
+import logging
+
+from .sentences import split_sentences
+from .segment_cache import SIDECAR_EXT
+
+logger = logging.getLogger(__name__)
+
+
+WORDS_EXT = SIDECAR_EXT
+TICKS_PER_SECOND = 10_000_000 # edge-tts offsets are in 100ns
+
+
+def words_file(wav_file: str) -> str:
+    return wav_file + WORDS_EXT
+
+def save_words(wav_file: str, words: List[dict]):
+    with open(words_file(wav_file), 'w', encoding='utf-8') as f:
+        json.dump(words, f, ensure_ascii=False)
+
+def load_words(wav_file: str) -> List[dict]:
+    ''' words of a segment wav, [] if there are none '''
+    path = words_file(wav_file)
+    if (not os.path.isfile(path)):
+        return []
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def boundaries_to_words(events: Iterable[dict], trim_start: float, duration: float) -> List[dict]:
+    ''' edge-tts boundary chunks -> [{"text", "start", "end"}] in seconds relative to the trimmed segment '''
+    words = []
+    for event in events:
+        start = event['offset'] / TICKS_PER_SECOND - trim_start
+        end = start + event['duration'] / TICKS_PER_SECOND
+        words.append({
+            'text': event['text'],
+            'start': round(min(max(start, 0.0), duration), 4),
+            'end': round(min(max(end, 0.0), duration), 4),
+        })
+    return words
+
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS segments (
+    id INTEGER PRIMARY KEY, -- segment index
+    text TEXT NOT NULL,
+    voice TEXT,
+    start REAL NOT NULL,
+    end REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sentences (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    segment_id INTEGER NOT NULL REFERENCES segments(id),
+    text TEXT NOT NULL,
+    start REAL NOT NULL,
+    end REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS words (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    segment_id INTEGER NOT NULL REFERENCES segments(id),
+    sentence_id INTEGER REFERENCES sentences(id),
+    text TEXT NOT NULL,
+    start REAL NOT NULL,
+    end REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS segments_start ON segments(start);
+CREATE INDEX IF NOT EXISTS sentences_start ON sentences(start);
+CREATE INDEX IF NOT EXISTS sentences_segment ON sentences(segment_id);
+CREATE INDEX IF NOT EXISTS words_start ON words(start);
+CREATE INDEX IF NOT EXISTS words_sentence ON words(sentence_id);
+'''
+
+
+class TimingIndex():
+
+    def __init__(self, db_file: str, *, overwrite: bool=False):
+        if (overwrite and os.path.isfile(db_file)):
+            os.remove(db_file)
+        self.db_file = db_file
+        self.conn = sqlite3.connect(db_file)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(_SCHEMA)
+
+    def add_segment(self, index: int, text: str, voice: Optional[str], offset: float, duration: float, words: List[dict]):
+        ''' words relative to the segment, offset: start of the segment in the merged output '''
+        self.conn.execute(
+            'INSERT OR REPLACE INTO segments (id, text, voice, start, end) VALUES (?, ?, ?, ?, ?)',
+            (index, text, voice, offset, offset + duration))
+
+        # locate every word in the text, in order, to know its sentence
+        positions = []
+        cursor = 0
+        for word in words:
+            pos = text.find(word['text'], cursor)
+            if (pos >= 0):
+                cursor = pos + len(word['text'])
+            positions.append(pos if pos >= 0 else None)
+
+        spans = split_sentences(text)
+        word_i = 0
+        for span_i, (span_start, span_end) in enumerate(spans):
+            is_last = span_i == len(spans) - 1
+            sentence_words = []
+            while (word_i < len(words) and (is_last or positions[word_i] is None or positions[word_i] < span_end)):
+                sentence_words.append(words[word_i])
+                word_i += 1
+            if (len(sentence_words) > 0):
+                start, end = sentence_words[0]['start'], sentence_words[-1]['end']
+            else:
+                # no timing from the TTS, interpolate by character position
+                start = duration * span_start / max(len(text), 1)
+                end = duration * span_end / max(len(text), 1)
+            cur = self.conn.execute(
+                'INSERT INTO sentences (segment_id, text, start, end) VALUES (?, ?, ?, ?)',
+                (index, text[span_start:span_end], offset + start, offset + end))
+            self.conn.executemany(
+                'INSERT INTO words (segment_id, sentence_id, text, start, end) VALUES (?, ?, ?, ?, ?)',
+                [(index, cur.lastrowid, w['text'], offset + w['start'], offset + w['end']) for w in sentence_words])
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def sentence_at(self, t: float) -> Optional[sqlite3.Row]:
+        ''' the sentence playing at t seconds '''
+        return self.conn.execute(
+            'SELECT * FROM sentences WHERE start <= ? ORDER BY start DESC LIMIT 1', (t,)).fetchone()
+
+    def find(self, text: str, limit: int=20) -> List[sqlite3.Row]:
+        ''' sentences containing text '''
+        return self.conn.execute(
+            'SELECT * FROM sentences WHERE text LIKE ? ORDER BY start LIMIT ?', (f'%{text}%', limit)).fetchall()
+
+    def sentences(self) -> Iterator[sqlite3.Row]:
+        return iter(self.conn.execute('SELECT * FROM sentences ORDER BY start'))
+
+
+def _timestamp(t: float, sep: str) -> str:
+    ms = int(round(t * 1000))
+    h, ms = divmod(ms, 3600_000)
+    m, ms = divmod(ms, 60_000)
+    s, ms = divmod(ms, 1000)
+    return f'{h:02d}:{m:02d}:{s:02d}{sep}{ms:03d}'
+
+def export_srt(index: TimingIndex, output_file: str):
+    with open(output_file, 'w', encoding='utf-8') as f:
+        for i, row in enumerate(index.sentences()):
+            f.write(f'{i + 1}\n{_timestamp(row["start"], ",")} --> {_timestamp(row["end"], ",")}\n{row["text"]}\n\n')
+
+def export_vtt(index: TimingIndex, output_file: str):
+    with open(output_file, 'w', encoding='utf-8') as f:
+        f.write('WEBVTT\n\n')
+        for row in index.sentences():
+            f.write(f'{_timestamp(row["start"], ".")} --> {_timestamp(row["end"], ".")}\n{row["text"]}\n\n')
@@ -0,0 +1,319 @@
+
+"""
+
+TTS Backends
+
+what build_audio renders text segments with. a backend writes the trimmed wav of a segment
+(and its word timings, see timing.py) and describes itself with capability flags:
+
+- supports_batch: synthesize_batch() renders many segments in one call, build_audio groups
+  the segments its workers request at about the same time (up to max_batch)
+- supports_streaming: audio arrives progressively while the request runs
+- supports_word_timings: word timings are written next to the wav
+- rate_range: the rates it can speak at, others are clamped to it (with a warning). None: any rate is
+  passed on, the service decides
+
+version goes into the segment cache keys, a new version renders everything again.
+
+- EdgeTTSBackend: edge-tts, over a pool of reused sessions (see tts_transport.py)
+- ToneBackend: local and deterministic formant-like tones, one per word, no network.
+  for load tests of scheduling, caching and merging without the remote service
+
+"""
+
+from typing import (
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+import asyncio
+import inspect
+import re
+import zlib
+import logging
+
+import numpy as np
+import edge_tts
+
+from .. import metrics
+from .. import profiling
+from . import audio_utils
+from . import offload
+from . import timing
+from .segments import TextSegment
+from .tts_transport import TTSSessionPool, unsupported_reason
+
+logger = logging.getLogger(__name__)
+
+BACKEND_VERSION = f'edge-tts-{getattr(edge_tts, "__version__", "unknown")}'
+# edge-tts >= 7 sends sentence boundaries unless asked for words, older versions always send words
+_COMMUNICATE_KWARGS = (
+    {'boundary': 'WordBoundary'} if 'boundary' in inspect.signature(edge_tts.Communicate).parameters else {})
+
+_TTS_SECONDS = metrics.histogram('tts_seconds', 'one edge-tts request, connect to last byte')
+_TTS_FIRST_BYTE = metrics.histogram('tts_first_byte_seconds', 'edge-tts request to its first audio chunk')
+_TTS_BYTES = metrics.counter('tts_audio_bytes_total', 'mp3 bytes received from edge-tts')
+_TTS_ERRORS = metrics.counter('tts_errors_total', 'edge-tts requests that raised')
+_POSTPROCESS_SECONDS = metrics.histogram(
+    'audio_postprocess_seconds', 'decode, trim and normalize one segment (offload pool, queueing included)')
+_BATCH_SIZE = metrics.histogram('tts_batch_size', 'segments per synthesize_batch call', buckets=(1, 2, 4, 8, 16, 32, 64))
+
+
+def float_to_percent(f: float):
+    ''' convert to edge-tts format
+
+    1.1 -> "+10%"
+
+    0.9 -> "-10%"
+    '''
+    assert f > 0
+    d = f - 1
+    if (d >= 0):
+        return f'+{round(d * 100)}%'
+    else:
+        return f'-{round(-d * 100)}%'
+
+
+async def build_audio_segment(temp_file: str, segment: TextSegment, *, normalize: Optional[str]=None,
+                              transport: Optional[TTSSessionPool]=None):
+    ''' generate one segment with edge-tts. remove whitespace, store as wav.
+    word timings are stored next to it, see timing.py
+
+    transport: pool of open edge-tts sessions (see tts_transport.py), None connects for this segment only '''
+    rate_str = float_to_percent(segment.rate)
+    volume_str = float_to_percent(segment.volume)
+    if (transport is not None):
+        stream = transport.synthesize(segment.text, segment.voice, rate=rate_str, volume=volume_str)
+    else:
+        stream = edge_tts.Communicate(
+            segment.text, segment.voice, rate=rate_str, volume=volume_str, **_COMMUNICATE_KWARGS).stream()
+    mp3_data = bytearray()
+    boundaries = []
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    try:
+        with profiling.stage('tts'):
+            async for chunk in stream:
+                if chunk["type"] == "audio":
+                    if (len(mp3_data) == 0):
+                        _TTS_FIRST_BYTE.observe(loop.time() - started)
+                    mp3_data += chunk["data"]
+                elif chunk["type"] in ("WordBoundary", "SentenceBoundary"):
+                    boundaries.append(chunk)
+    except Exception:
+        _TTS_ERRORS.inc()
+        raise
+    _TTS_SECONDS.observe(loop.time() - started)
+    _TTS_BYTES.inc(len(mp3_data))
+    # remove whitespace, nothing is encoded until the final merge.
+    # decoding runs in the offload pool, the event loop keeps serving the other streams
+    started = loop.time()
+    duration, trim_start = await offload.run_cpu(
+        audio_utils.process_tts_audio, bytes(mp3_data), temp_file, normalize=normalize)
+    _POSTPROCESS_SECONDS.observe(loop.time() - started)
+    if (len(boundaries) > 0):
+        timing.save_words(temp_file, timing.boundaries_to_words(boundaries, trim_start, duration))
+
+
+class TTSBackend():
+    ''' base of the backends, renders the segments of a batch one after the other '''
+
+    name = 'base'
+    supports_batch = False
+    supports_streaming = False
+    supports_word_timings = False
+    rate_range: Optional[Tuple[float, float]] = (0.5, 2.0)
+    max_batch = 1
+
+    @property
+    def version(self) -> str:
+        return self.name
+
+    def supports_rate(self, rate: float) -> bool:
+        return self.rate_range is None or self.rate_range[0] <= rate <= self.rate_range[1]
+
+    def clamp_rate(self, rate: float) -> float:
+        if (self.rate_range is None):
+            return rate
+        return min(max(rate, self.rate_range[0]), self.rate_range[1])
+
+    async def synthesize(self, temp_file: str, segment: TextSegment, *, normalize: Optional[str]=None):
+        ''' write the trimmed (and normalized) wav of segment to temp_file '''
+        raise NotImplementedError
+
+    async def synthesize_batch(self, items: Sequence[Tuple[str, TextSegment]], *,
+                               normalize: Optional[str]=None) -> List[Optional[BaseException]]:
+        ''' (temp_file, segment) -> None if it was written, else the error, in the order of items '''
+        results = []
+        for temp_file, segment in items:
+            try:
+                await self.synthesize(temp_file, segment, normalize=normalize)
+                results.append(None)
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def report(self) -> dict:
+        return {'backend': self.version}
+
+    async def close(self):
+        pass
+
+
+class EdgeTTSBackend(TTSBackend):
+
+    name = 'edge-tts'
+    supports_streaming = True
+    supports_word_timings = True
+    # every rate is sent as it is, like build_audio always did
+    rate_range = None
+
+    def __init__(self, *, pooled: bool=True, max_sessions: int=32):
+        ''' pooled=False opens a websocket per segment, as edge_tts.Communicate does.
+        so does an edge_tts the pool doesn't support (tts_transport.unsupported_reason) '''
+        if (pooled):
+            reason = unsupported_reason()
+            if (reason is not None):
+                logger.warning(f'pooled TTS sessions disabled ({reason}), using edge_tts.Communicate')
+                pooled = False
+        self.transport = TTSSessionPool(max_size=max_sessions) if pooled else None
+
+    @property
+    def version(self) -> str:
+        # the key of the segments cached before backends existed
+        return BACKEND_VERSION
+
+    async def synthesize(self, temp_file: str, segment: TextSegment, *, normalize: Optional[str]=None):
+        await build_audio_segment(temp_file, segment, normalize=normalize, transport=self.transport)
+
+    def report(self) -> dict:
+        report = super().report()
+        if (self.transport is not None):
+            report['sessions'] = self.transport.report()
+        return report
+
+    async def close(self):
+        if (self.transport is not None):
+            await self.transport.close()
+
+
+# formants (Hz) of a few vowels, a word gets one of them
+_VOWELS = ((730, 1090), (270, 2290), (300, 870), (530, 1840), (570, 840), (400, 2000))
+_CJK_CHAR = r'[　-〿぀-ヿ㐀-鿿豈-﫿＀-￯]'
+_WORD = re.compile(_CJK_CHAR + r'|[^\s' + _CJK_CHAR[1:-1] + r']+')
+TONE_VERSION = 1
+
+def _stable_hash(text: str) -> int:
+    # hash() is salted per process
+    return zlib.crc32(text.encode('utf-8'))
+
+def render_tone(text: str, voice: str, rate: float=1.0, volume: float=1.0, *,
+                frame_rate: int=audio_utils.DEFAULT_FRAME_RATE, seconds_per_char: float=0.06,
+                lead: float=0.1) -> Tuple[np.ndarray, List[dict]]:
+    '''
+    int16 mono samples of text, and edge-tts style boundary events (offsets in 100 ns ticks)
+
+    every word is a harmonic tone at the voice's pitch shaped by the formants of a vowel,
+    longer words last longer, pauses after words and longer ones after sentence ends.
+    lead seconds of silence before and after, like the TTS service
+    '''
+    f0 = 90.0 + _stable_hash(voice) % 160
+    harmonics = np.arange(1, int(4000 // f0) + 1, dtype=np.float64)[:, None] # (n_harmonics, 1)
+    pieces = [np.zeros(int(lead * frame_rate))]
+    position = pieces[0].shape[0]
+    events = []
+    for m in _WORD.finditer(text):
+        word = m.group()
+        seconds = max(0.08, len(word) * seconds_per_char) / rate
+        n = int(seconds * frame_rate)
+        formants = _VOWELS[_stable_hash(word) % len(_VOWELS)]
+        weights = sum(np.exp(-((harmonics * f0 - f) / 150.0) ** 2) for f in formants) # (n_harmonics, 1)
+        t = np.arange(n) / frame_rate
+        tone = (weights * np.sin(2 * np.pi * f0 * harmonics * t)).sum(axis=0)
+        tone /= max(1e-9, np.abs(tone).max())
+        ramp = min(n // 2, int(0.01 * frame_rate))
+        envelope = np.ones(n)
+        envelope[:ramp] = np.linspace(0, 1, ramp)
+        envelope[n - ramp:] = np.linspace(1, 0, ramp)
+        pieces.append(tone * envelope)
+        events.append({
+            'type': 'WordBoundary',
+            'offset': int(position / frame_rate * timing.TICKS_PER_SECOND),
+            'duration': int(n / frame_rate * timing.TICKS_PER_SECOND),
+            'text': word,
+        })
+        pause = 0.25 if re.search(r'[.!?。！？…]$', word) else 0.05
+        pieces.append(np.zeros(int(pause / rate * frame_rate)))
+        position += n + pieces[-1].shape[0]
+    pieces.append(np.zeros(int(lead * frame_rate)))
+    samples = np.concatenate(pieces) * 0.3 * volume * audio_utils.INT16_FULL_SCALE
+    samples = np.clip(np.rint(samples), -audio_utils.INT16_FULL_SCALE, audio_utils.INT16_FULL_SCALE - 1)
+    return samples.astype(np.int16)[:, None], events
+
+def _tone_to_wav(temp_file: str, text: str, voice: str, rate: float, volume: float,
+                 normalize: Optional[str]) -> List[dict]:
+    ''' runs in the offload pool, returns the word timings '''
+    samples, events = render_tone(text, voice, rate, volume)
+    frame_rate = audio_utils.DEFAULT_FRAME_RATE
+    trimmed, start = audio_utils.trim_pcm_bounds(samples, frame_rate, normalize=normalize)
+    audio_utils.save_wav(temp_file, trimmed, frame_rate)
+    return timing.boundaries_to_words(events, start / frame_rate, trimmed.shape[0] / frame_rate)
+
+def _tone_batch(items: List[Tuple[str, str, str, float, float]], normalize: Optional[str]) -> List[object]:
+    ''' one offload call for a whole batch: word timings, or the error, per item '''
+    results = []
+    for temp_file, text, voice, rate, volume in items:
+        try:
+            results.append(_tone_to_wav(temp_file, text, voice, rate, volume, normalize))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+class ToneBackend(TTSBackend):
+
+    name = 'tone'
+    supports_batch = True
+    supports_word_timings = True
+    rate_range = (0.25, 4.0)
+
+    def __init__(self, *, latency: float=0.0, max_batch: int=32):
+        ''' latency: seconds every call (a batch is one call) waits, to load test the scheduling '''
+        self.latency = latency
+        self.max_batch = max_batch
+        self.calls = 0
+        self.segments = 0
+
+    @property
+    def version(self) -> str:
+        return f'tone-{TONE_VERSION}'
+
+    async def synthesize(self, temp_file: str, segment: TextSegment, *, normalize: Optional[str]=None):
+        error = (await self.synthesize_batch([(temp_file, segment)], normalize=normalize))[0]
+        if (error is not None):
+            raise error
+
+    async def synthesize_batch(self, items: Sequence[Tuple[str, TextSegment]], *,
+                               normalize: Optional[str]=None) -> List[Optional[BaseException]]:
+        self.calls += 1
+        self.segments += len(items)
+        _BATCH_SIZE.observe(len(items))
+        if (self.latency > 0):
+            await asyncio.sleep(self.latency)
+        words = await offload.run_cpu(
+            _tone_batch,
+            [(temp_file, s.text, s.voice, self.clamp_rate(s.rate), s.volume) for temp_file, s in items],
+            normalize)
+        results = []
+        for (temp_file, _), result in zip(items, words):
+            if (isinstance(result, BaseException)):
+                results.append(result)
+                continue
+            timing.save_words(temp_file, result)
+            results.append(None)
+        return results
+
+    def report(self) -> dict:
+        return dict(super().report(), calls=self.calls, segments=self.segments)
@@ -0,0 +1,378 @@
+
+"""
+
+TTS Transport
+
+a pool of warm edge-tts websocket sessions, instead of one connection (and TLS handshake)
+per segment as edge_tts.Communicate does
+
+- a session sends speech.config once, then any number of ssml requests one after the other,
+  each one read up to its turn.end
+- idle sessions are kept for reuse; a session that is closed, errored, older than max_age
+  (the Sec-MS-GEC token of the connection expires), idle for longer than max_idle or has served
+  max_requests requests is closed instead of reused
+- a request failing on a reused session before any audio arrived (the server dropped the idle
+  connection) is repeated once on a new session
+- the chunks are the ones of edge_tts.Communicate.stream(): {"type": "audio", "data": ...} and
+  {"type": "WordBoundary" / "SentenceBoundary", "offset", "duration", "text"}
+
+the protocol details (url, headers, DRM token, ssml) come from edge_tts itself and are looked up
+on every connect, so benchmarks.fake_backends.FakeTTSServer.install() redirects the pool as well.
+they are module internals, not API: the pool is only used with the edge-tts versions in
+SUPPORTED_EDGE_TTS that have all of them (unsupported_reason), otherwise EdgeTTSBackend falls back
+to edge_tts.Communicate.
+
+"""
+
+from typing import (
+    Any,
+    AsyncIterator,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+
+import asyncio
+import contextlib
+import importlib.metadata
+import json
+import time
+import uuid
+import logging
+from xml.sax.saxutils import escape, unescape
+
+import aiohttp
+import edge_tts.communicate as edge_communicate
+
+from .. import metrics
+
+logger = logging.getLogger(__name__)
+
+_CONNECTIONS = metrics.counter('tts_connections_total', 'edge-tts websocket connections opened')
+_REUSED = metrics.counter('tts_session_reuses_total', 'edge-tts requests served by an already open session')
+_RECYCLED = metrics.counter('tts_sessions_recycled_total', 'pooled sessions closed, by reason')
+_CONNECT_SECONDS = metrics.histogram('tts_connect_seconds', 'edge-tts websocket connect, TLS handshake included')
+
+# edge-tts versions the wire protocol was checked against, [first, last)
+SUPPORTED_EDGE_TTS = ((7, 0), (7, 4))
+# module internals the transport uses
+_REQUIRED_INTERNALS = ('WSS_URL', 'WSS_HEADERS', 'DRM', 'SEC_MS_GEC_VERSION', '_SSL_CTX', 'TTSConfig',
+                       'remove_incompatible_characters', 'split_text_by_byte_length')
+_REQUIRED_DRM = ('generate_sec_ms_gec', 'headers_with_muid', 'handle_client_response_error')
+# bytes of escaped text per ssml request, edge_tts uses the same limit
+MAX_SSML_TEXT_BYTES = 4096
+# the service sends 48 kbit/s mp3, offsets are in 100 ns ticks
+_TICKS_PER_BYTE = 8 * 10_000_000 / 48_000
+
+
+class TransportError(Exception):
+    ''' the service answered something the transport can't use '''
+
+
+def _connect_id() -> str:
+    return uuid.uuid4().hex
+
+def _date() -> str:
+    return time.strftime('%a %b %d %Y %H:%M:%S GMT+0000 (Coordinated Universal Time)', time.gmtime())
+
+def _parse_headers(head: bytes) -> Dict[bytes, bytes]:
+    headers = {}
+    for line in head.split(b'\r\n'):
+        key, sep, value = line.partition(b':')
+        if (sep):
+            headers[key] = value
+    return headers
+
+def unsupported_reason() -> Optional[str]:
+    ''' why the installed edge_tts can't be used by the transport, None if it can '''
+    try:
+        installed = importlib.metadata.version('edge-tts')
+    except importlib.metadata.PackageNotFoundError:
+        return 'edge-tts version unknown'
+    release = tuple(int(part) for part in installed.split('.')[:2] if part.isdigit())
+    if (not (SUPPORTED_EDGE_TTS[0] <= release < SUPPORTED_EDGE_TTS[1])):
+        first, last = ('.'.join(map(str, v)) for v in SUPPORTED_EDGE_TTS)
+        return f'edge-tts {installed} is not in the supported range >={first},<{last}'
+    missing = [name for name in _REQUIRED_INTERNALS if not hasattr(edge_communicate, name)]
+    drm = getattr(edge_communicate, 'DRM', None)
+    missing += [f'DRM.{name}' for name in _REQUIRED_DRM if drm is not None and not hasattr(drm, name)]
+    if (missing):
+        return f'edge-tts {installed} lacks {", ".join(missing)}'
+    return None
+
+def _connect_params() -> Tuple[str, Dict[str, str], Any]:
+    ''' url, headers and ssl context of a new connection, as the installed edge_tts builds them '''
+    drm = edge_communicate.DRM
+    # time based token, valid for a few minutes
+    url = (f'{edge_communicate.WSS_URL}&ConnectionId={_connect_id()}'
+           f'&Sec-MS-GEC={drm.generate_sec_ms_gec()}'
+           f'&Sec-MS-GEC-Version={edge_communicate.SEC_MS_GEC_VERSION}')
+    headers = drm.headers_with_muid(dict(edge_communicate.WSS_HEADERS))
+    return url, headers, edge_communicate._SSL_CTX
+
+def split_text(text: str) -> List[str]:
+    ''' escaped pieces of text of at most MAX_SSML_TEXT_BYTES, like edge_tts.Communicate '''
+    clean = edge_communicate.remove_incompatible_characters(text)
+    return [piece.decode('utf-8') if isinstance(piece, bytes) else piece
+            for piece in edge_communicate.split_text_by_byte_length(escape(clean), MAX_SSML_TEXT_BYTES)]
+
+def make_ssml(text: str, voice: str, rate: str, volume: str, pitch: str) -> str:
+    ''' text: escaped '''
+    return (
+        "<speak version='1.0' xmlns='http://www.w3.org/2001/10/synthesis' xml:lang='en-US'>"
+        f"<voice name='{voice}'><prosody pitch='{pitch}' rate='{rate}' volume='{volume}'>"
+        f"{text}</prosody></voice></speak>"
+    )
+
+def _full_voice_name(voice: str) -> str:
+    ''' "en-US-EmmaNeural" -> the long form the service expects, validates the voice as well '''
+    return edge_communicate.TTSConfig(voice, '+0%', '+0%', '+0Hz', 'WordBoundary').voice
+
+
+class TTSSession():
+    ''' one websocket to the service, one request at a time '''
+
+    def __init__(self, *, boundary: str='WordBoundary', connect_timeout: float=10.0,
+                 receive_timeout: float=60.0, connector: Optional[aiohttp.BaseConnector]=None):
+        self.boundary = boundary
+        self.connect_timeout = connect_timeout
+        self.receive_timeout = receive_timeout
+        self.connector = connector
+        self.created = time.monotonic()
+        self.last_used = self.created
+        self.requests = 0
+        self.broken = False # a request ended abnormally, the socket state is unknown
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._ws: Optional[aiohttp.ClientWebSocketResponse] = None
+
+    async def connect(self):
+        started = time.monotonic()
+        self._session = aiohttp.ClientSession(
+            connector=self.connector, connector_owner=self.connector is None, trust_env=True,
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=self.connect_timeout))
+        try:
+            for attempt in range(2):
+                url, headers, ssl = _connect_params()
+                try:
+                    self._ws = await self._session.ws_connect(url, headers=headers, compress=15, ssl=ssl)
+                    break
+                except aiohttp.ClientResponseError as e:
+                    if (e.status != 403 or attempt > 0):
+                        raise
+                    # clock skew, the token is recomputed with the server's date
+                    edge_communicate.DRM.handle_client_response_error(e)
+            word = self.boundary == 'WordBoundary'
+            await self._ws.send_str(
+                f'X-Timestamp:{_date()}\r\n'
+                'Content-Type:application/json; charset=utf-8\r\n'
+                'Path:speech.config\r\n\r\n'
+                '{"context":{"synthesis":{"audio":{"metadataoptions":{'
+                f'"sentenceBoundaryEnabled":"{str(not word).lower()}","wordBoundaryEnabled":"{str(word).lower()}"'
+                '},"outputFormat":"audio-24khz-48kbitrate-mono-mp3"}}}}\r\n'
+            )
+        except BaseException:
+            await self.close()
+            raise
+        _CONNECTIONS.inc()
+        _CONNECT_SECONDS.observe(time.monotonic() - started)
+
+    @property
+    def closed(self) -> bool:
+        return self.broken or self._ws is None or self._ws.closed or self._ws.exception() is not None
+
+    async def close(self):
+        if (self._ws is not None):
+            await self._ws.close()
+        if (self._session is not None):
+            await self._session.close()
+        self._ws = None
+        self._session = None
+
+    async def _request(self, ssml: str) -> AsyncIterator[Dict[str, Any]]:
+        ''' raw chunks of one ssml request, offsets relative to its start '''
+        request_id = _connect_id()
+        await self._ws.send_str(
+            f'X-RequestId:{request_id}\r\n'
+            'Content-Type:application/ssml+xml\r\n'
+            f'X-Timestamp:{_date()}Z\r\n'
+            'Path:ssml\r\n\r\n'
+            f'{ssml}'
+        )
+        while (True):
+            message = await self._ws.receive(timeout=self.receive_timeout)
+            if (message.type == aiohttp.WSMsgType.TEXT):
+                data = message.data.encode('utf-8')
+                split = data.find(b'\r\n\r\n')
+                headers = _parse_headers(data[:split])
+                body = data[split + 4:]
+                if (headers.get(b'X-RequestId', request_id.encode()) != request_id.encode()):
+                    continue # late message of an earlier request
+                path = headers.get(b'Path')
+                if (path == b'turn.end'):
+                    return
+                if (path == b'audio.metadata'):
+                    for meta in json.loads(body)['Metadata']:
+                        if (meta['Type'] in ('WordBoundary', 'SentenceBoundary')):
+                            yield {
+                                'type': meta['Type'],
+                                'offset': meta['Data']['Offset'],
+                                'duration': meta['Data']['Duration'],
+                                'text': unescape(meta['Data']['text']['Text']),
+                            }
+                elif (path not in (b'response', b'turn.start')):
+                    raise TransportError(f'unknown path {path!r}')
+            elif (message.type == aiohttp.WSMsgType.BINARY):
+                if (len(message.data) < 2):
+                    raise TransportError('binary message without header length')
+                header_length = int.from_bytes(message.data[:2], 'big')
+                headers = _parse_headers(message.data[2:2 + header_length])
+                data = message.data[2 + header_length:]
+                if (headers.get(b'X-RequestId', request_id.encode()) != request_id.encode()):
+                    continue
+                if (headers.get(b'Path') != b'audio'):
+                    raise TransportError('binary message that is not audio')
+                if (len(data) > 0):
+                    yield {'type': 'audio', 'data': data}
+            elif (message.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSING, aiohttp.WSMsgType.CLOSED)):
+                raise TransportError(f'websocket closed during a request ({self._ws.close_code})')
+            elif (message.type == aiohttp.WSMsgType.ERROR):
+                raise TransportError(f'websocket error: {message.data}')
+
+    async def synthesize(self, text: str, voice: str, *, rate: str='+0%', volume: str='+0%',
+                         pitch: str='+0Hz') -> AsyncIterator[Dict[str, Any]]:
+        ''' chunks of text, like edge_tts.Communicate(text, voice, ...).stream() '''
+        self.requests += 1
+        ok = False
+        try:
+            audio_bytes = 0 # of the earlier pieces, shifts the offsets of the later ones
+            received = False
+            for piece in split_text(text):
+                piece_bytes = 0
+                async for chunk in self._request(make_ssml(piece, _full_voice_name(voice), rate, volume, pitch)):
+                    if (chunk['type'] == 'audio'):
+                        piece_bytes += len(chunk['data'])
+                        received = True
+                    else:
+                        chunk['offset'] += int(audio_bytes * _TICKS_PER_BYTE)
+                    yield chunk
+                audio_bytes += piece_bytes
+            if (not received):
+                raise TransportError('no audio received')
+            ok = True
+        finally:
+            # an abandoned or failed request leaves unread messages behind
+            self.broken = self.broken or not ok
+            self.last_used = time.monotonic()
+
+
+class TTSSessionPool():
+
+    def __init__(self, *, max_size: int=32, max_idle: float=30.0, max_age: float=240.0,
+                 max_requests: int=500, boundary: str='WordBoundary',
+                 connect_timeout: float=10.0, receive_timeout: float=60.0):
+        '''
+        max_size: open sessions at most, requests beyond it wait for a session
+        max_idle: seconds an unused session is kept
+        max_age: seconds after connecting a session is retired (the DRM token lasts 5 minutes)
+        max_requests: requests per session before it is retired
+        '''
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.max_age = max_age
+        self.max_requests = max_requests
+        self.boundary = boundary
+        self.connect_timeout = connect_timeout
+        self.receive_timeout = receive_timeout
+        self._idle: List[TTSSession] = [] # most recently used last
+        self._slots = asyncio.Semaphore(max_size)
+        self._closed = False
+        self.stats = {'connections': 0, 'requests': 0, 'reused': 0, 'recycled': 0, 'stale_retries': 0}
+
+    def _retire_reason(self, session: TTSSession) -> Optional[str]:
+        now = time.monotonic()
+        if (session.closed):
+            return 'closed'
+        if (now - session.created > self.max_age):
+            return 'age'
+        if (now - session.last_used > self.max_idle):
+            return 'idle'
+        if (session.requests >= self.max_requests):
+            return 'requests'
+        return None
+
+    async def _retire(self, session: TTSSession, reason: str):
+        self.stats['recycled'] += 1
+        _RECYCLED.inc(reason=reason)
+        logger.debug(f'TTS session retired ({reason}) after {session.requests} requests')
+        await session.close()
+
+    async def _get(self) -> Tuple[TTSSession, bool]:
+        ''' a healthy session and whether it was reused '''
+        while (len(self._idle) > 0):
+            session = self._idle.pop()
+            reason = self._retire_reason(session)
+            if (reason is None):
+                return session, True
+            await self._retire(session, reason)
+        session = TTSSession(boundary=self.boundary, connect_timeout=self.connect_timeout,
+                             receive_timeout=self.receive_timeout)
+        await session.connect()
+        self.stats['connections'] += 1
+        return session, False
+
+    async def _put(self, session: TTSSession):
+        reason = 'closed' if self._closed else self._retire_reason(session)
+        if (reason is None):
+            self._idle.append(session)
+        else:
+            await self._retire(session, reason)
+
+    @contextlib.asynccontextmanager
+    async def session(self):
+        ''' async with pool.session() as (session, reused): ... '''
+        if (self._closed):
+            raise RuntimeError('TTS session pool is closed')
+        async with self._slots:
+            session, reused = await self._get()
+            try:
+                yield session, reused
+            finally:
+                await asyncio.shield(self._put(session))
+
+    async def synthesize(self, text: str, voice: str, *, rate: str='+0%', volume: str='+0%',
+                         pitch: str='+0Hz') -> AsyncIterator[Dict[str, Any]]:
+        ''' chunks of text on a pooled session, like edge_tts.Communicate(text, voice, ...).stream() '''
+        self.stats['requests'] += 1
+        for attempt in range(2):
+            started = False
+            async with self.session() as (session, reused):
+                if (reused):
+                    self.stats['reused'] += 1
+                    _REUSED.inc()
+                try:
+                    async for chunk in session.synthesize(text, voice, rate=rate, volume=volume, pitch=pitch):
+                        started = True
+                        yield chunk
+                    return
+                except (TransportError, aiohttp.ClientError, ConnectionError) as e:
+                    if (not reused or started or attempt > 0):
+                        raise
+                    # the server dropped the idle connection, nothing was delivered yet
+                    logger.debug(f'stale TTS session ({e}), retrying on a new one')
+                    self.stats['stale_retries'] += 1
+
+    async def close(self):
+        self._closed = True
+        idle, self._idle = self._idle, []
+        for session in idle:
+            await session.close()
+
+    def report(self) -> dict:
+        return dict(self.stats, idle=len(self._idle))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
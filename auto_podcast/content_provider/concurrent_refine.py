@@ -0,0 +1,203 @@
+
+"""
+
+Concurrent Refine
+
+refined PDF pages without waiting for one LLM round trip after another (see pdf_refine.iterate_refined_pdf_pages)
+
+- the pages are cut into shards of consecutive pages, refined in parallel
+- a shard starts with `overlap` warm-up pages of the previous shard. they are formatted but not
+  emitted, only to get the carried-over text and context right; lines both shards produced
+  around the boundary are emitted once
+- within a shard, summarizing page N runs while page N+1 is formatted. page N+1 therefore gets the
+  description of page N-1 (one page older than in the serial mode)
+- all LLM calls share one semaphore; pages come out in order. shards further than `concurrency`
+  ahead of the consumer are not started, so the first pages are not starved by later ones
+
+"""
+
+from typing import (
+    Any,
+    AsyncGenerator,
+    AsyncIterable,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+)
+
+import asyncio
+import difflib
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+FormatPage = Callable[[str, Optional[str]], Awaitable[Dict[str, str]]]
+SummarizePage = Callable[[str], Awaitable[str]]
+
+_PAGE = 'page'
+_END = 'end'
+_ERROR = 'error'
+
+
+def _norm(line: str) -> str:
+    ''' comparable form of a line: the LLM may change spacing, punctuation and markdown around the same text '''
+    return re.sub(r'[\W_]+', '', line).lower()
+
+# normalized lines at least this long also match when the LLM reworded them slightly
+_FUZZY_CHARS = 20
+_FUZZY_RATIO = 0.85
+
+def _same_line(a: str, b: str) -> bool:
+    ''' a and b (normalized) are versions of the same line. short lines (headings, list items) must be equal '''
+    if (a == b):
+        return True
+    if (min(len(a), len(b)) < _FUZZY_CHARS):
+        return False
+    matcher = difflib.SequenceMatcher(None, a, b, autojunk=False)
+    return matcher.quick_ratio() >= _FUZZY_RATIO and matcher.ratio() >= _FUZZY_RATIO
+
+def _overlap(tail: List[str], head: List[str]) -> int:
+    ''' longest k such that the last k lines of tail are the first k lines of head '''
+    for k in range(min(len(tail), len(head)), 0, -1):
+        if (all(_same_line(a, b) for a, b in zip(tail[-k:], head[:k]))):
+            return k
+    return 0
+
+
+def reconcile_boundary(prev_content: str, prev_ending: str, first_page: str, *, window: int=8) -> str:
+    '''
+    first page of a shard, joined to the previous shard
+
+    prev_content: last page the previous shard emitted
+    prev_ending: text the previous shard carried over after it (not emitted by it)
+    first_page: first page emitted by the next shard, whose warm-up produced its own version of the carry-over
+
+    lines are compared whole (normalized, long ones allowing small rewordings):
+    leading lines of first_page that repeat the last lines of prev_content (up to window lines) are dropped,
+    lines of prev_ending that first_page does not start with are prepended
+    '''
+    emitted = [_norm(line) for line in prev_content.split('\n')[-window:] if _norm(line) != '']
+    lines = first_page.split('\n')
+    # positions of the non empty lines of first_page
+    content = [i for i, line in enumerate(lines) if _norm(line) != '']
+    dropped = _overlap(emitted, [_norm(lines[i]) for i in content])
+    if (dropped > 0):
+        logger.debug(f'shard boundary: {dropped} duplicated lines dropped')
+    # from the first line kept, empty lines before it go too
+    lines = lines[content[dropped]:] if dropped < len(content) else []
+
+    carried = [line for line in prev_ending.split('\n') if _norm(line) != '']
+    head = [_norm(line) for line in lines if _norm(line) != ''][:len(carried) + window]
+    missing = [line for line in carried if not any(_same_line(_norm(line), other) for other in head)]
+    if (len(missing) > 0):
+        logger.debug(f'shard boundary: {len(missing)} carried over lines restored')
+    return '\n'.join(missing + lines)
+
+
+async def _limited(limit: asyncio.Semaphore, fn: Callable[..., Awaitable[Any]], *args):
+    async with limit:
+        return await fn(*args)
+
+
+async def _refine_shard(pages: List[str], warmup: int, format_page: FormatPage, summarize_page: SummarizePage,
+                        limit: asyncio.Semaphore, out: asyncio.Queue):
+    ''' puts (_PAGE, content) for every page after the warm-up ones, then (_END, carried over text) '''
+    summary: Optional[asyncio.Task] = None
+    try:
+        page_cache = ''
+        description = None
+        for i, page in enumerate(pages):
+            page_cache += '\n' + page
+            formatted = await _limited(limit, format_page, page_cache, description)
+            page_cache = formatted['ending']
+            if (summary is not None):
+                # page i - 1, ready for page i + 1
+                description = await summary
+            summary = None
+            if (not formatted.get('skipped')):
+                # pages kept as they are (pdf_refine heuristics) are not summarized
+                summary = asyncio.ensure_future(_limited(limit, summarize_page, formatted['content']))
+            if (i >= warmup):
+                out.put_nowait((_PAGE, formatted['content']))
+        out.put_nowait((_END, page_cache))
+    except Exception as e:
+        out.put_nowait((_ERROR, e))
+    finally:
+        if (summary is not None and not summary.done()):
+            # the description of the last page is not needed by anyone
+            summary.cancel()
+
+
+async def iterate_refined_pages(
+        pages: AsyncIterable[str], *, format_page: FormatPage, summarize_page: SummarizePage,
+        concurrency: int=4, shard_pages: int=8, overlap: int=1) -> AsyncGenerator[str, None]:
+    '''
+    like the serial loop of pdf_refine.iterate_refined_pdf_pages: yields every refined page,
+    then the text carried over after the last one
+
+    concurrency: max concurrent LLM calls, also the number of shards in flight
+    shard_pages: pages per shard (without warm-up pages)
+    overlap: warm-up pages a shard takes from the end of the previous one
+    '''
+    limit = asyncio.Semaphore(concurrency)
+    slots = asyncio.Semaphore(concurrency)
+    shards: asyncio.Queue = asyncio.Queue()
+    tasks: List[asyncio.Task] = []
+
+    async def dispatch():
+        try:
+            previous: List[str] = []
+            batch: List[str] = []
+
+            async def start():
+                await slots.acquire()
+                warmup = previous[-overlap:] if (overlap > 0 and len(previous) > 0) else []
+                out = asyncio.Queue()
+                tasks.append(asyncio.ensure_future(
+                    _refine_shard(warmup + batch, len(warmup), format_page, summarize_page, limit, out)))
+                shards.put_nowait(out)
+
+            async for page in pages:
+                batch.append(page)
+                if (len(batch) >= shard_pages):
+                    await start()
+                    previous, batch = batch, []
+            if (len(batch) > 0 or len(tasks) == 0):
+                await start()
+        except Exception as e:
+            failed = asyncio.Queue()
+            failed.put_nowait((_ERROR, e))
+            shards.put_nowait(failed)
+        shards.put_nowait(None)
+
+    dispatcher = asyncio.ensure_future(dispatch())
+    try:
+        last_page = None
+        ending = ''
+        while (True):
+            out = await shards.get()
+            if (out is None):
+                break
+            first = True
+            while (True):
+                kind, value = await out.get()
+                if (kind == _ERROR):
+                    raise value
+                if (kind == _END):
+                    ending = value
+                    break
+                if (first and last_page is not None):
+                    value = reconcile_boundary(last_page, ending, value)
+                first = False
+                last_page = value
+                yield value
+            slots.release()
+        yield ending
+    finally:
+        dispatcher.cancel()
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,113 @@
+
+"""
+
+Line Batch
+
+judging many PDF lines in one LLM request instead of one request per line
+(see pdf_refine.llm_judge_line_types / llm_judge_line_removals)
+
+- the lines of a window are numbered, the lines around the window are sent once as plain context
+- the answer is a json array with one {"line": n, ...} object per numbered line,
+  every object is validated on its own
+- only the lines without a valid object are asked again, the rest of the window stays as context
+- a request that gives up (LLMError) answers no line, the next round asks again and the lines
+  still unanswered after the last round go to the fallback
+
+"""
+
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Set,
+    Tuple,
+)
+
+import jsonschema
+import logging
+
+from .llm_client import LLMError
+
+logger = logging.getLogger(__name__)
+
+
+def format_window(lines: List[str], ask: Set[int]) -> str:
+    ''' numbered lines are the ones to judge (1-based), the others are indented for reference '''
+    return '\n'.join(
+        f'[{n}] {line}' if (n in ask) else f'    {line}'
+        for n, line in enumerate(lines, start=1)
+    )
+
+
+def collect_answers(answer: Any, ask: Set[int], item_schema: dict, field: str) -> Dict[int, Any]:
+    ''' line number -> value of field, for the valid objects of answer about lines in ask '''
+    valid = {}
+    if (not isinstance(answer, list)):
+        return valid
+    for item in answer:
+        try:
+            jsonschema.validate(item, item_schema)
+        except jsonschema.ValidationError:
+            continue
+        if (item['line'] in ask and item['line'] not in valid):
+            valid[item['line']] = item[field]
+    return valid
+
+
+async def judge_window(
+        lines: List[str], *, ask_llm: Callable[[str], Awaitable[Any]], item_schema: dict, field: str,
+        fallback: Callable[[int], Awaitable[Any]], rounds: int=3) -> List[Any]:
+    '''
+    one value per line
+
+    ask_llm(numbered lines) -> parsed json answer of the LLM
+    fallback(index): value of a line still unanswered after `rounds` batched requests (e.g. the one-line judge)
+    '''
+    ask = set(range(1, len(lines) + 1))
+    values: Dict[int, Any] = {}
+    for i in range(rounds):
+        if (len(ask) == 0):
+            break
+        try:
+            answer = await ask_llm(format_window(lines, ask))
+        except LLMError as e:
+            logger.warning(f'batched request for {len(ask)} lines failed: {e}')
+            answer = None
+        got = collect_answers(answer, ask, item_schema, field)
+        values.update(got)
+        ask -= set(got)
+        if (len(ask) > 0):
+            logger.info(f'{len(ask)} of {len(lines)} lines without a valid answer, asking again')
+    for n in sorted(ask):
+        values[n] = await fallback(n - 1)
+    return [values[n] for n in range(1, len(lines) + 1)]
+
+
+def iterate_windows(context_iter: Iterable[Tuple[str, List[str]]], batch_size: int
+                    ) -> Iterator[Tuple[List[str], List[str], List[str], List[List[str]]]]:
+    '''
+    groups the output of pdf_refine.iterate_pdf_context into windows of batch_size lines:
+    (lines, context before the first line, context after the last line, per line contexts)
+    '''
+    batch: List[Tuple[str, List[str]]] = []
+
+    def window():
+        context_size = len(batch[0][1]) // 2
+        return (
+            [line for line, _ in batch],
+            batch[0][1][:context_size],
+            batch[-1][1][context_size + 1:],
+            [context for _, context in batch],
+        )
+
+    for item in context_iter:
+        batch.append(item)
+        if (len(batch) >= batch_size):
+            yield window()
+            batch = []
+    if (len(batch) > 0):
+        yield window()
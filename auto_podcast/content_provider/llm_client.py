@@ -0,0 +1,303 @@
+
+"""
+
+LLM Client
+
+the one way content providers talk to the LLM
+
+- chains are built once per name and share one chat model, so one HTTP connection pool
+- token buckets keep requests/min and tokens/min under the account limits
+  (tokens are estimated before the call and corrected with the reported usage)
+- failed calls are retried with capped exponential backoff and jitter, a bounded number of times
+- a circuit breaker stops calling the endpoint after consecutive failures; after a cooldown a
+  single probe call decides whether it is back
+
+limits can be set by environment variables:
+
+    AUTO_PODCAST_LLM_RPM=3500     requests per minute, 0 disables the limit
+    AUTO_PODCAST_LLM_TPM=90000    tokens per minute, 0 disables the limit
+
+"""
+
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Optional,
+)
+
+import asyncio
+import os
+import random
+import time
+import logging
+
+from .llm_utils import LLMMetricsCallback, count_retry
+from .. import metrics
+
+logger = logging.getLogger(__name__)
+
+_THROTTLE_SECONDS = metrics.counter('llm_throttle_seconds_total', 'time LLM calls waited for the rate limits')
+_CIRCUIT_TRIPS = metrics.counter('llm_circuit_trips_total', 'times the circuit breaker opened')
+
+# characters per token, rough enough for budgeting
+CHARS_PER_TOKEN = 4
+
+
+class LLMError(Exception):
+    ''' no usable answer within the allowed attempts '''
+
+
+class TokenBucket():
+    ''' per_minute units refill continuously, at most capacity (default: per_minute) are available at once.
+    per_minute <= 0 disables the bucket '''
+
+    def __init__(self, per_minute: float, capacity: Optional[float]=None):
+        self.per_minute = per_minute
+        self.capacity = capacity if capacity is not None else per_minute
+        self.available = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock() # waiters are served in order
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self._updated) * self.per_minute / 60)
+        self._updated = now
+
+    async def acquire(self, amount: float=1.0) -> float:
+        ''' returns the seconds waited '''
+        if (self.per_minute <= 0):
+            return 0.0
+        amount = min(amount, self.capacity) # a single huge request must not wait forever
+        waited = 0.0
+        async with self._lock:
+            self._refill()
+            while (self.available < amount):
+                delay = (amount - self.available) * 60 / self.per_minute
+                await asyncio.sleep(delay)
+                waited += delay
+                self._refill()
+            self.available -= amount
+        return waited
+
+    def adjust(self, amount: float):
+        ''' take (or give back, if negative) amount after the fact, may go into debt '''
+        if (self.per_minute <= 0):
+            return
+        self._refill()
+        self.available = min(self.capacity, self.available - amount)
+
+
+class CircuitBreaker():
+    '''
+    closed: calls go through. failure_threshold consecutive failures open it
+    open: calls wait until reset_timeout has passed since it opened
+    half open: one probe call goes through, the others keep waiting. success closes it, failure opens it again
+    '''
+
+    def __init__(self, failure_threshold: int=5, reset_timeout: float=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if (self._opened_at is None):
+            return 'closed'
+        if (time.monotonic() - self._opened_at < self.reset_timeout):
+            return 'open'
+        return 'half open'
+
+    async def wait(self) -> float:
+        ''' returns when a call may be made, the seconds waited '''
+        waited = 0.0
+        while (self._opened_at is not None):
+            remaining = self._opened_at + self.reset_timeout - time.monotonic()
+            if (remaining <= 0 and not self._probing):
+                self._probing = True
+                break
+            delay = max(remaining, min(1.0, self.reset_timeout))
+            await asyncio.sleep(delay)
+            waited += delay
+        return waited
+
+    def success(self):
+        if (self._opened_at is not None):
+            logger.info('LLM circuit closed')
+        self.failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    def failure(self):
+        self.failures += 1
+        if (self._probing or (self._opened_at is None and self.failures >= self.failure_threshold)):
+            logger.warning(f'LLM circuit open after {self.failures} failures, pausing {self.reset_timeout}s')
+            _CIRCUIT_TRIPS.inc()
+            self._opened_at = time.monotonic()
+            self._probing = False
+
+    def abandon(self):
+        ''' a call ended without a result (cancelled), let another one probe '''
+        self._probing = False
+
+
+def _status_code(error: Exception) -> Optional[int]:
+    status = getattr(error, 'status_code', None) or getattr(error, 'http_status', None)
+    if (status is None):
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+    return status if isinstance(status, int) else None
+
+def is_retryable(error: Exception) -> bool:
+    ''' transport errors (no status), timeouts, rate limiting and server errors.
+    other 4xx (bad request, authentication, context length) will fail the same way again '''
+    status = _status_code(error)
+    return status is None or status in (408, 409, 429) or status >= 500
+
+
+class LLMClient():
+
+    def __init__(self, *, requests_per_minute: float=3500, tokens_per_minute: float=90000,
+                 max_attempts: int=5, backoff_base: float=1.0, backoff_max: float=30.0,
+                 failure_threshold: int=5, reset_timeout: float=30.0, completion_tokens: int=512):
+        '''
+        max_attempts: calls per invoke() before giving up with LLMError, invalid answers included
+        backoff_base / backoff_max: delay after the n-th failed call is min(backoff_max, backoff_base * 2^n), jittered
+        completion_tokens: expected answer length, reserved from the tokens/min budget before a call
+        '''
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.completion_tokens = completion_tokens
+        self._model = None
+        self._chains: Dict[str, Any] = {}
+
+    def chat_model(self):
+        ''' the shared chat model, its temperature is configurable per call (llm_temperature) '''
+        if (self._model is None):
+            from langchain.chat_models import ChatOpenAI
+            from langchain_core.runnables import ConfigurableField
+            # retries are done here, with the rate limits and the circuit breaker in the loop
+            self._model = ChatOpenAI(temperature=0, max_retries=0).configurable_fields(
+                temperature=ConfigurableField(
+                    id="llm_temperature",
+                    name="LLM Temperature",
+                    description="The temperature of the LLM",
+                )
+            )
+        return self._model
+
+    def chain(self, name: str, template: str, parser_factory: Callable[[], Any]):
+        ''' jinja2 prompt template | chat model | parser, built on first use of name '''
+        if (name not in self._chains):
+            from langchain.prompts import ChatPromptTemplate
+            chain = (
+                ChatPromptTemplate.from_template(template, template_format='jinja2')
+                | self.chat_model()
+                | parser_factory()
+            )
+            self._chains[name] = chain
+        return self._chains[name]
+
+    def _backoff(self, attempt: int) -> float:
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        return delay * random.uniform(0.5, 1.0)
+
+    @staticmethod
+    async def _first(agen):
+        ''' first item of agen (None if it is empty), then agen is closed '''
+        try:
+            async for item in agen:
+                return item
+            return None
+        finally:
+            await agen.aclose()
+
+    async def invoke(self, chain, inputs: Dict[str, Any], *, function: str, temperature: float=0.0,
+                     retry_temperature: Optional[float]=None, validate: Optional[Callable[[Any], Any]]=None,
+                     max_attempts: Optional[int]=None, stream: bool=False):
+        '''
+        answer of chain for inputs
+
+        function: label of the metrics
+        retry_temperature: temperature of the calls after an invalid answer
+        validate: raises on an unusable answer, which is then asked again (without backoff)
+        stream: read the answer as it is generated and take the first item the chain yields,
+            the rest is not read (JsonOutputParser with stop_schema yields as soon as the value is complete)
+        raises LLMError when no attempt produced a valid answer, or at once when the request is rejected
+        as such (is_retryable), which does not count towards opening the circuit
+        '''
+        max_attempts = max_attempts or self.max_attempts
+        estimate = sum(len(str(v)) for v in inputs.values()) // CHARS_PER_TOKEN + self.completion_tokens
+        last_error = None
+        failures = 0
+        for attempt in range(max_attempts):
+            if (attempt > 0):
+                count_retry(function)
+            throttled = await self.breaker.wait()
+            throttled += await self.requests.acquire(1)
+            throttled += await self.tokens.acquire(estimate)
+            if (throttled > 0):
+                _THROTTLE_SECONDS.inc(throttled, function=function)
+
+            callback = LLMMetricsCallback(function)
+            try:
+                configured = chain.with_config({"llm_temperature": temperature, "callbacks": [callback]})
+                if (stream):
+                    answer = await self._first(configured.astream(inputs))
+                else:
+                    answer = await configured.ainvoke(inputs)
+            except asyncio.CancelledError:
+                self.breaker.abandon()
+                raise
+            except Exception as e:
+                self.tokens.adjust(-estimate)
+                if (not is_retryable(e)):
+                    # the request is at fault (e.g. too long for the context), not the endpoint:
+                    # the circuit stays as it is, a probe slot taken by this call is given back
+                    self.breaker.abandon()
+                    raise LLMError(f'{function}: LLM call rejected ({type(e).__name__}: {e})') from e
+                self.breaker.failure()
+                last_error = e
+                failures += 1
+                delay = self._backoff(failures - 1)
+                logger.warning(f'{function}: LLM call failed ({type(e).__name__}: {e}), retry in {delay:.1f}s')
+                await asyncio.sleep(delay)
+                continue
+            self.breaker.success()
+            if (callback.tokens > 0):
+                self.tokens.adjust(callback.tokens - estimate)
+
+            if (validate is not None):
+                try:
+                    validate(answer)
+                except Exception as e:
+                    logger.info(f'{function}: unusable LLM answer ({e}), retry')
+                    last_error = e
+                    if (retry_temperature is not None):
+                        temperature = retry_temperature
+                    continue
+            return answer
+        raise LLMError(f'{function}: no valid answer after {attempt + 1} attempts') from last_error
+
+
+_default: Optional[LLMClient] = None
+
+def default_client() -> LLMClient:
+    ''' the shared client, limits from AUTO_PODCAST_LLM_RPM / AUTO_PODCAST_LLM_TPM '''
+    global _default
+    if (_default is None):
+        _default = LLMClient(
+            requests_per_minute=float(os.environ.get('AUTO_PODCAST_LLM_RPM', 3500)),
+            tokens_per_minute=float(os.environ.get('AUTO_PODCAST_LLM_TPM', 90000)),
+        )
+    return _default
+
+def set_default_client(client: Optional[LLMClient]):
+    ''' install a client with other limits, None resets to the default '''
+    global _default
+    _default = client
@@ -1,52 +1,179 @@
 
+from typing import (
+    Any,
+    AsyncIterator,
+    Iterator,
+    List,
+    Optional,
+    Union,
+)
 
-from langchain_core.output_parsers import StrOutputParser, BaseOutputParser
+from langchain_core.output_parsers import StrOutputParser, BaseOutputParser, BaseTransformOutputParser
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import BaseMessage
 
+import asyncio
 import json
+import re
+import time
+
+import jsonschema
+
+from .. import metrics
+
+
+_LLM_SECONDS = metrics.histogram('llm_seconds', 'one LLM call, by calling function')
+_LLM_TOKENS = metrics.counter('llm_tokens_total', 'LLM tokens by kind (prompt, completion) and calling function')
+_LLM_ERRORS = metrics.counter('llm_errors_total', 'LLM calls that raised, by calling function')
+_LLM_RETRIES = metrics.counter('llm_retries_total', 'LLM calls repeated because of an error or an unusable answer')
+
+
+_JSON_SPECIAL = re.compile(r'[\[\]{}"\\]')
+_CLOSER = {'[': ']', '{': '}'}
+
+
+def _json_start(input_string: str, last_index: int) -> int:
+    ''' position of the bracket opening the one at last_index, -1 if there is none.
+    walks back once, skipping brackets inside strings '''
+    depth = 0
+    in_string = False
+    specials = [m.start() for m in _JSON_SPECIAL.finditer(input_string, 0, last_index + 1)]
+    for i in reversed(specials):
+        c = input_string[i]
+        if (c == '"'):
+            backslashes = 0
+            while (i - backslashes > 0 and input_string[i - backslashes - 1] == '\\'):
+                backslashes += 1
+            if (backslashes % 2 == 0):
+                in_string = not in_string
+        elif (in_string or c == '\\'):
+            continue
+        elif (c in ']}'):
+            depth += 1
+        else:
+            depth -= 1
+            if (depth == 0):
+                return i
+    return -1
 
 
 def find_last_valid_json(input_string):
-    # Find the last occurrence of ']' or '}'
+    ''' the JSON value ending at the last ']' or '}', None if there is none.
+    linear: the opening bracket is found by matching brackets backwards, then parsed once '''
     last_index = max(input_string.rfind(']'), input_string.rfind('}'))
-
-    # If neither ']' nor '}' is found, return None
     if last_index == -1:
         return None
 
-    # Extract the potential JSON string
-    for i in range(last_index):
-        if (input_string[i] in ['[', '{']):
-            potential_json = input_string[i:last_index + 1]
+    start = _json_start(input_string, last_index)
+    if (start != -1):
+        try:
+            return json.loads(input_string[start:last_index + 1])
+        except json.JSONDecodeError:
+            pass
+    return None
+
+
+class JsonExtractor():
+    '''
+    finds the JSON values of a text arriving in chunks, in one pass
+
+        extractor = JsonExtractor()
+        for chunk in stream:
+            for value in extractor.feed(chunk):
+                ...
+        extractor.result() # find_last_valid_json of the whole text
 
-            # Try to parse the string as JSON
-            try:
-                json_object = json.loads(potential_json)
-                return json_object  # Return the JSON object if parsing is successful
-            except json.JSONDecodeError:
-                pass
-    return None  # Return None if parsing fails
+    brackets are matched as the text comes in (skipping the ones inside strings), a value is
+    parsed when its outermost bracket closes; brackets in the prose around it don't nest, a
+    closer that doesn't match starts over
+    '''
 
+    def __init__(self):
+        self._parts: List[str] = [] # all text fed
+        self._length = 0
+        self._stack: List[str] = [] # open brackets of the current value
+        self._current: List[str] = [] # text of the current value, before this chunk
+        self._in_string = False
+        self._escaped = -1 # position of the character after a backslash in a string
 
-class JsonOutputParser(BaseOutputParser):
-    """OutputParser that parses LLMResult into json."""
+    def feed(self, chunk: str) -> List[Any]:
+        ''' the values completed by chunk '''
+        values = []
+        base = self._length
+        self._parts.append(chunk)
+        self._length += len(chunk)
+        start = 0 if self._stack else None # where the current value starts in chunk
+        for m in _JSON_SPECIAL.finditer(chunk):
+            i = m.start()
+            c = chunk[i]
+            if (self._in_string):
+                if (base + i == self._escaped):
+                    continue
+                if (c == '\\'):
+                    self._escaped = base + i + 1
+                elif (c == '"'):
+                    self._in_string = False
+                continue
+            if (not self._stack):
+                if (c in _CLOSER):
+                    self._stack.append(c)
+                    start = i
+                continue # quotes and closers in prose
+            if (c == '"'):
+                self._in_string = True
+            elif (c in _CLOSER):
+                self._stack.append(c)
+            elif (c == _CLOSER[self._stack[-1]]):
+                self._stack.pop()
+                if (not self._stack):
+                    text = ''.join(self._current) + chunk[start:i + 1]
+                    self._current = []
+                    start = None
+                    try:
+                        values.append(json.loads(text))
+                    except json.JSONDecodeError:
+                        pass
+            elif (c in ']}'):
+                self._stack = []
+                self._current = []
+                start = None
+        if (start is not None):
+            self._current.append(chunk[start:])
+        return values
+
+    @property
+    def text(self) -> str:
+        return ''.join(self._parts)
+
+    def result(self):
+        ''' find_last_valid_json of all text fed '''
+        return find_last_valid_json(self.text)
+
+
+class JsonOutputParser(BaseTransformOutputParser):
+    """OutputParser that parses LLMResult into json.
+
+    when streamed (chain.astream / transform) with stop_schema, yields the first value valid
+    against stop_schema as soon as it is complete and stops reading the LLM output;
+    otherwise (or when no value is valid) yields the last json of the full text, like parse.
+    stop_schema is meant for prompts answering with the json only: after reasoning, an earlier
+    json may be one the LLM changes its mind about, parse takes the last one
+    """
 
     remapping: dict = {}
+    stop_schema: Optional[dict] = None
 
-    def __init__(self, remapping: dict=dict()):
+    def __init__(self, remapping: dict=dict(), stop_schema: Optional[dict]=None):
         super().__init__()
         self.remapping = remapping
+        self.stop_schema = stop_schema
 
     @property
     def _type(self) -> str:
         """Return the output parser type for serialization."""
         return "default"
 
-    def parse(self, text: str) -> str:
-        """Parse last json."""
-        res = find_last_valid_json(text)
-        if (res is None):
-            return None
-        
+    def _remap(self, res):
         if (type(res) == dict and self.remapping is not None):
             for k_from, k_to in self.remapping.items():
                 if (k_from in res):
@@ -55,4 +182,101 @@ class JsonOutputParser(BaseOutputParser):
                     res.pop(k_from)
         return res
 
+    def parse(self, text: str) -> str:
+        """Parse last json."""
+        res = find_last_valid_json(text)
+        if (res is None):
+            return None
+        return self._remap(res)
+
+    def _valid(self, value) -> bool:
+        try:
+            jsonschema.validate(value, self.stop_schema)
+        except jsonschema.ValidationError:
+            return False
+        return True
+
+    def _feed(self, extractor: JsonExtractor, chunk) -> Optional[list]:
+        ''' [value] once a value valid against stop_schema is complete '''
+        text = chunk.content if isinstance(chunk, BaseMessage) else chunk
+        if (not isinstance(text, str)):
+            text = ''.join(part if isinstance(part, str) else part.get('text', '') for part in text)
+        values = extractor.feed(text)
+        if (self.stop_schema is not None):
+            for value in values:
+                if (self._valid(value)):
+                    return [self._remap(value)]
+        return None
+
+    def _transform(self, input: Iterator[Union[str, BaseMessage]]) -> Iterator[Any]:
+        extractor = JsonExtractor()
+        for chunk in input:
+            found = self._feed(extractor, chunk)
+            if (found is not None):
+                yield found[0]
+                return
+        yield self.parse(extractor.text)
+
+    async def _atransform(self, input: AsyncIterator[Union[str, BaseMessage]]) -> AsyncIterator[Any]:
+        extractor = JsonExtractor()
+        async for chunk in input:
+            found = self._feed(extractor, chunk)
+            if (found is not None):
+                yield found[0]
+                return
+        yield self.parse(extractor.text)
+
+
+def _token_usage(response) -> dict:
+    ''' {"prompt_tokens", "completion_tokens"} of an LLMResult, whichever way the provider reports it '''
+    usage = (response.llm_output or {}).get('token_usage') or {}
+    if (usage):
+        return usage
+    # streaming / newer integrations put it on the message
+    for generations in response.generations:
+        for generation in generations:
+            meta = getattr(getattr(generation, 'message', None), 'usage_metadata', None)
+            if (meta):
+                return {'prompt_tokens': meta.get('input_tokens', 0), 'completion_tokens': meta.get('output_tokens', 0)}
+    return {}
+
+
+class LLMMetricsCallback(BaseCallbackHandler):
+    """Records latency, tokens and errors of every LLM call of a chain, labeled by function.
+
+    chain.ainvoke(inputs, config={'callbacks': [LLMMetricsCallback('llm_format_page')]})
+    """
+
+    def __init__(self, function: str):
+        super().__init__()
+        self.function = function
+        self.tokens = 0 # reported prompt + completion tokens of the calls seen
+        self._started = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._started[run_id] = time.perf_counter()
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._started[run_id] = time.perf_counter()
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        started = self._started.pop(run_id, None)
+        if (started is not None):
+            _LLM_SECONDS.observe(time.perf_counter() - started, function=self.function)
+        usage = _token_usage(response)
+        _LLM_TOKENS.inc(usage.get('prompt_tokens', 0), kind='prompt', function=self.function)
+        _LLM_TOKENS.inc(usage.get('completion_tokens', 0), kind='completion', function=self.function)
+        self.tokens += usage.get('prompt_tokens', 0) + usage.get('completion_tokens', 0)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        started = self._started.pop(run_id, None)
+        if (started is not None):
+            _LLM_SECONDS.observe(time.perf_counter() - started, function=self.function)
+        if (isinstance(error, (GeneratorExit, asyncio.CancelledError))):
+            # a streamed answer closed early (JsonOutputParser stop_schema), not a failure
+            return
+        _LLM_ERRORS.inc(function=self.function)
+
 
+def count_retry(function: str):
+    _LLM_RETRIES.inc(function=function)
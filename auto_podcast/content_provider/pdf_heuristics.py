@@ -0,0 +1,250 @@
+
+"""
+
+PDF Heuristics
+
+deterministic clean up of extracted PDF text, before (or instead of) the LLM
+
+- running headers / footers: lines near the top or bottom of a page that repeat on the
+  surrounding pages (digits ignored, so "Title 12" and "Title 13" are the same line)
+- page numbers: "12", "- 12 -", "Page 12", "xii", "第12页" near the top or bottom of a page
+- line joining: hard wrapped lines are joined into paragraphs, "hyphen-\\nated" words are
+  rejoined, a short line ending a sentence ends its paragraph, CJK lines are joined without a space
+- a paragraph running over the page end is moved to the next page, so every page ends at a paragraph break
+- confidence: how likely the cleaned page needs no further fixing. pdf_refine only sends pages
+  below a threshold to the LLM
+
+headings ("Chapter 3", "第三章", short all caps lines) become markdown "# " lines.
+
+"""
+
+from typing import (
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+)
+
+import collections
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# well formed roman numerals only, not any word made of these letters ("Did", "Mix", "Civil")
+_ROMAN = r'(?=[ivxlcdm])m{0,3}(?:cm|cd|d?c{0,3})(?:xc|xl|l?x{0,3})(?:ix|iv|v?i{0,3})'
+# below one hundred: front matter is not longer, and "mix" or "did" would be numerals too
+_SMALL_ROMAN = r'(?=[ivxl])(?:xc|xl|l?x{0,3})(?:ix|iv|v?i{0,3})'
+PAGE_NUMBER_RE = re.compile(
+    r'^\s*(?:'
+    r'(?:page\s*)?[-–—(\[]?\s*\d{1,4}\s*[-–—)\]]?'
+    # a bare roman numeral in lowercase (front matter), any case after "page" or in dashes / brackets
+    r'|(?-i:' + _SMALL_ROMAN + r')'
+    r'|(?:page\s+|[-–—(\[]\s*)' + _ROMAN + r'\s*[-–—)\]]?'
+    r'|\d{1,4}\s*/\s*\d{1,4}'
+    r'|第\s*\d{1,4}\s*页'
+    r')\s*$',
+    re.I)
+
+_NUMBER_WORDS = 'one|two|three|four|five|six|seven|eight|nine|ten|eleven|twelve|first|second|third|last'
+HEADING_RE = re.compile(
+    r'^\s*(?:'
+    r'(?:chapter|part|book|section|appendix)\s+(?:\d+|[ivxlcdm]+|[a-z]|' + _NUMBER_WORDS + r')\b[.:：-]?(?:\s+\S.{0,60})?'
+    r'|(?:prologue|epilogue|preface|introduction|contents|index)[.:：]?'
+    r'|第\s*[0-9零〇一二三四五六七八九十百千两]+\s*[章节回部篇卷](?:\s*\S.{0,30})?'
+    r')\s*$',
+    re.I)
+
+# a line ending like this ends a sentence
+_SENTENCE_END = re.compile(r'''[.!?。！？…:：;；][”’"'）)\]」』]*$''')
+_CJK = re.compile(r'[　-〿぀-ヿ㐀-鿿豈-﫿＀-￯]')
+_GARBAGE = re.compile(r'\(cid:\d+\)|[�\x00-\x08\x0b\x0c\x0e-\x1f]')
+_LETTER_SPACED = re.compile(r'(?:\b\w\s){5,}')
+
+
+def _normalize(line: str) -> str:
+    ''' key of a header / footer candidate '''
+    return re.sub(r'\s+', ' ', re.sub(r'\d+', '#', line)).strip().lower()
+
+def is_page_number(line: str) -> bool:
+    return PAGE_NUMBER_RE.match(line) is not None
+
+def is_heading(line: str) -> bool:
+    line = line.strip()
+    if (HEADING_RE.match(line)):
+        # "Part two of the plan was simple." is a sentence
+        return not line.endswith(('.', ',', ';'))
+    # SHORT ALL CAPS LINE
+    letters = [c for c in line if c.isalpha()]
+    return 3 <= len(letters) and len(line) <= 40 and all(c.isupper() for c in letters) and not _SENTENCE_END.search(line)
+
+def ends_sentence(line: str) -> bool:
+    return _SENTENCE_END.search(line.rstrip()) is not None
+
+
+def _edge_indexes(lines: List[str], edge_lines: int) -> List[int]:
+    ''' indexes of the first and last edge_lines non-empty lines '''
+    filled = [i for i, line in enumerate(lines) if line.strip() != '']
+    return sorted(set(filled[:edge_lines] + filled[-edge_lines:]))
+
+
+def strip_headers_footers(pages: Iterable[str], *, window: int=10, min_repeat: float=0.3,
+                          edge_lines: int=3) -> Iterator[List[str]]:
+    '''
+    lines of every page, running headers / footers and page numbers removed
+
+    window: pages around a page (before and after) that are compared with it
+    min_repeat: fraction of those pages a line has to repeat on (near their top or bottom), at least 3 pages
+    '''
+    half = max(1, window // 2)
+    loaded: Dict[int, List[str]] = {}
+    keys: Dict[int, Set[str]] = {}
+    it = iter(pages)
+    n_loaded = 0
+    exhausted = False
+    current = 0
+    while (True):
+        # read ahead half a window
+        while (not exhausted and n_loaded <= current + half):
+            try:
+                page = next(it)
+            except StopIteration:
+                exhausted = True
+                break
+            lines = [line.rstrip() for line in page.split('\n')]
+            loaded[n_loaded] = lines
+            keys[n_loaded] = {_normalize(lines[i]) for i in _edge_indexes(lines, edge_lines)}
+            n_loaded += 1
+        if (current >= n_loaded):
+            break
+
+        lines = loaded[current]
+        neighbours = [j for j in range(current - half, current + half + 1) if j != current and j in keys]
+        counts = collections.Counter(key for j in neighbours for key in keys[j])
+        needed = max(2, min_repeat * len(neighbours))
+        removed = []
+        for i in _edge_indexes(lines, edge_lines):
+            key = _normalize(lines[i])
+            if (is_page_number(lines[i]) or (counts[key] >= needed and len(neighbours) >= 2)):
+                removed.append(i)
+        if (len(removed) > 0):
+            logger.debug(f'page {current}: removed {[lines[i] for i in removed]}')
+        yield [line for i, line in enumerate(lines) if i not in removed]
+
+        # pages before the window are no longer needed
+        loaded.pop(current - half, None)
+        keys.pop(current - half, None)
+        current += 1
+
+
+def join_lines(lines: List[str], *, width: Optional[int]=None) -> List[str]:
+    '''
+    paragraphs (one line each, headings as "# ...") of hard wrapped lines
+
+    width: usual length of a full line, by default estimated from lines
+    '''
+    lengths = sorted(len(line.strip()) for line in lines if line.strip() != '')
+    if (width is None):
+        width = lengths[int(len(lengths) * 0.8)] if len(lengths) > 0 else 0
+    paragraphs: List[str] = []
+    current = ''
+    previous = '' # last raw line of current
+
+    def flush():
+        nonlocal current
+        if (current != ''):
+            paragraphs.append(current)
+        current = ''
+
+    for raw in lines:
+        line = raw.strip()
+        if (line == ''):
+            flush()
+            continue
+        if (is_heading(line)):
+            flush()
+            paragraphs.append('# ' + line)
+            continue
+        if (current == ''):
+            current = line
+        elif (len(current) >= 2 and current.endswith('-') and current[-2].isalpha() and line[0].islower()):
+            # hyphenation
+            current = current[:-1] + line
+        elif (ends_sentence(previous) and len(previous) < width * 0.75):
+            # short last line of a paragraph
+            flush()
+            current = line
+        elif (_CJK.match(line[0]) and _CJK.match(current[-1])):
+            current += line
+        else:
+            current += ' ' + line
+        previous = line
+    flush()
+    return paragraphs
+
+
+def page_confidence(text: str) -> float:
+    '''
+    0..1, how likely text (a cleaned page, paragraphs on their own lines) reads correctly as it is.
+    garbled characters, letter spaced words, short fragments (tables, captions, broken lines) and
+    number columns lower it
+    '''
+    paragraphs = [p.strip() for p in text.split('\n') if p.strip() != '']
+    if (len(paragraphs) == 0):
+        return 1.0
+    chars = sum(len(p) for p in paragraphs)
+    body = [p for p in paragraphs if not p.startswith('#')]
+    penalty = 0.0
+    penalty += 5 * sum(len(m.group()) for p in paragraphs for m in _GARBAGE.finditer(p)) / chars
+    penalty += 0.5 * sum(1 for p in body if _LETTER_SPACED.search(p)) / max(1, len(body))
+    fragments = [p for p in body if len(p) < 40 and not ends_sentence(p)]
+    penalty += 0.8 * len(fragments) / max(1, len(body))
+    numeric = [p for p in body if sum(c.isdigit() for c in p) > 0.3 * len(p)]
+    penalty += 0.8 * len(numeric) / max(1, len(body))
+    return max(0.0, 1.0 - penalty)
+
+
+class CleanPage():
+
+    def __init__(self, index: int, text: str, confidence: float):
+        self.index = index # page number in the input, the text left over after the last page has len(pages)
+        self.text = text
+        self.confidence = confidence
+
+    def __repr__(self) -> str:
+        return f'CleanPage(index={self.index}, confidence={self.confidence:.2f}, chars={len(self.text)})'
+
+
+def clean_pages(pages: Iterable[str], *, window: int=10, min_repeat: float=0.3) -> Iterator[CleanPage]:
+    '''
+    pages of pdf_text.extract_text_from_pdf -> CleanPage with one paragraph per line
+
+    a paragraph continuing on the next page is moved there, the last CleanPage holds
+    what is left after the last page (usually empty)
+    '''
+    carry: List[str] = []
+    index = -1
+    for index, lines in enumerate(strip_headers_footers(pages, window=window, min_repeat=min_repeat)):
+        if (len(carry) > 0):
+            # blank lines at the top of the page (below a removed header) don't end the carried paragraph
+            while (len(lines) > 0 and lines[0].strip() == ''):
+                lines = lines[1:]
+        lines = carry + lines
+        while (len(lines) > 0 and lines[-1].strip() == ''):
+            lines.pop()
+        # the unfinished last paragraph goes to the next page
+        start = len(lines)
+        if (start > 0 and not ends_sentence(lines[-1]) and not is_heading(lines[-1])):
+            while (start > 0 and lines[start - 1].strip() != '' and not is_heading(lines[start - 1])):
+                start -= 1
+            if (start == 0):
+                # a whole page without a paragraph break, don't carry it forever
+                start = len(lines)
+        lines, carry = lines[:start], lines[start:]
+        text = '\n'.join(join_lines(lines))
+        yield CleanPage(index, text, page_confidence(text))
+    text = '\n'.join(join_lines(carry))
+    yield CleanPage(index + 1, text, page_confidence(text))
@@ -0,0 +1,243 @@
+
+"""
+
+PDF Index
+
+chapters of a PDF, built once per file and kept in the kv cache
+
+- from the PDF outline (bookmarks) if there is one
+- otherwise from headings at the top of the pages ("Chapter 3", "CHAPTER III", "第三章")
+
+every chapter maps to a page span, and to byte offsets in the text of the whole book as
+pdf_text.extract_text_from_pdf returns it (utf-8, pages joined by newlines), so a chapter
+starting mid-page can be cut exactly.
+
+    index = get_index('book.pdf')
+    pages = index.page_range(['Chapter 3', 5])  # by title or by number (1-based)
+    async for segment in plain_pdf_gen('book.pdf', voice, chapters=['Chapter 3']): ...
+
+"""
+
+from typing import (
+    Iterable,
+    List,
+    Union,
+)
+
+import bisect
+import json
+import re
+import logging
+
+import PyPDF2
+from PyPDF2 import PdfReader
+
+from .. import kv_cache
+from . import pdf_text
+
+logger = logging.getLogger(__name__)
+
+
+INDEX_NAMESPACE = 'pdf_index'
+# bump when the index format or the heading rules change
+INDEX_FORMAT = 1
+
+CHAPTER_RE = re.compile(
+    r'^\s*(?:'
+    r'chapter\s+(?:\d+|[ivxlcdm]+|[a-z]+)\b.{0,60}'
+    r'|第\s*[0-9零〇一二三四五六七八九十百千两]+\s*[章回卷].{0,30}'
+    r')\s*$',
+    re.I)
+
+# headings are looked for in the first lines of a page only
+HEADING_LINES = 5
+
+Selector = Union[int, str, slice, range]
+
+
+class Chapter():
+
+    def __init__(self, number: int, title: str, level: int, start_page: int, end_page: int,
+                 start_offset: int=0, end_offset: int=0, source: str='outline'):
+        self.number = number # 1-based, in reading order
+        self.title = title
+        self.level = level # 0: top level of the outline
+        self.start_page = start_page
+        self.end_page = end_page # exclusive
+        self.start_offset = start_offset # bytes in the book text
+        self.end_offset = end_offset
+        self.source = source # 'outline' or 'heading'
+
+    @property
+    def pages(self) -> range:
+        return range(self.start_page, self.end_page)
+
+    def to_dict(self) -> dict:
+        return dict(vars(self))
+
+    def __repr__(self) -> str:
+        return f'Chapter({self.number}, {self.title!r}, pages {self.start_page}-{self.end_page - 1})'
+
+
+class PdfIndex():
+
+    def __init__(self, digest: str, page_count: int, page_offsets: List[int], chapters: List[Chapter]):
+        self.digest = digest
+        self.page_count = page_count
+        self.page_offsets = page_offsets # byte offset of every page in the book text, plus its total length
+        self.chapters = chapters
+
+    def to_json(self) -> str:
+        return json.dumps({
+            'digest': self.digest,
+            'page_count': self.page_count,
+            'page_offsets': self.page_offsets,
+            'chapters': [chapter.to_dict() for chapter in self.chapters],
+        }, ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, text: str) -> 'PdfIndex':
+        data = json.loads(text)
+        return cls(data['digest'], data['page_count'], data['page_offsets'],
+                   [Chapter(**chapter) for chapter in data['chapters']])
+
+    def find(self, selector: Selector) -> List[Chapter]:
+        '''
+        int: chapter number (1-based), str: title (exact match first, else case-insensitive substring),
+        slice / range: chapter numbers
+        '''
+        if (isinstance(selector, bool)):
+            raise TypeError('chapter selector must be a number, title, slice or range')
+        if (isinstance(selector, int)):
+            if (not 1 <= selector <= len(self.chapters)):
+                raise KeyError(f'no chapter {selector}, the book has {len(self.chapters)}')
+            return [self.chapters[selector - 1]]
+        if (isinstance(selector, str)):
+            found = [c for c in self.chapters if c.title.strip() == selector.strip()]
+            if (len(found) == 0):
+                found = [c for c in self.chapters if selector.strip().lower() in c.title.lower()]
+            if (len(found) == 0):
+                raise KeyError(f'no chapter titled {selector!r}')
+            return found
+        if (isinstance(selector, slice)):
+            return self.chapters[selector]
+        if (isinstance(selector, range)):
+            return [chapter for n in selector for chapter in self.find(n)]
+        raise TypeError(f'chapter selector must be a number, title, slice or range, got {selector!r}')
+
+    def select(self, selectors: Union[Selector, Iterable[Selector]]) -> List[Chapter]:
+        ''' chapters of one selector or of a list of them, in reading order, without duplicates '''
+        if (isinstance(selectors, (int, str, slice, range))):
+            selectors = [selectors]
+        chapters = {c.number: c for selector in selectors for c in self.find(selector)}
+        return [chapters[n] for n in sorted(chapters)]
+
+    def page_range(self, selectors: Union[Selector, Iterable[Selector]]) -> List[int]:
+        ''' pages of the selected chapters, usable as page_range of the pdf providers '''
+        return sorted({page for chapter in self.select(selectors) for page in chapter.pages})
+
+    def chapter_text(self, chapter: Chapter, pdf_path: str) -> str:
+        ''' exact text of chapter, from its heading up to the next chapter '''
+        # the next chapter may start in the middle of a page after chapter.pages
+        last_page = bisect.bisect_right(self.page_offsets, chapter.end_offset - 1) - 1
+        page_range = range(chapter.start_page, max(chapter.end_page, last_page + 1))
+        pages = list(pdf_text.extract_text_from_pdf(pdf_path, page_range))
+        text = '\n'.join(pages).encode('utf-8')
+        base = self.page_offsets[chapter.start_page]
+        return text[chapter.start_offset - base:chapter.end_offset - base].decode('utf-8', errors='ignore')
+
+
+def _outline_entries(reader: PdfReader) -> List[tuple]:
+    ''' (title, level, page) of the outline, depth first '''
+    outline = getattr(reader, 'outline', None)
+    if (outline is None):
+        # PyPDF2 < 3
+        outline = getattr(reader, 'outlines', None) or reader.getOutlines()
+    entries = []
+    def walk(items, level):
+        for item in items:
+            if (isinstance(item, list)):
+                walk(item, level + 1)
+                continue
+            try:
+                page = reader.get_destination_page_number(item)
+            except Exception:
+                logger.debug(f'outline entry without a page: {item!r}')
+                continue
+            if (page is not None and page >= 0):
+                entries.append((str(item.title).strip(), level, page))
+    walk(outline or [], 0)
+    return entries
+
+def _heading_entries(pages: List[str]) -> List[tuple]:
+    ''' (title, 0, page) of the first chapter heading near the top of every page '''
+    entries = []
+    for page, text in enumerate(pages):
+        lines = [line.strip() for line in text.split('\n') if line.strip() != '']
+        for line in lines[:HEADING_LINES]:
+            if (CHAPTER_RE.match(line)):
+                entries.append((line, 0, page))
+                break
+    return entries
+
+def build_index(pdf_path: str) -> PdfIndex:
+    reader = PdfReader(pdf_path)
+    entries = _outline_entries(reader)
+    source = 'outline'
+    # all pages once, in parallel and cached for later reads (see pdf_text.extract_text_from_pdf)
+    pages = list(pdf_text.extract_text_from_pdf(pdf_path))
+    if (len(entries) == 0):
+        entries = _heading_entries(pages)
+        source = 'heading'
+
+    page_offsets = [0]
+    for text in pages:
+        page_offsets.append(page_offsets[-1] + len(text.encode('utf-8')) + 1) # + newline
+    page_offsets[-1] -= 1 if len(pages) > 0 else 0
+
+    entries.sort(key=lambda entry: entry[2]) # stable, keeps outline order within a page
+    chapters = []
+    for n, (title, level, page) in enumerate(entries):
+        # until the next entry of the same or a higher level
+        end_page = len(pages)
+        for _, other_level, other_page in entries[n + 1:]:
+            if (other_level <= level):
+                end_page = other_page if other_page > page else page + 1
+                break
+        # the heading's position on its page, the page start if it can't be found
+        position = pages[page].find(title) if title else -1
+        start_offset = page_offsets[page] + (len(pages[page][:position].encode('utf-8')) if position >= 0 else 0)
+        chapters.append(Chapter(n + 1, title, level, page, end_page, start_offset, 0, source))
+    for chapter in chapters:
+        following = [c.start_offset for c in chapters
+                     if c.number > chapter.number and c.level <= chapter.level and c.start_offset > chapter.start_offset]
+        chapter.end_offset = following[0] if following else page_offsets[chapter.end_page]
+    logger.info(f'{pdf_path}: {len(chapters)} chapters from the {source}')
+    return PdfIndex(pdf_text.file_hash(pdf_path), len(pages), page_offsets, chapters)
+
+
+_indexes = {}
+
+def get_index(pdf_path: str) -> PdfIndex:
+    ''' the index of pdf_path, built on first use and stored in the kv cache '''
+    digest = pdf_text.file_hash(pdf_path)
+    if (digest not in _indexes):
+        store = kv_cache.default_cache()
+        key = f'{digest}:{PyPDF2.__version__}:{INDEX_FORMAT}'
+        text = store.get_text(INDEX_NAMESPACE, key)
+        if (text is not None):
+            index = PdfIndex.from_json(text)
+        else:
+            index = build_index(pdf_path)
+            store.put_text(INDEX_NAMESPACE, key, index.to_json())
+        _indexes[digest] = index
+    return _indexes[digest]
+
+def resolve_page_range(pdf_path: str, page_range=None, chapters=None):
+    ''' page_range of a provider given page_range and / or chapters (both: pages in both) '''
+    if (chapters is None):
+        return page_range
+    pages = get_index(pdf_path).page_range(chapters)
+    if (page_range is not None):
+        pages = [page for page in pages if page in page_range]
+    return pages
@@ -1,24 +1,32 @@
 
 from . import pdf_text
 
-from typing import Generator, Any, Tuple, List, Container
+from typing import Generator, Any, Tuple, List, Container, Iterable, Optional
 import jsonschema
+import functools
 import logging
 import json
 import os
 
 import langchain
-from langchain.chat_models import ChatOpenAI
-from langchain.prompts import ChatPromptTemplate, PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import ConfigurableField
 from langchain.globals import set_debug
-from .llm_utils import JsonOutputParser
+from .llm_utils import JsonOutputParser, count_retry
+from . import llm_client
 from . import simple_caching
+from . import concurrent_refine
+from . import line_batch
+from . import pdf_heuristics
+from . import pdf_index
+from .. import profiling
+from .. import metrics
+from .prefetch import prefetch_in_thread
 from ..audio_builder.segments import *
 
 logger = logging.getLogger(__name__)
 
+_PAGES = metrics.counter('pdf_pages_total', 'refined pages by route: llm, or heuristic (cleaned locally only)')
+
 def iterate_pdf_line(page_iter: Generator[str, Any, None]):
     ''' break pages into lines, + [PAGE SEPARATOR] '''
     for page in page_iter:
@@ -43,17 +51,13 @@ def iterate_pdf_context(line_iter: Generator[str, Any, None], *, context_size: i
 
 
 
-async def llm_judge_line_removal(line: str, context_array: List[str]):
-    
-    chain = (
-        ChatPromptTemplate.from_template(
-            """
+LINE_REMOVAL_PROMPT = """
 You are an assistant that goes through a text file line by line and identify the category of lines and the relationship between adjacent lines. Please note that the text file is converted from a PDF file. Therefore, it may contain broken formats, and irrelevant informations. Your goal is to check whether a line should be removed, given the context around it. The guidlines are as follows:
 1. We use <br> to represent line breaks in the extracted text.
 2. A line is preserved if it is consistent with the context.
 3. A line is preserved if it is a part of a paragraph, chapter title or section title.
 4. A line is removed if it is inconsistent with the context.
-5. A line is removed if it belongs to page header or footer, or page separator. 
+5. A line is removed if it belongs to page header or footer, or page separator.
 
 Your response should contain you thoughts and reasoning, and finally your answer to the question in strict json format: {"remove": true/false} indicating whether the line should be removed.
 
@@ -66,48 +70,32 @@ Here is the context before and after the line we want to check, for reference.
 ```
 {{ context }}
 ```
-""".strip(),
-        template_format='jinja2'
-        )
-        | ChatOpenAI(temperature=0).configurable_fields(
-            temperature=ConfigurableField(
-                id="llm_temperature",
-                name="LLM Temperature",
-                description="The temperature of the LLM",
-            )
-        )
-        | JsonOutputParser()
+""".strip()
+
+LINE_REMOVAL_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "remove": {"type": "boolean"}
+    },
+    "required": ["remove"]
+}
+
+async def llm_judge_line_removal(line: str, context_array: List[str]):
+    client = llm_client.default_client()
+    answer = await client.invoke(
+        client.chain('line_removal', LINE_REMOVAL_PROMPT, JsonOutputParser),
+        {
+            'line': line,
+            'context': '\n<br>\n'.join(context_array),
+        },
+        function='llm_judge_line_removal',
+        temperature=0.0,
+        retry_temperature=0.5, # increase temperature
+        validate=lambda answer: jsonschema.validate(answer, LINE_REMOVAL_SCHEMA),
     )
-    
-    answer = None
-    temperature = 0.0
-    while (answer is None):
-        try:
-            answer = await chain.with_config({"llm_temperature": temperature}).ainvoke({
-                'line': line,
-                'context': '\n<br>\n'.join(context_array),
-            })
-            if (answer is not None):
-                # validate {"answer": 1}
-                jsonschema.validate(answer, {
-                    "type": "object",
-                    "properties": {
-                        "remove": {"type": "boolean"}
-                    },
-                    "required": ["remove"]
-                })
-        except Exception:
-            import traceback
-            traceback.print_exc()
-            answer = None
-            temperature = 0.5 # increase temperature
     return answer['remove']
 
-async def llm_judge_line_type(line: str, context_array: List[str]):
-
-    chain = (
-        ChatPromptTemplate.from_template(
-            """
+LINE_TYPE_PROMPT = """
 You are an assistant that goes through a text file line by line and identify the category of lines and the relationship between adjacent lines. Please note that the text file is converted from a PDF file. Therefore, it may contain broken formats, headers, footers and extra line breaks. Your goal is to categorize which type a line of text belongs to, given the context around it. The categories are as follows:
 1. The line is a part of the book index or the table of contents.
 2. The line is a part of a paragraph and is the beginning of a sentence.
@@ -127,90 +115,204 @@ Here is the context before and after the line we want to categorize, for referen
 ```
 {{ context }}
 ```
-""".strip(),
-        template_format='jinja2'
-        )
-        | ChatOpenAI(temperature=0).configurable_fields(
-            temperature=ConfigurableField(
-                id="llm_temperature",
-                name="LLM Temperature",
-                description="The temperature of the LLM",
-            )
-        )
-        | JsonOutputParser()
+""".strip()
+
+# {"answer": 1}
+LINE_TYPE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "answer": {
+            "type": "integer"
+        }
+    },
+    "required": ["answer"],
+    "additionalProperties": False
+}
+
+async def llm_judge_line_type(line: str, context_array: List[str]):
+    client = llm_client.default_client()
+    answer = await client.invoke(
+        client.chain('line_type', LINE_TYPE_PROMPT, JsonOutputParser),
+        {
+            'line': line,
+            'context': '\n'.join(context_array),
+        },
+        function='llm_judge_line_type',
+        temperature=0.7,
+        validate=lambda answer: jsonschema.validate(answer, LINE_TYPE_SCHEMA),
     )
-    
-    answer = None
-    while (answer is None):
-        try:
-            answer = await chain.with_config({"llm_temperature": 0.7}).ainvoke({
-                'line': line,
-                'context': '\n'.join(context_array),
-            })
-            if (answer is not None):
-                # validate {"answer": 1}
-                jsonschema.validate(answer, {
-                    "type": "object",
-                    "properties": {
-                        "answer": {
-                            "type": "integer"
-                        }
-                    },
-                    "required": ["answer"],
-                    "additionalProperties": False
-                })
-        except Exception:
-            import traceback
-            traceback.print_exc()
-            answer = None
-    
     return answer['answer']
 
 
-async def llm_summarize_page(page: str):
-    cache_dir = 'cache/llm_summarize_page'
-    
-    chain = (
-        ChatPromptTemplate.from_template(
-            """
+LINE_TYPES_BATCH_PROMPT = """
+You are an assistant that goes through a text file line by line and identify the category of lines and the relationship between adjacent lines. Please note that the text file is converted from a PDF file. Therefore, it may contain broken formats, headers, footers and extra line breaks. Your goal is to categorize which type each numbered line of text belongs to, given the context around it. The categories are as follows:
+1. The line is a part of the book index or the table of contents.
+2. The line is a part of a paragraph and is the beginning of a sentence.
+3. The line is a part of a paragraph, but not the beginning of a sentence. It is the continuation of the sentence in the previous line.
+4. The line is a chapter title or section title.
+5. The line is a part of the header or footer of the pdf page.
+6. The line does not belong to any category above.
+
+The lines we want to categorize are marked with their number like [3]. Lines without a number are only given for reference, do not categorize them.
+
+Answer with only a json array in strict format, one object for every numbered line: [{"line": 3, "answer": ans}, ...] where ans is the index number of the category you choose for that line.
+
+Here is the context before the lines, for reference.
+```
+{{ before }}
+```
+
+Here are the lines we want to categorize.
+```
+{{ lines }}
+```
+
+Here is the context after the lines, for reference.
+```
+{{ after }}
+```
+""".strip()
+
+# one object of the answer array, [{"line": 3, "answer": 2}, ...]
+LINE_TYPES_ITEM_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "line": {"type": "integer"},
+        "answer": {"type": "integer", "minimum": 1, "maximum": 6}
+    },
+    "required": ["line", "answer"]
+}
+
+LINE_REMOVALS_BATCH_PROMPT = """
+You are an assistant that goes through a text file line by line and identify the category of lines and the relationship between adjacent lines. Please note that the text file is converted from a PDF file. Therefore, it may contain broken formats, and irrelevant informations. Your goal is to check whether each numbered line should be removed, given the context around it. The guidlines are as follows:
+1. A line is preserved if it is consistent with the context.
+2. A line is preserved if it is a part of a paragraph, chapter title or section title.
+3. A line is removed if it is inconsistent with the context.
+4. A line is removed if it belongs to page header or footer, or page separator.
+
+The lines we want to check are marked with their number like [3]. Lines without a number are only given for reference, do not check them.
+
+Answer with only a json array in strict format, one object for every numbered line: [{"line": 3, "remove": true/false}, ...] indicating whether that line should be removed.
+
+Here is the context before the lines, for reference.
+```
+{{ before }}
+```
+
+Here are the lines we want to check.
+```
+{{ lines }}
+```
+
+Here is the context after the lines, for reference.
+```
+{{ after }}
+```
+""".strip()
+
+LINE_REMOVALS_ITEM_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "line": {"type": "integer"},
+        "remove": {"type": "boolean"}
+    },
+    "required": ["line", "remove"]
+}
+
+def _answer_array_schema(item_schema: dict) -> dict:
+    ''' an array with at least one answer object, a line number mentioned in prose ("line [3] is ...") is not one.
+    the other items are not checked here: line_batch keeps the valid ones and asks again for the rest '''
+    return {"type": "array", "contains": item_schema}
+
+async def _ask_lines(chain_name: str, template: str, function: str, item_schema: dict, before: List[str],
+                     after: List[str], temperature: float, numbered: str):
+    client = llm_client.default_client()
+    schema = _answer_array_schema(item_schema)
+    return await client.invoke(
+        client.chain(chain_name, template, functools.partial(JsonOutputParser, stop_schema=schema)),
+        {
+            'before': '\n'.join(before),
+            'lines': numbered,
+            'after': '\n'.join(after),
+        },
+        function=function,
+        temperature=temperature,
+        # line_batch then picks the objects about the lines asked, missing lines are asked again
+        validate=lambda answer: jsonschema.validate(answer, schema),
+        stream=True,
+    )
+
+async def llm_judge_line_types(lines: List[str], before: List[str], after: List[str],
+                               contexts: Optional[List[List[str]]]=None) -> List[int]:
+    ''' llm_judge_line_type of every line in one request. contexts: per line contexts for the one-line fallback '''
+    return await line_batch.judge_window(
+        lines,
+        ask_llm=functools.partial(_ask_lines, 'line_types', LINE_TYPES_BATCH_PROMPT, 'llm_judge_line_types',
+                                  LINE_TYPES_ITEM_SCHEMA, before, after, 0.7),
+        item_schema=LINE_TYPES_ITEM_SCHEMA,
+        field='answer',
+        fallback=lambda i: llm_judge_line_type(lines[i], contexts[i] if contexts else before + lines + after),
+    )
+
+async def llm_judge_line_removals(lines: List[str], before: List[str], after: List[str],
+                                  contexts: Optional[List[List[str]]]=None) -> List[bool]:
+    ''' llm_judge_line_removal of every line in one request '''
+    return await line_batch.judge_window(
+        lines,
+        ask_llm=functools.partial(_ask_lines, 'line_removals', LINE_REMOVALS_BATCH_PROMPT, 'llm_judge_line_removals',
+                                  LINE_REMOVALS_ITEM_SCHEMA, before, after, 0.0),
+        item_schema=LINE_REMOVALS_ITEM_SCHEMA,
+        field='remove',
+        fallback=lambda i: llm_judge_line_removal(lines[i], contexts[i] if contexts else before + lines + after),
+    )
+
+async def iterate_line_type_llm(context_iter: Iterable[Tuple[str, List[str]]], *, batch_size: int=1):
+    ''' (line, context) from iterate_pdf_context -> (line, line type)
+    batch_size > 1 judges that many lines per request, with the context before and after the whole window '''
+    if (batch_size <= 1):
+        for line, context in context_iter:
+            yield (line, await llm_judge_line_type(line, context))
+        return
+    for lines, before, after, contexts in line_batch.iterate_windows(context_iter, batch_size):
+        for line, line_type in zip(lines, await llm_judge_line_types(lines, before, after, contexts)):
+            yield (line, line_type)
+
+async def iterate_line_removal_llm(context_iter: Iterable[Tuple[str, List[str]]], *, batch_size: int=1):
+    ''' (line, context) from iterate_pdf_context -> (line, whether to remove it) '''
+    if (batch_size <= 1):
+        for line, context in context_iter:
+            yield (line, await llm_judge_line_removal(line, context))
+        return
+    for lines, before, after, contexts in line_batch.iterate_windows(context_iter, batch_size):
+        for line, remove in zip(lines, await llm_judge_line_removals(lines, before, after, contexts)):
+            yield (line, remove)
+
+
+SUMMARIZE_PAGE_PROMPT = """
 The following text is from a page of a book. Use one sentence to describe what the page is about.
 
 ```
 {{ page }}
 ```
-""".strip(),
-        template_format='jinja2'
-        )
-        | ChatOpenAI(temperature=0).configurable_fields(
-            temperature=ConfigurableField(
-                id="llm_temperature",
-                name="LLM Temperature",
-                description="The temperature of the LLM",
-            )
-        )
-        | StrOutputParser()
-    )
-    
-    cache_id = str(chain) + page
-    cached_result = simple_caching.get_text_cache(cache_dir, identifier=cache_id)
-    if (cached_result is not None):
-        return json.loads(cached_result)
-    
-    answer = None
-    while (answer is None):
-        try:
-            answer = await chain.with_config({"llm_temperature": 0.0}).ainvoke({
-                'page': page,
-            })
-        except Exception:
-            import traceback
-            traceback.print_exc()
-            answer = None
-    
+""".strip()
+
+def _summarize_page_chain():
+    return llm_client.default_client().chain('summarize_page', SUMMARIZE_PAGE_PROMPT, StrOutputParser)
+
+@simple_caching.cached_func(
+    'cache/llm_summarize_page',
+    fingerprint=lambda: simple_caching.runnable_fingerprint(_summarize_page_chain()))
+async def llm_summarize_page(page: str):
+    ''' one sentence description, None if the LLM is unavailable (the description is only context for the next page) '''
+    try:
+        answer = await llm_client.default_client().invoke(
+            _summarize_page_chain(), {'page': page}, function='llm_summarize_page', temperature=0.0)
+    except llm_client.LLMError:
+        logger.exception('LLM summarize failed, continuing without description')
+        return None
+
     logger.info('LLM summarize')
     logger.info(answer)
-
-    simple_caching.save_text_cache(cache_dir, identifier=cache_id, text=json.dumps(answer))
     return answer
 
 def count_non_whitespace_characters(input_string):
@@ -218,15 +320,8 @@ def count_non_whitespace_characters(input_string):
     count = sum(1 for char in input_string if not char.isspace())
     return count
 
-async def llm_format_page_(page_text, last_page_description=None):
-    cache_dir = 'cache/llm_format_page'
-    ''' 
-    Remove bad formats, broken lines etc..
-    returns {"content": "...", "ending": "..."} '''
-
-    chain_markdown = (
-        ChatPromptTemplate.from_template(
-            '''
+# first version of llm_format_page: markdown, then let the LLM choose the split position
+FORMAT_PAGE_PROMPT_V0 = '''
 You are a book editor. You have received a manuscript that contains broken formats and some irrelevant text. Now you are going to turn it into standard markdown format. Please follow these guidelines:
 - Remove nonsense characters and page numbers.
 - In your formatted markdown, remove inappropriate line breaks within sentences.
@@ -238,55 +333,10 @@ You are a book editor. You have received a manuscript that contains broken forma
 Here is the current page you are processing
 ```
 {{ page }}
-```'''.strip(),
-            template_format='jinja2'
-        )
-        | ChatOpenAI(temperature=0).configurable_fields(
-            temperature=ConfigurableField(
-                id="llm_temperature",
-                name="LLM Temperature",
-                description="The temperature of the LLM",
-            )
-        )
-        | StrOutputParser()
-    )
-    
-#     chain_json = (
-#         ChatPromptTemplate.from_template(
-#             '''
-# You are a book editor. You have received a page of manuscript in markdown. Now you are going to split it into two parts and turn it into a json. Please follow these guidelines:
-# - The json should be in strict format like {"content": "...", "ending": "..."}
-# - The "content" is used to put the majority of the manuscript.
-# - The "ending" string is for the last paragraph. Usually the last paragraph is incomplete and is to be continued in the next page. Therefore, do not put them into "content". Put them into "ending" for later analysis.
-# - Make sure you process the full text that is given to you. Do not miss anything.
-
-# Here is the current page you are processing
-# ```
-# {{ page }}
-# ```'''.strip(),
-#             template_format='jinja2'
-#         )
-#         | ChatOpenAI(temperature=0).configurable_fields(
-#             temperature=ConfigurableField(
-#                 id="llm_temperature",
-#                 name="LLM Temperature",
-#                 description="The temperature of the LLM",
-#             )
-#         )
-#         | JsonOutputParser()
-#     )
-
-    
-    chain_json = (
-        # ChatPromptTemplate.from_messages([
-        #     ("system", "You are a helpful assistant"),
-        #     ("human", "Hello, how are you doing?"),
-        #     ("ai", "I'm doing well, thanks!"),
-        #     ("human", "{user_input}"),
-        # ])
-        ChatPromptTemplate.from_template(
-            # "Firstly, tell me where you are planning to make the split." is very important!!
-            '''
+```'''.strip()
+
+# "Firstly, tell me where you are planning to make the split." is very important!!
+SPLIT_PAGE_PROMPT = '''
 You are an AI assisstant thet splits long text into two parts. You have received a long text in markdown. Now you are going find the best position to split it and answer with a json. Please follow these guidelines:
 - The json should be in strict format like {"split_after": "..."} where "..." is the exact sentence right before the split position.
 - Choose the split location carefully. Make the split between the paragraphs where it appears to be a natural break in the text.
@@ -300,78 +350,61 @@ Here is the current text you are processing
 ```
 
 Answer with the strict json format:
-'''.strip(),
-            template_format='jinja2'
-        )
-        | ChatOpenAI(temperature=0).configurable_fields(
-            temperature=ConfigurableField(
-                id="llm_temperature",
-                name="LLM Temperature",
-                description="The temperature of the LLM",
-            )
-        )
-        # | JsonOutputParser(remapping={'part1': 'content', 'part2': 'ending'})
-        | JsonOutputParser()
+'''.strip()
+
+SPLIT_PAGE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "split_after": {"type": "string"},
+    },
+    "required": ["split_after"]
+}
+
+def _format_page_v0_chains():
+    client = llm_client.default_client()
+    return (
+        client.chain('format_page_v0', FORMAT_PAGE_PROMPT_V0, StrOutputParser),
+        client.chain('split_page', SPLIT_PAGE_PROMPT, functools.partial(JsonOutputParser, stop_schema=SPLIT_PAGE_SCHEMA)),
     )
 
+@simple_caching.cached_func(
+    'cache/llm_format_page',
+    fingerprint=lambda: ''.join(simple_caching.runnable_fingerprint(chain) for chain in _format_page_v0_chains()))
+async def llm_format_page_(page_text, last_page_description=None):
+    '''
+    Remove bad formats, broken lines etc..
+    returns {"content": "...", "ending": "..."} '''
+    client = llm_client.default_client()
+    chain_markdown, chain_json = _format_page_v0_chains()
 
-    cache_id = str(chain_json) + str(chain_markdown) + page_text + str(last_page_description)
-    cached_result = simple_caching.get_text_cache(cache_dir, identifier=cache_id)
-    if (cached_result is not None):
-        return json.loads(cached_result)
-
-    
-    
     answer = None
     temperature = 0.0
     emphasized_rules = ''
-    while (answer is None):
-        try:
-            insert_fyi = ''
-            if (last_page_description is not None):
-                insert_fyi = f'''For your information, here is what the previous page was about:
+    max_retries = 5
+    for _ in range(max_retries):
+        insert_fyi = ''
+        if (last_page_description is not None):
+            insert_fyi = f'''For your information, here is what the previous page was about:
 {repr(last_page_description)}
 '''
-            page_markdown = await chain_markdown.with_config({"llm_temperature": temperature}).ainvoke({
-                'page': page_text,
-                'insert_fyi': insert_fyi,
-            })
-            answer = await chain_json.with_config({"llm_temperature": 0.7}).ainvoke({
+        page_markdown = await client.invoke(chain_markdown, {
+            'page': page_text,
+            'insert_fyi': insert_fyi,
+        }, function='llm_format_page_', temperature=temperature)
+        try:
+            answer = await client.invoke(chain_json, {
                 'page': page_markdown,
                 'emphasized_rules': emphasized_rules,
-            })
-            if (answer is None):
-                # no json
-                set_debug(True)
-                logger.info(f'no valid json in LLM response, retry')
-                temperature = min(0.8, temperature + 0.2) # increase temperature
-                emphasized_rules += '- Answer with strict json format.\n'
-                continue
-            
-            # jsonschema.validate(answer, {
-            #     "type": "object",
-            #     "properties": {
-            #         "content": {"type": "string"},
-            #         "ending": {"type": "string"}
-            #     },
-            #     "required": ["content", "ending"]
-            # })
-            jsonschema.validate(answer, {
-                "type": "object",
-                "properties": {
-                    "split_after": {"type": "string"},
-                },
-                "required": ["split_after"]
-            })
-
-        except Exception:
-            import traceback
-            traceback.print_exc()
-            answer = None
+            }, function='llm_format_page_', temperature=0.7,
+               validate=lambda answer: jsonschema.validate(answer, SPLIT_PAGE_SCHEMA), max_attempts=2, stream=True)
+        except llm_client.LLMError:
+            # no json
+            set_debug(True)
+            logger.info(f'no valid json in LLM response, retry')
             temperature = min(0.8, temperature + 0.2) # increase temperature
             emphasized_rules += '- Answer with strict json format.\n'
             continue
-        
+
         logger.debug(f'Original page:')
         logger.debug(page_text)
         logger.debug(f'LLM markdown response {page_markdown}')
@@ -383,31 +416,14 @@ Answer with the strict json format:
             temperature = min(0.8, temperature + 0.2)
             emphasized_rules += '- Make the split_after text brief and explicit.\n'
             continue
-        
-        split_index = page_markdown.find(answer['split_after']) + len(answer['split_after'])
-        answer = {'content': page_markdown[:split_index], 'ending': page_markdown[split_index:]}
 
-        # len_after = count_non_whitespace_characters(answer['content']) + count_non_whitespace_characters(answer['ending'])
-        # logger.info(f'LLM format page: {len_before} -> {len_after}')
-        # if (len_before - len_after > 40 and len_after / len_before < 0.9):
-        #     # too short, something is wrong
-        #     logger.info(f'LLM is shrinking the page too much, retry')
-        #     answer = None
-        #     temperature = min(0.8, temperature + 0.2)
-    
-    simple_caching.save_text_cache(cache_dir, identifier=cache_id, text=json.dumps(answer))
-    return answer
+        split_index = page_markdown.find(answer['split_after']) + len(answer['split_after'])
+        return {'content': page_markdown[:split_index], 'ending': page_markdown[split_index:]}
 
+    raise llm_client.LLMError(f'llm_format_page_: no valid split after {max_retries} attempts')
 
-async def llm_format_page(page_text, last_page_description=None):
-    cache_dir = 'cache/llm_format_page'
-    ''' 
-    Remove bad formats, broken lines etc..
-    returns {"content": "...", "ending": "..."} '''
 
-    chain_markdown = (
-        ChatPromptTemplate.from_template(
-            '''
+FORMAT_PAGE_PROMPT = '''
 You are a book editor. You have received a manuscript that contains broken formats and some irrelevant text. Now you are going to turn it into standard markdown format. Please follow these guidelines:
 - Remove nonsense characters and page numbers.
 - In your formatted markdown, remove inappropriate line breaks within sentences.
@@ -419,24 +435,21 @@ You are a book editor. You have received a manuscript that contains broken forma
 Here is the current page you are processing
 ```
 {{ page }}
-```'''.strip(),
-            template_format='jinja2'
-        )
-        | ChatOpenAI(temperature=0).configurable_fields(
-            temperature=ConfigurableField(
-                id="llm_temperature",
-                name="LLM Temperature",
-                description="The temperature of the LLM",
-            )
-        )
-        | StrOutputParser()
-    )
+```'''.strip()
 
+def _format_page_chain():
+    return llm_client.default_client().chain('format_page', FORMAT_PAGE_PROMPT, StrOutputParser)
 
-    cache_id = str(chain_markdown) + page_text + str(last_page_description)
-    cached_result = simple_caching.get_text_cache(cache_dir, identifier=cache_id)
-    if (cached_result is not None):
-        return json.loads(cached_result)
+@simple_caching.cached_func(
+    'cache/llm_format_page',
+    fingerprint=lambda: simple_caching.runnable_fingerprint(_format_page_chain()))
+async def llm_format_page(page_text, last_page_description=None):
+    '''
+    Remove bad formats, broken lines etc..
+    returns {"content": "...", "ending": "..."}
+    raises llm_client.LLMError if the LLM stays unavailable '''
+    client = llm_client.default_client()
+    chain_markdown = _format_page_chain()
 
     answer = None
     temperature = 0.0
@@ -446,44 +459,39 @@ Here is the current page you are processing
     while (answer is None):
 
         num_retries += 1
+        if (num_retries > 1):
+            count_retry('llm_format_page')
         if (num_retries > max_retries):
             logger.warning(f'max retries reached, fall back to raw text')
-            answer = page_text
+            answer = {'content': page_text, 'ending': ''}
             break
 
-        try:
-            insert_fyi = ''
-            if (last_page_description is not None):
-                insert_fyi = f'''For your information, here is what the previous page was about:
+        insert_fyi = ''
+        if (last_page_description is not None):
+            insert_fyi = f'''For your information, here is what the previous page was about:
 {repr(last_page_description)}
 '''
-            page_markdown = await chain_markdown.with_config({"llm_temperature": temperature}).ainvoke({
-                'page': page_text,
-                'emphasized_rules': emphasized_rules,
-                'insert_fyi': insert_fyi,
-            })
-
-            # check text length
-            len_before = count_non_whitespace_characters(page_text)
-            len_after = count_non_whitespace_characters(page_markdown)
-            logger.info(f'LLM format page: {len_before} -> {len_after}')
-            if (len_before - len_after > 40 and len_after / len_before < 0.9):
-                # too short, something is wrong
-                logger.info(f'LLM is shrinking the page too much, retry')
-                answer = None
-                temperature = min(0.8, temperature + 0.2)
-                emphasized_rules += '- Make sure you process the full text that is given to you. Do not miss anything.\n'
-
-            answer = page_markdown
-
-        except Exception:
-            import traceback
-            traceback.print_exc()
+        # connection errors and rate limits are retried by the client, with backoff
+        page_markdown = await client.invoke(chain_markdown, {
+            'page': page_text,
+            'emphasized_rules': emphasized_rules,
+            'insert_fyi': insert_fyi,
+        }, function='llm_format_page', temperature=temperature)
+
+        # check text length
+        len_before = count_non_whitespace_characters(page_text)
+        len_after = count_non_whitespace_characters(page_markdown)
+        logger.info(f'LLM format page: {len_before} -> {len_after}')
+        if (len_before - len_after > 40 and len_after / len_before < 0.9):
+            # too short, something is wrong
+            logger.info(f'LLM is shrinking the page too much, retry')
             answer = None
-            temperature = min(0.8, temperature + 0.2) # increase temperature
-            emphasized_rules += '- Answer with strict json format.\n'
+            temperature = min(0.8, temperature + 0.2)
+            emphasized_rules += '- Make sure you process the full text that is given to you. Do not miss anything.\n'
             continue
-        
+
+        answer = page_markdown
+
         logger.debug(f'Original page:')
         logger.debug(page_text)
         logger.debug(f'LLM markdown response:')
@@ -501,26 +509,63 @@ Here is the current page you are processing
         split_index = index_for_occurrence(answer, '\n', num_breaks // 2)
         
         answer = {'content': page_markdown[:split_index], 'ending': page_markdown[split_index:]}
-    
-    simple_caching.save_text_cache(cache_dir, identifier=cache_id, text=json.dumps(answer))
+
     return answer
 
 
 
-async def iterate_refined_pdf_pages(pdf_path, page_range: Container[int]=None):
+def _format_or_keep(min_confidence: float):
+    ''' llm_format_page, except for pages the heuristics already got right (see pdf_heuristics.page_confidence) '''
+    async def format_page(page_text, last_page_description=None):
+        if (pdf_heuristics.page_confidence(page_text) >= min_confidence):
+            _PAGES.inc(route='heuristic')
+            return {'content': page_text.strip('\n'), 'ending': '', 'skipped': True}
+        _PAGES.inc(route='llm')
+        return await llm_format_page(page_text, last_page_description)
+    return format_page
+
+async def iterate_refined_pdf_pages(pdf_path, page_range: Container[int]=None, *, chapters=None,
+                                    concurrency: int=1, shard_pages: int=8, overlap: int=1,
+                                    heuristics: bool=False, min_confidence: float=0.9):
+    ''' refined pages in order, then the text left over after the last one
+
+    concurrency > 1 refines shards of shard_pages pages in parallel with up to concurrency LLM calls
+    at once, and summarizes a page while the next one is formatted (see concurrent_refine.py)
+
+    heuristics=True cleans the pages locally first (headers, footers, page numbers, line breaks,
+    see pdf_heuristics.py), only pages with a confidence below min_confidence go to the LLM
+
+    chapters: chapter numbers / titles to refine (see pdf_index.py), only their pages are read '''
+    profiling.ensure_monitor()
+    page_range = pdf_index.resolve_page_range(pdf_path, page_range, chapters)
+    pages = pdf_text.extract_text_from_pdf(pdf_path, page_range)
+    format_page = llm_format_page
+    if (heuristics):
+        pages = (page.text for page in pdf_heuristics.clean_pages(pages))
+        format_page = _format_or_keep(min_confidence)
+    if (concurrency > 1):
+        async for page in concurrent_refine.iterate_refined_pages(
+                prefetch_in_thread(pages),
+                format_page=format_page, summarize_page=llm_summarize_page,
+                concurrency=concurrency, shard_pages=shard_pages, overlap=overlap):
+            yield page
+        return
     page_cache = ''
     last_page_description = None
-    for page in pdf_text.extract_text_from_pdf(pdf_path, page_range):
+    async for page in prefetch_in_thread(pages):
         page_cache += '\n' + page
-        llm_format = await llm_format_page(page_cache, last_page_description)
+        llm_format = await format_page(page_cache, last_page_description)
         page_cache = llm_format['ending']
         page_formated = llm_format['content']
-        last_page_description = await llm_summarize_page(page_formated)
+        if (not llm_format.get('skipped')):
+            last_page_description = await llm_summarize_page(page_formated)
         yield page_formated
     yield page_cache
 
-async def refined_pdf_gen(pdf_path: str, voice: str, page_range: Container[int]=None):
-    async for page in iterate_refined_pdf_pages(pdf_path, page_range):
+async def refined_pdf_gen(pdf_path: str, voice: str, page_range: Container[int]=None, *, chapters=None,
+                          concurrency: int=1, heuristics: bool=False):
+    async for page in iterate_refined_pdf_pages(pdf_path, page_range, chapters=chapters,
+                                                concurrency=concurrency, heuristics=heuristics):
         logger.info('Refined page')
         logger.info(page)
         for line in page.split('\n'):
@@ -551,7 +596,8 @@ async def atest():
     #             pdf_text.extract_text_from_pdf('test.pdf', page_range=[3, 5])
     #         ),
     #         context_size=5
-    #     )
+    #     ),
+    #     batch_size=20
     # )
     # with open('log.txt', 'w', encoding='utf-8') as f:
     #     async for line, line_type in agen:
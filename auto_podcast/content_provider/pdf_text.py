@@ -1,20 +1,145 @@
 
+import PyPDF2
 from PyPDF2 import PdfReader
 
-from typing import Container
+from typing import Container, Dict, Iterator, List, Optional, Tuple
+import collections
+import hashlib
+import os
+import logging
 
 from ..audio_builder.segments import *
+from ..audio_builder import offload
+from .. import kv_cache
+from .prefetch import prefetch_in_thread
+from . import pdf_heuristics
 
-def extract_text_from_pdf(pdf_path: str, page_range: Container[int]=None):
+logger = logging.getLogger(__name__)
+
+# extracted page texts, shared by all runs
+PAGE_CACHE_NAMESPACE = 'pdf_pages'
+
+# (path, size, mtime) -> sha256 of the file
+_file_hashes: Dict[Tuple[str, int, float], str] = {}
+
+def file_hash(pdf_path: str) -> str:
+    st = os.stat(pdf_path)
+    stamp = (os.path.abspath(pdf_path), st.st_size, st.st_mtime)
+    if (stamp not in _file_hashes):
+        digest = hashlib.sha256()
+        with open(pdf_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        _file_hashes[stamp] = digest.hexdigest()
+    return _file_hashes[stamp]
+
+def _page_key(digest: str, page: int) -> str:
+    # another PyPDF2 version may extract the text differently
+    return f'{digest}:{page}:{PyPDF2.__version__}'
+
+def _extract_pages(pdf_path: str, pages: List[int]) -> List[str]:
+    ''' runs in the offload workers, every chunk parses the file on its own '''
     reader = PdfReader(pdf_path)
-    # print(len(reader.pages))
-    for i, page in enumerate(reader.pages):
-        if (page_range is not None and i not in page_range):
-            continue
-        yield page.extract_text()
-
-async def plain_pdf_gen(pdf_path: str, voice: str, page_range: Container[int]=None):
-    for page in extract_text_from_pdf(pdf_path, page_range):
+    return [reader.pages[i].extract_text() for i in pages]
+
+def _count_pages(pdf_path: str) -> int:
+    return len(PdfReader(pdf_path).pages)
+
+def extract_text_from_pdf(pdf_path: str, page_range: Container[int]=None, *,
+                          cache: bool=True, chunk_pages: int=8, prefetch_chunks: Optional[int]=None) -> Iterator[str]:
+    '''
+    text of every page in page_range, in order
+
+    pages are extracted in chunks of chunk_pages by the offload pool (see audio_builder/offload.py,
+    offload.configure(0) extracts inline), up to prefetch_chunks chunks (default: one per worker
+    plus one) ahead of the consumer.
+    with cache=True the texts are kept in the kv cache, keyed by the file content, the page and the
+    PyPDF2 version: a page that was extracted once, in any page range, is never parsed again
+    '''
+    store = kv_cache.default_cache() if cache else None
+    digest = file_hash(pdf_path) if cache else ''
+
+    count = None
+    if (store is not None):
+        cached_count = store.get_text(PAGE_CACHE_NAMESPACE, f'{digest}:pages')
+        count = int(cached_count) if cached_count is not None else None
+    if (count is None):
+        count = _count_pages(pdf_path)
+        if (store is not None):
+            store.put_text(PAGE_CACHE_NAMESPACE, f'{digest}:pages', str(count))
+    pages = [i for i in range(count) if page_range is None or i in page_range]
+
+    texts: Dict[int, str] = {}
+    missing = pages
+    if (store is not None):
+        missing = []
+        for i in pages:
+            text = store.get_text(PAGE_CACHE_NAMESPACE, _page_key(digest, i))
+            if (text is None):
+                missing.append(i)
+            else:
+                texts[i] = text
+    if (len(missing) < len(pages)):
+        logger.debug(f'{pdf_path}: {len(pages) - len(missing)} of {len(pages)} pages cached')
+
+    executor = offload.get_executor()
+    chunks = [missing[k:k + chunk_pages] for k in range(0, len(missing), chunk_pages)]
+    if (prefetch_chunks is None):
+        prefetch_chunks = getattr(executor, '_max_workers', 1) + 1
+    # page -> chunk number
+    chunk_of = {i: n for n, chunk in enumerate(chunks) for i in chunk}
+    running = collections.OrderedDict() # chunk number -> future
+    submitted = 0
+
+    def submit_ahead(current: int):
+        nonlocal submitted
+        while (submitted < len(chunks) and submitted < current + prefetch_chunks):
+            running[submitted] = executor.submit(_extract_pages, pdf_path, chunks[submitted])
+            submitted += 1
+
+    try:
+        for i in pages:
+            if (i not in texts):
+                n = chunk_of[i]
+                if (executor is None):
+                    results = _extract_pages(pdf_path, chunks[n])
+                else:
+                    submit_ahead(n)
+                    results = running.pop(n).result()
+                    submit_ahead(n + 1)
+                for page, text in zip(chunks[n], results):
+                    texts[page] = text
+                    if (store is not None):
+                        store.put_text(PAGE_CACHE_NAMESPACE, _page_key(digest, page), text)
+            yield texts.pop(i)
+    finally:
+        # consumer stopped early
+        for future in running.values():
+            future.cancel()
+
+async def plain_pdf_gen(pdf_path: str, voice: str, page_range: Container[int]=None, *, chapters=None,
+                        heuristics: bool=False):
+    ''' heuristics=True removes headers, footers and page numbers and reads paragraphs
+    instead of PDF lines (see pdf_heuristics.py)
+
+    chapters: chapter numbers / titles to read, e.g. [2, 'Epilogue'] (see pdf_index.py),
+    only their pages are extracted. with page_range too, the pages in both are read '''
+    if (chapters is not None):
+        from . import pdf_index
+        page_range = pdf_index.resolve_page_range(pdf_path, page_range, chapters)
+    if (heuristics):
+        async for page in prefetch_in_thread(pdf_heuristics.clean_pages(extract_text_from_pdf(pdf_path, page_range))):
+            for paragraph in page.text.split('\n'):
+                if (paragraph.strip() == ''):
+                    continue
+                yield TextSegment(
+                    paragraph.lstrip('# ').strip(),
+                    voice,
+                )
+                yield WhiteSpace(1.0)
+        return
+    # PyPDF2 is blocking, parse in a thread a few pages ahead
+    async for page in prefetch_in_thread(extract_text_from_pdf(pdf_path, page_range)):
         for line in page.split('\n'):
             if (line.strip() == ''):
                 # new paragraph
@@ -0,0 +1,54 @@
+
+import asyncio
+import threading
+import logging
+
+from typing import AsyncGenerator, Iterable, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+_DONE = object()
+
+
+async def prefetch_in_thread(iterable: Iterable[T], *, prefetch: int=4) -> AsyncGenerator[T, None]:
+    '''
+    iterate a blocking iterable (e.g. PyPDF2 page extraction) in a background thread,
+    staying up to `prefetch` items ahead of the consumer. the event loop only awaits the queue.
+    '''
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def put(item):
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    def produce():
+        try:
+            for item in iterable:
+                if (stop.is_set()):
+                    return
+                put((item, None))
+        except BaseException as e:
+            put((_DONE, e))
+            return
+        put((_DONE, None))
+
+    thread = threading.Thread(target=produce, name='prefetch', daemon=True)
+    thread.start()
+    try:
+        while (True):
+            item, error = await queue.get()
+            if (item is _DONE):
+                if (error is not None):
+                    raise error
+                break
+            yield item
+    finally:
+        # consumer stopped early: unblock the producer and let it exit
+        stop.set()
+        while (thread.is_alive()):
+            while (not queue.empty()):
+                queue.get_nowait()
+            await asyncio.sleep(0.01)
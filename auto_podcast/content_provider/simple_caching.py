@@ -1,35 +1,160 @@
 
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Optional,
+    Union,
+)
+
+import asyncio
+import functools
 import os
 import hashlib
+import json
+import time
 import logging
 
+from .. import kv_cache
+
 logger = logging.getLogger(__name__)
 
+def _namespace(temp_path: str) -> str:
+    ''' cache/llm_format_page -> llm_format_page '''
+    return os.path.basename(os.path.normpath(temp_path))
+
 def calculate_md5(input_string):
     md5_hash = hashlib.md5()
     md5_hash.update(input_string.encode('utf-8'))
     md5_hex = md5_hash.hexdigest()
     return md5_hex
 
+def _legacy_text_cache(temp_path: str, key: str):
+    ''' entry of the old one-file-per-entry layout (temp_path/<md5>.txt), if there is one '''
+    fpath = os.path.join(temp_path, key + '.txt')
+    if (not os.path.isfile(fpath)):
+        return None
+    with open(fpath, 'r', encoding='utf-8') as f:
+        return f.read()
+
 def get_text_cache(temp_path: str, identifier: str):
-    if (os.path.isdir(temp_path)):
-        fname = calculate_md5(identifier) + '.txt'
-        fpath = os.path.join(temp_path, fname)
-        if (os.path.isfile(fpath)):
-            with open(fpath, 'r', encoding='utf-8') as f:
-                return f.read()
-    return None
+    ''' temp_path names the cache (its last path component is the namespace in the kv cache) '''
+    cache = kv_cache.default_cache()
+    key = calculate_md5(identifier)
+    text = cache.get_text(_namespace(temp_path), key)
+    if (text is None):
+        # carried over from the file layout once, the files can be deleted afterwards
+        text = _legacy_text_cache(temp_path, key)
+        if (text is not None):
+            cache.put_text(_namespace(temp_path), key, text)
+    return text
 
 def save_text_cache(temp_path: str, identifier: str, text: str):
-    os.makedirs(temp_path, exist_ok=True)
-    fname = calculate_md5(identifier) + '.txt'
-    fpath = os.path.join(temp_path, fname)
-    if (os.path.exists(fpath)):
-        logger.warn(f'possible cache hash collision for {fpath}')
-    with open(fpath, 'w', encoding='utf-8') as f:
-        f.write(text)
-
-# def cached_func(temp_path: str):
-#     def wrapper(fn):
-#         pass
-#     return wrapper
+    kv_cache.default_cache().put_text(_namespace(temp_path), calculate_md5(identifier), text)
+
+def runnable_fingerprint(runnable) -> str:
+    ''' stable hash of what determines a langchain chain's answer: prompt templates, model names, step types.
+    runtime configuration (temperature, callbacks) is not part of it.
+    meant to be computed once per chain, str(chain) serializes the whole object graph '''
+    parts = []
+    def walk(r):
+        steps = getattr(r, 'steps', None) # RunnableSequence
+        if (steps is not None):
+            for step in steps:
+                walk(step)
+            return
+        default = getattr(r, 'default', None) # configurable_fields / configurable_alternatives
+        if (default is not None and hasattr(default, 'invoke')):
+            walk(default)
+            return
+        parts.append(type(r).__name__)
+        for message in getattr(r, 'messages', None) or []:
+            template = getattr(getattr(message, 'prompt', None), 'template', None)
+            if (isinstance(template, str)):
+                parts.append(template)
+        for attr in ('template', 'model_name', 'model'):
+            value = getattr(r, attr, None)
+            if (isinstance(value, str)):
+                parts.append(value)
+    walk(runnable)
+    return calculate_md5(json.dumps(parts, ensure_ascii=False))
+
+def cached_func(temp_path: str, *, version: int=1, ttl: Optional[float]=None,
+                fingerprint: Union[str, Callable[[], str], None]=None,
+                key: Optional[Callable[..., Any]]=None):
+    ''' memoize an async function in the text cache named temp_path
+
+    results are stored as json, the arguments (or key(*args, **kwargs)) identify an entry.
+    concurrent calls with the same arguments share one call of fn. exceptions and None are not cached.
+
+    version: bump to invalidate every entry written by older code
+    ttl: seconds an entry stays valid, None for no expiry
+    fingerprint: identifies what else the result depends on (prompt, model), a string or a
+        function called once on first use, e.g. lambda: runnable_fingerprint(chain)
+
+    the wrapper has .invalidate(*args, **kwargs) to drop one entry
+    '''
+    def wrapper(fn):
+        inflight: Dict[str, asyncio.Future] = {}
+        resolved = []
+
+        def cache_key(*args, **kwargs) -> str:
+            if (len(resolved) == 0):
+                resolved.append(fingerprint() if callable(fingerprint) else fingerprint)
+            identifier = key(*args, **kwargs) if key is not None else [args, kwargs]
+            return calculate_md5(json.dumps(
+                [fn.__qualname__, version, resolved[0], identifier], ensure_ascii=False, sort_keys=True, default=str))
+
+        def lookup(cache_id: str):
+            text = kv_cache.default_cache().get_text(_namespace(temp_path), cache_id)
+            if (text is None):
+                return None
+            entry = json.loads(text)
+            if (ttl is not None and time.time() - entry['created'] > ttl):
+                return None
+            return entry
+
+        @functools.wraps(fn)
+        async def cached(*args, **kwargs):
+            cache_id = cache_key(*args, **kwargs)
+            entry = lookup(cache_id)
+            if (entry is not None):
+                return entry['value']
+            while (cache_id in inflight):
+                # identical call already running
+                leader = inflight[cache_id]
+                try:
+                    return await asyncio.shield(leader)
+                except asyncio.CancelledError:
+                    if (not leader.cancelled()):
+                        raise
+                    # the running call was cancelled, not us. do it ourselves
+
+            future = asyncio.get_running_loop().create_future()
+            inflight[cache_id] = future
+            try:
+                value = await fn(*args, **kwargs)
+            except Exception as e:
+                future.set_exception(e)
+                future.exception() # retrieved, waiters (if any) get it re-raised
+                raise
+            except BaseException:
+                future.cancel()
+                raise
+            else:
+                if (value is not None):
+                    kv_cache.default_cache().put_text(
+                        _namespace(temp_path), cache_id,
+                        json.dumps({'created': time.time(), 'value': value}, ensure_ascii=False))
+                future.set_result(value)
+                return value
+            finally:
+                del inflight[cache_id]
+
+        def invalidate(*args, **kwargs) -> bool:
+            return kv_cache.default_cache().delete(_namespace(temp_path), cache_key(*args, **kwargs))
+
+        cached.invalidate = invalidate
+        cached.cache_key = cache_key
+        return cached
+    return wrapper
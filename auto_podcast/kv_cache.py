@@ -0,0 +1,325 @@
+
+"""
+
+KV Cache
+
+a size-bounded key-value cache for everything the pipeline memoizes:
+LLM answers (content_provider/simple_caching.py) and audio artifacts
+(audio_builder/segment_cache.py, KVSegmentCache).
+
+- one SQLite file (cache/cache.sqlite by default) instead of one file per entry.
+  every write is a transaction, a crash never leaves a truncated entry
+- namespaces: entries of different callers never collide and can be cleared separately
+- binary values, text helpers on top; optional zlib compression of larger values
+- an in-process LRU tier in front of SQLite for hot entries
+- a size cap over all namespaces, the least recently used entries are evicted
+
+the backend is pluggable, anything implementing CacheBackend can be installed with set_default_cache().
+
+"""
+
+from typing import (
+    Dict,
+    Iterator,
+    Optional,
+    Tuple,
+)
+
+import collections
+import os
+import sqlite3
+import threading
+import time
+import zlib
+import logging
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_CACHE_FILE = 'cache/cache.sqlite'
+
+# own names: KVSegmentCache counts its lookups as cache_requests_total already, one layer up
+_REQUESTS = metrics.counter('kv_cache_requests_total', 'kv cache reads by namespace and result: hit, miss')
+_EVICTIONS = metrics.counter('kv_cache_evictions_total', 'kv cache entries evicted to stay under the size cap, by namespace')
+
+
+class CacheBackend():
+    ''' the interface simple_caching and KVSegmentCache rely on '''
+
+    def get(self, namespace: str, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def put(self, namespace: str, key: str, value: bytes):
+        raise NotImplementedError
+
+    def delete(self, namespace: str, key: str) -> bool:
+        raise NotImplementedError
+
+    def contains(self, namespace: str, key: str) -> bool:
+        return self.get(namespace, key) is not None
+
+    def keys(self, namespace: str) -> Iterator[str]:
+        raise NotImplementedError
+
+    def get_text(self, namespace: str, key: str) -> Optional[str]:
+        value = self.get(namespace, key)
+        return None if value is None else value.decode('utf-8')
+
+    def put_text(self, namespace: str, key: str, text: str):
+        self.put(namespace, key, text.encode('utf-8'))
+
+    def namespace(self, name: str) -> 'Namespace':
+        return Namespace(self, name)
+
+    def report(self) -> dict:
+        return {}
+
+    def close(self):
+        pass
+
+
+class Namespace():
+    ''' a backend bound to one namespace '''
+
+    def __init__(self, backend: CacheBackend, name: str):
+        self.backend = backend
+        self.name = name
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.backend.get(self.name, key)
+
+    def put(self, key: str, value: bytes):
+        self.backend.put(self.name, key, value)
+
+    def delete(self, key: str) -> bool:
+        return self.backend.delete(self.name, key)
+
+    def get_text(self, key: str) -> Optional[str]:
+        return self.backend.get_text(self.name, key)
+
+    def put_text(self, key: str, text: str):
+        self.backend.put_text(self.name, key, text)
+
+    def __contains__(self, key: str) -> bool:
+        return self.backend.contains(self.name, key)
+
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL, -- stored bytes
+    compressed INTEGER NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL,
+    PRIMARY KEY (namespace, key)
+);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries(accessed);
+'''
+
+
+class KVCache(CacheBackend):
+
+    def __init__(self, path: str=DEFAULT_CACHE_FILE, *, max_bytes: int=4 * 1024 ** 3,
+                 memory_items: int=1024, memory_bytes: int=64 * 1024 ** 2,
+                 compress: bool=True, compress_min_bytes: int=1024):
+        '''
+        max_bytes: cap of the stored (compressed) values of all namespaces
+        memory_items / memory_bytes: bounds of the in-process LRU tier, 0 disables it
+        compress: zlib values of at least compress_min_bytes, if that makes them smaller
+        '''
+        self.path = path
+        self.max_bytes = max_bytes
+        self.memory_items = memory_items
+        self.memory_bytes = memory_bytes
+        self.compress = compress
+        self.compress_min_bytes = compress_min_bytes
+        self.stats = collections.Counter()
+
+        if (os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # shared by the loop thread and the prefetch / offload threads
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(_SCHEMA)
+        self._total_bytes = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        # (namespace, key) -> value, least recently used first
+        self._memory: 'collections.OrderedDict[Tuple[str, str], bytes]' = collections.OrderedDict()
+        self._memory_used = 0
+        # hits served from memory, their access time is written with the next write
+        self._touched: Dict[Tuple[str, str], float] = {}
+
+    def _remember(self, item: Tuple[str, str], value: bytes):
+        if (self.memory_items <= 0 or len(value) > self.memory_bytes // 4):
+            return
+        if (item in self._memory):
+            self._memory_used -= len(self._memory.pop(item))
+        self._memory[item] = value
+        self._memory_used += len(value)
+        while (len(self._memory) > self.memory_items or self._memory_used > self.memory_bytes):
+            _, old = self._memory.popitem(last=False)
+            self._memory_used -= len(old)
+
+    def _forget(self, item: Tuple[str, str]):
+        if (item in self._memory):
+            self._memory_used -= len(self._memory.pop(item))
+
+    def get(self, namespace: str, key: str) -> Optional[bytes]:
+        item = (namespace, key)
+        with self._lock:
+            value = self._memory.get(item)
+            if (value is not None):
+                self._memory.move_to_end(item)
+                self._touched[item] = time.time()
+                self.stats['memory_hits'] += 1
+                _REQUESTS.inc(cache=namespace, result='hit')
+                return value
+            row = self._conn.execute(
+                'SELECT value, compressed FROM entries WHERE namespace = ? AND key = ?', item).fetchone()
+            if (row is None):
+                self.stats['misses'] += 1
+                _REQUESTS.inc(cache=namespace, result='miss')
+                return None
+            self._conn.execute(
+                'UPDATE entries SET accessed = ? WHERE namespace = ? AND key = ?', (time.time(), namespace, key))
+            value = zlib.decompress(row[0]) if row[1] else bytes(row[0])
+            self._remember(item, value)
+            self.stats['disk_hits'] += 1
+            _REQUESTS.inc(cache=namespace, result='hit')
+            return value
+
+    def contains(self, namespace: str, key: str) -> bool:
+        ''' no stats, no LRU update '''
+        with self._lock:
+            if ((namespace, key) in self._memory):
+                return True
+            return self._conn.execute(
+                'SELECT 1 FROM entries WHERE namespace = ? AND key = ?', (namespace, key)).fetchone() is not None
+
+    def put(self, namespace: str, key: str, value: bytes):
+        value = bytes(value)
+        stored, compressed = value, 0
+        if (self.compress and len(value) >= self.compress_min_bytes):
+            packed = zlib.compress(value, 6)
+            if (len(packed) < len(value)):
+                stored, compressed = packed, 1
+        now = time.time()
+        with self._lock:
+            self._flush_touched()
+            old = self._conn.execute(
+                'SELECT size FROM entries WHERE namespace = ? AND key = ?', (namespace, key)).fetchone()
+            self._conn.execute(
+                'INSERT OR REPLACE INTO entries (namespace, key, value, size, compressed, created, accessed) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (namespace, key, sqlite3.Binary(stored), len(stored), compressed, now, now))
+            self._total_bytes += len(stored) - (old[0] if old else 0)
+            self._remember((namespace, key), value)
+            self.stats['puts'] += 1
+            self._evict()
+
+    def delete(self, namespace: str, key: str) -> bool:
+        with self._lock:
+            self._forget((namespace, key))
+            row = self._conn.execute(
+                'SELECT size FROM entries WHERE namespace = ? AND key = ?', (namespace, key)).fetchone()
+            if (row is None):
+                return False
+            self._conn.execute('DELETE FROM entries WHERE namespace = ? AND key = ?', (namespace, key))
+            self._total_bytes -= row[0]
+            return True
+
+    def clear(self, namespace: Optional[str]=None):
+        ''' drop one namespace, or everything '''
+        with self._lock:
+            if (namespace is None):
+                self._conn.execute('DELETE FROM entries')
+                self._memory.clear()
+                self._memory_used = 0
+            else:
+                self._conn.execute('DELETE FROM entries WHERE namespace = ?', (namespace,))
+                for item in [i for i in self._memory if i[0] == namespace]:
+                    self._forget(item)
+            self._total_bytes = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def keys(self, namespace: str) -> Iterator[str]:
+        with self._lock:
+            rows = self._conn.execute('SELECT key FROM entries WHERE namespace = ?', (namespace,)).fetchall()
+        return (row[0] for row in rows)
+
+    def _flush_touched(self):
+        if (len(self._touched) > 0):
+            self._conn.executemany(
+                'UPDATE entries SET accessed = ? WHERE namespace = ? AND key = ?',
+                [(t, ns, key) for (ns, key), t in self._touched.items()])
+            self._touched.clear()
+
+    def _evict(self):
+        if (self._total_bytes <= self.max_bytes):
+            return
+        # down to 90% of the cap, so eviction doesn't run on every put
+        target = self.max_bytes * 0.9
+        newest = self._conn.execute('SELECT MAX(accessed) FROM entries').fetchone()[0]
+        rows = self._conn.execute(
+            'SELECT namespace, key, size FROM entries WHERE accessed < ? ORDER BY accessed', (newest,))
+        victims = []
+        freed = 0
+        for namespace, key, size in rows:
+            if (self._total_bytes - freed <= target):
+                break
+            victims.append((namespace, key))
+            freed += size
+        self._conn.execute('BEGIN')
+        self._conn.executemany('DELETE FROM entries WHERE namespace = ? AND key = ?', victims)
+        self._conn.execute('COMMIT')
+        self._total_bytes -= freed
+        for namespace, key in victims:
+            self._forget((namespace, key))
+            _EVICTIONS.inc(cache=namespace)
+        self.stats['evictions'] += len(victims)
+        logger.debug(f'evicted {len(victims)} entries ({freed} bytes) from {self.path}')
+
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    def report(self) -> dict:
+        with self._lock:
+            namespaces = self._conn.execute(
+                'SELECT namespace, COUNT(*), SUM(size) FROM entries GROUP BY namespace').fetchall()
+        return {
+            **self.stats,
+            'total_bytes': self._total_bytes,
+            'max_bytes': self.max_bytes,
+            'memory_items': len(self._memory),
+            'memory_bytes': self._memory_used,
+            'namespaces': {ns: {'entries': n, 'bytes': size} for ns, n, size in namespaces},
+        }
+
+    def close(self):
+        with self._lock:
+            self._flush_touched()
+            self._conn.close()
+
+
+_default: Optional[CacheBackend] = None
+_default_lock = threading.Lock()
+
+def default_cache() -> CacheBackend:
+    ''' the shared backend, a KVCache at DEFAULT_CACHE_FILE unless set_default_cache() installed another '''
+    global _default
+    with _default_lock:
+        if (_default is None):
+            _default = KVCache(DEFAULT_CACHE_FILE)
+        return _default
+
+def set_default_cache(backend: Optional[CacheBackend]):
+    ''' install a backend (e.g. KVCache('other.sqlite', max_bytes=...)), None resets to the default '''
+    global _default
+    with _default_lock:
+        if (_default is not None and _default is not backend):
+            _default.close()
+        _default = backend
@@ -0,0 +1,417 @@
+
+"""
+
+Metrics
+
+in-process counters, gauges and histograms shared by the audio builder and
+the content providers, so a slow run shows where the time goes (LLM, edge-tts,
+post-processing, ffmpeg) instead of only debug logs.
+
+    from .. import metrics
+    metrics.counter('llm_retries_total', 'LLM calls retried').inc(function='llm_format_page')
+    with metrics.timer('tts_seconds', 'one edge-tts request'):
+        ...
+
+exported as a json snapshot (snapshot()) or Prometheus text (to_prometheus()),
+summary() condenses one run into the numbers worth reading.
+no dependencies, values recorded in offload worker processes are not seen here,
+time those stages around the offload call instead.
+
+"""
+
+from typing import (
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+import bisect
+import contextlib
+import json
+import math
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+# seconds, from a cache lookup to a long LLM call
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _key(labels: Dict[str, object]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _format_labels(key: LabelKey, extra: Optional[Tuple[str, str]]=None) -> str:
+    items = list(key) + ([extra] if extra else [])
+    if (len(items) == 0):
+        return ''
+    escaped = [(k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in items]
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+def _format_value(value: float) -> str:
+    if (math.isinf(value)):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric():
+
+    kind = ''
+
+    def __init__(self, name: str, help: str, lock: threading.Lock):
+        self.name = name
+        self.help = help
+        self._lock = lock
+        self._values: Dict[LabelKey, object] = {}
+
+    def label_sets(self) -> List[LabelKey]:
+        with self._lock:
+            return list(self._values)
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(_Metric):
+    ''' monotonically increasing total '''
+
+    kind = 'counter'
+
+    def inc(self, amount: float=1.0, **labels):
+        key = _key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(_key(labels), 0.0)
+
+    def total(self, **labels) -> float:
+        ''' sum over every label set matching the given labels '''
+        want = set(_key(labels))
+        with self._lock:
+            return sum(v for k, v in self._values.items() if want <= set(k))
+
+    def to_dict(self) -> list:
+        with self._lock:
+            return [{'labels': dict(k), 'value': v} for k, v in self._values.items()]
+
+    def prometheus_lines(self) -> Iterator[str]:
+        for k, v in sorted(self._values.items()):
+            yield f'{self.name}{_format_labels(k)} {_format_value(v)}'
+
+
+class Gauge(Counter):
+    ''' a value that goes up and down, remembers its peak '''
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, help: str, lock: threading.Lock):
+        super().__init__(name, help, lock)
+        self._peaks: Dict[LabelKey, float] = {}
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._set(_key(labels), value)
+
+    def _set(self, key: LabelKey, value: float):
+        self._values[key] = value
+        self._peaks[key] = max(self._peaks.get(key, value), value)
+
+    def inc(self, amount: float=1.0, **labels):
+        key = _key(labels)
+        with self._lock:
+            self._set(key, self._values.get(key, 0.0) + amount)
+
+    def dec(self, amount: float=1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def peak(self, **labels) -> float:
+        return self._peaks.get(_key(labels), 0.0)
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+            self._peaks.clear()
+
+    def to_dict(self) -> list:
+        with self._lock:
+            return [{'labels': dict(k), 'value': v, 'peak': self._peaks.get(k, v)} for k, v in self._values.items()]
+
+
+class _HistogramValue():
+
+    def __init__(self, n_buckets: int):
+        self.counts = [0] * (n_buckets + 1) # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+
+class Histogram(_Metric):
+    ''' bucketed distribution, quantiles are interpolated within a bucket '''
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, lock: threading.Lock, buckets: Sequence[float]=DEFAULT_BUCKETS):
+        super().__init__(name, help, lock)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = _key(labels)
+        with self._lock:
+            h = self._values.get(key)
+            if (h is None):
+                h = self._values[key] = _HistogramValue(len(self.buckets))
+            h.counts[bisect.bisect_left(self.buckets, value)] += 1
+            h.count += 1
+            h.sum += value
+            h.min = min(h.min, value)
+            h.max = max(h.max, value)
+
+    def _merged(self, labels: Dict[str, object]) -> _HistogramValue:
+        ''' every label set matching labels, added up '''
+        want = set(_key(labels))
+        out = _HistogramValue(len(self.buckets))
+        with self._lock:
+            for k, h in self._values.items():
+                if (not want <= set(k)):
+                    continue
+                out.counts = [a + b for a, b in zip(out.counts, h.counts)]
+                out.count += h.count
+                out.sum += h.sum
+                out.min = min(out.min, h.min)
+                out.max = max(out.max, h.max)
+        return out
+
+    def count(self, **labels) -> int:
+        return self._merged(labels).count
+
+    def sum(self, **labels) -> float:
+        return self._merged(labels).sum
+
+    def quantile(self, q: float, **labels) -> Optional[float]:
+        h = self._merged(labels)
+        if (h.count == 0):
+            return None
+        rank = q * h.count
+        seen = 0
+        for i, n in enumerate(h.counts):
+            if (seen + n >= rank and n > 0):
+                lower = self.buckets[i - 1] if i > 0 else min(h.min, self.buckets[0])
+                upper = self.buckets[i] if i < len(self.buckets) else h.max
+                value = lower + (upper - lower) * (rank - seen) / n
+                return min(max(value, h.min), h.max)
+            seen += n
+        return h.max
+
+    def stats(self, **labels) -> dict:
+        h = self._merged(labels)
+        if (h.count == 0):
+            return {'count': 0}
+        return {
+            'count': h.count,
+            'sum': h.sum,
+            'mean': h.sum / h.count,
+            'min': h.min,
+            'p50': self.quantile(0.5, **labels),
+            'p95': self.quantile(0.95, **labels),
+            'max': h.max,
+        }
+
+    def to_dict(self) -> list:
+        return [{'labels': dict(k), **self.stats(**dict(k))} for k in self.label_sets()]
+
+    def prometheus_lines(self) -> Iterator[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        for k, h in items:
+            cumulative = 0
+            for bound, n in zip(list(self.buckets) + [math.inf], h.counts):
+                cumulative += n
+                yield f'{self.name}_bucket{_format_labels(k, ("le", _format_value(bound)))} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(k)} {_format_value(h.sum)}'
+            yield f'{self.name}_count{_format_labels(k)} {h.count}'
+
+
+class Registry():
+
+    def __init__(self, namespace: str='auto_podcast'):
+        self.namespace = namespace
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _get(self, cls, name: str, help: str, **kwargs) -> _Metric:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if (metric is None):
+                metric = self._metrics[name] = cls(name, help, threading.Lock(), **kwargs)
+            elif (type(metric) is not cls):
+                raise ValueError(f'metric {name} is a {metric.kind}, not a {cls.kind}')
+            return metric
+
+    def counter(self, name: str, help: str='') -> Counter:
+        return self._get(Counter, name, help)
+
+    def gauge(self, name: str, help: str='') -> Gauge:
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name: str, help: str='', buckets: Sequence[float]=DEFAULT_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help, buckets=buckets)
+
+    def reset(self):
+        ''' zero every metric, e.g. at the start of a run '''
+        for metric in list(self._metrics.values()):
+            metric.reset()
+        self.started = time.time()
+
+    def snapshot(self) -> dict:
+        return {
+            'started': self.started,
+            'elapsed': time.time() - self.started,
+            'metrics': {
+                name: {'type': m.kind, 'help': m.help, 'values': m.to_dict()}
+                for name, m in sorted(self._metrics.items())
+            },
+        }
+
+    def to_prometheus(self) -> str:
+        lines = []
+        for name, m in sorted(self._metrics.items()):
+            full_name = f'{self.namespace}_{name}' if self.namespace else name
+            lines.append(f'# HELP {full_name} {m.help}')
+            lines.append(f'# TYPE {full_name} {m.kind}')
+            lines += [full_name + line[len(name):] for line in m.prometheus_lines()]
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> dict:
+        ''' the headline numbers of a run, only sections that saw any activity '''
+        out = {'elapsed': time.time() - self.started}
+        def hist(name: str, **labels) -> Optional[dict]:
+            m = self._metrics.get(name)
+            return m.stats(**labels) if isinstance(m, Histogram) and m.count(**labels) > 0 else None
+        def total(name: str, **labels) -> float:
+            m = self._metrics.get(name)
+            return m.total(**labels) if isinstance(m, Counter) else 0.0
+        def peak(name: str) -> float:
+            m = self._metrics.get(name)
+            return max((m.peak(**dict(k)) for k in m.label_sets()), default=0.0) if isinstance(m, Gauge) else 0.0
+
+        tts = hist('tts_seconds')
+        if (tts is not None):
+            audio_bytes = total('tts_audio_bytes_total')
+            out['tts'] = {
+                'requests': tts['count'],
+                'latency': tts,
+                'first_byte': hist('tts_first_byte_seconds'),
+                'audio_bytes': audio_bytes,
+                # per stream, not the aggregate of parallel streams
+                'bytes_per_second': audio_bytes / tts['sum'] if tts['sum'] > 0 else 0.0,
+                'postprocess': hist('audio_postprocess_seconds'),
+            }
+        if (total('segments_total') > 0):
+            out['segments'] = {
+                'total': total('segments_total'),
+                'by_source': {
+                    source: total('segments_total', source=source)
+                    for source in ('tts', 'stretch', 'cache', 'resume', 'silence', 'failed')
+                    if total('segments_total', source=source) > 0
+                },
+                'retries': total('segment_retries_total'),
+                'failures': total('segment_failures_total'),
+                'peak_queue_depth': peak('segment_queue_depth'),
+                'peak_in_flight': peak('segment_in_flight'),
+                'merge': hist('merge_seconds'),
+            }
+        llm = hist('llm_seconds')
+        if (llm is not None):
+            out['llm'] = {
+                'calls': llm['count'],
+                'latency': llm,
+                'prompt_tokens': total('llm_tokens_total', kind='prompt'),
+                'completion_tokens': total('llm_tokens_total', kind='completion'),
+                'retries': total('llm_retries_total'),
+                'errors': total('llm_errors_total'),
+            }
+        # segment caches, and the kv cache underneath them and the LLM caches
+        for key, metric in (('caches', 'cache_requests_total'), ('kv_caches', 'kv_cache_requests_total')):
+            caches = self._metrics.get(metric)
+            if (isinstance(caches, Counter) and len(caches.label_sets()) > 0):
+                out[key] = {}
+                for name in sorted({dict(k)['cache'] for k in caches.label_sets()}):
+                    hits = caches.total(cache=name, result='hit') + caches.total(cache=name, result='dedup')
+                    requests = caches.total(cache=name)
+                    out[key][name] = {'requests': requests, 'hit_ratio': hits / requests if requests else 0.0}
+        return out
+
+    def write(self, json_file: Optional[str]=None, prometheus_file: Optional[str]=None):
+        if (json_file is not None):
+            with open(json_file, 'w', encoding='utf-8') as f:
+                json.dump(self.snapshot(), f, indent=2, ensure_ascii=False)
+        if (prometheus_file is not None):
+            with open(prometheus_file, 'w', encoding='utf-8') as f:
+                f.write(self.to_prometheus())
+
+
+REGISTRY = Registry()
+
+def counter(name: str, help: str='') -> Counter:
+    return REGISTRY.counter(name, help)
+
+def gauge(name: str, help: str='') -> Gauge:
+    return REGISTRY.gauge(name, help)
+
+def histogram(name: str, help: str='', buckets: Sequence[float]=DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.histogram(name, help, buckets)
+
+@contextlib.contextmanager
+def timer(name: str, help: str='', **labels):
+    ''' observes the duration of the block, also when it raises '''
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        REGISTRY.histogram(name, help).observe(time.perf_counter() - started, **labels)
+
+def snapshot() -> dict:
+    return REGISTRY.snapshot()
+
+def to_prometheus() -> str:
+    return REGISTRY.to_prometheus()
+
+def summary() -> dict:
+    return REGISTRY.summary()
+
+def format_summary(s: Optional[dict]=None) -> str:
+    ''' one line per section, for the log '''
+    s = summary() if s is None else s
+    lines = [f'run: {s["elapsed"]:.1f}s']
+    if ('tts' in s):
+        t = s['tts']
+        lines.append(
+            f'tts: {t["requests"]} requests, p50 {t["latency"]["p50"]:.2f}s p95 {t["latency"]["p95"]:.2f}s, '
+            f'{t["bytes_per_second"] / 1024:.1f} KiB/s per stream')
+    if ('segments' in s):
+        g = s['segments']
+        lines.append(
+            f'segments: {g["total"]:.0f} {g["by_source"]}, {g["retries"]:.0f} retries, {g["failures"]:.0f} failed, '
+            f'peak queue {g["peak_queue_depth"]:.0f}, peak in flight {g["peak_in_flight"]:.0f}')
+    if ('llm' in s):
+        l = s['llm']
+        lines.append(
+            f'llm: {l["calls"]} calls, p50 {l["latency"]["p50"]:.2f}s, {l["prompt_tokens"]:.0f} prompt + '
+            f'{l["completion_tokens"]:.0f} completion tokens, {l["retries"]:.0f} retries')
+    for name, c in s.get('caches', {}).items():
+        lines.append(f'cache {name}: {c["requests"]:.0f} requests, hit ratio {c["hit_ratio"]:.2f}')
+    for name, c in s.get('kv_caches', {}).items():
+        lines.append(f'kv cache {name}: {c["requests"]:.0f} reads, hit ratio {c["hit_ratio"]:.2f}')
+    return '\n'.join(lines)
@@ -0,0 +1,347 @@
+
+"""
+
+Profiling
+
+opt-in, enabled by environment variables only, no code changes needed:
+
+    AUTO_PODCAST_PROFILE=profile          output directory ("1" means ./profile)
+    AUTO_PODCAST_PROFILE_STALL_MS=100     event loop lag that counts as a stall
+    AUTO_PODCAST_PROFILE_SAMPLE=0.05      fraction of stage runs to cProfile (the first run of a stage always is)
+
+what it records
+- event loop lag: a heartbeat task measures how late the loop wakes it up.
+  a watchdog thread grabs the loop thread's stack while the loop is stalled, so
+  profile/stalls.jsonl names the coroutine, the stage and the line that held it
+- per stage cProfile samples (provider, tts, postprocess, merge) in profile/<stage>/*.prof.
+  a stage run inside a coroutine profiles the loop thread from its start to its end,
+  so the sample also shows what else the loop executed meanwhile.
+  postprocess runs in the offload workers, which inherit the environment and profile themselves
+- profile/summary.json and profile/<stage>.txt (top functions) when the process exits,
+  or with: python -m auto_podcast.profiling [profile]
+
+when disabled every hook is a cheap no-op.
+
+"""
+
+from typing import (
+    AsyncGenerator,
+    Dict,
+    List,
+    Optional,
+    TypeVar,
+)
+
+import asyncio
+import atexit
+import collections
+import cProfile
+import glob
+import inspect
+import io
+import itertools
+import json
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+import logging
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+ENV_DIR = 'AUTO_PODCAST_PROFILE'
+ENV_STALL_MS = 'AUTO_PODCAST_PROFILE_STALL_MS'
+ENV_SAMPLE = 'AUTO_PODCAST_PROFILE_SAMPLE'
+
+_LOOP_LAG = metrics.histogram('event_loop_lag_seconds', 'delay of the profiling heartbeat, a stalled loop shows up here')
+_STALLS = metrics.counter('event_loop_stalls_total', 'event loop stalls over the threshold, by stage')
+
+T = TypeVar('T')
+
+_MAIN_PID = os.getpid() # the summary is written by the main process, not by offload workers
+
+
+class _Config():
+
+    def __init__(self):
+        value = os.environ.get(ENV_DIR, '').strip()
+        self.enabled = value not in ('', '0')
+        self.out_dir = 'profile' if value in ('1', 'true', 'yes') else value
+        self.stall_threshold = float(os.environ.get(ENV_STALL_MS, '100')) / 1000
+        self.sample_rate = float(os.environ.get(ENV_SAMPLE, '0.05'))
+
+_config: Optional[_Config] = None
+
+def config() -> _Config:
+    global _config
+    if (_config is None):
+        _config = _Config()
+        if (_config.enabled):
+            os.makedirs(_config.out_dir, exist_ok=True)
+            if (os.getpid() == _MAIN_PID):
+                atexit.register(write_summary)
+                logger.info(f'profiling enabled, writing to {_config.out_dir}')
+    return _config
+
+def enabled() -> bool:
+    return config().enabled
+
+
+# code object -> stage, filled by the hooks, read by the stall watchdog
+_stage_codes: Dict[object, str] = {}
+_profile_lock = threading.Lock()
+_profiling = False # cProfile allows one active profiler per thread, keep it to one at a time
+_stage_runs: Dict[str, int] = collections.Counter()
+_seq = itertools.count()
+
+
+def _start_sample(name: str) -> Optional[cProfile.Profile]:
+    global _profiling
+    cfg = config()
+    with _profile_lock:
+        runs = _stage_runs[name]
+        _stage_runs[name] += 1
+        if (_profiling or (runs > 0 and random.random() >= cfg.sample_rate)):
+            return None
+        _profiling = True
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+def _stop_sample(name: str, profiler: cProfile.Profile):
+    global _profiling
+    profiler.disable()
+    with _profile_lock:
+        _profiling = False
+    stage_dir = os.path.join(config().out_dir, name)
+    os.makedirs(stage_dir, exist_ok=True)
+    profiler.dump_stats(os.path.join(stage_dir, f'{os.getpid()}-{next(_seq):05d}.prof'))
+
+
+class stage():
+    '''
+    marks a block as part of a pipeline stage, sync or async:
+
+        with profiling.stage('tts'):
+            ...
+    '''
+
+    def __init__(self, name: str):
+        self.name = name
+        self._profiler = None
+
+    def __enter__(self):
+        if (not enabled()):
+            return self
+        # the watchdog maps stalled stacks to stages through the code of the enclosing function
+        _stage_codes.setdefault(sys._getframe(1).f_code, self.name)
+        self._profiler = _start_sample(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        if (self._profiler is not None):
+            _stop_sample(self.name, self._profiler)
+            self._profiler = None
+
+
+def sampled_call(name: str, fn, *args, **kwargs):
+    ''' fn(*args, **kwargs) as stage name. module level, so it can be sent to a process pool '''
+    if (not enabled()):
+        return fn(*args, **kwargs)
+    if (hasattr(fn, '__code__')):
+        _stage_codes.setdefault(fn.__code__, name)
+    profiler = _start_sample(name)
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        if (profiler is not None):
+            _stop_sample(name, profiler)
+
+
+def profile_agen(name: str, agen: AsyncGenerator[T, None]) -> AsyncGenerator[T, None]:
+    ''' every step of agen as stage name, agen itself if profiling is disabled '''
+    if (not enabled()):
+        return agen
+    return _profiled_agen(name, agen)
+
+async def _profiled_agen(name: str, agen: AsyncGenerator[T, None]) -> AsyncGenerator[T, None]:
+    if (inspect.isasyncgen(agen)):
+        _stage_codes.setdefault(agen.ag_code, name)
+    it = agen.__aiter__()
+    while (True):
+        with stage(name):
+            try:
+                item = await it.__anext__()
+            except StopAsyncIteration:
+                return
+        yield item
+
+
+class LoopMonitor():
+    ''' heartbeat task + watchdog thread for one event loop '''
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, out_dir: str, threshold: float, interval: float=0.02):
+        self.loop = loop
+        self.threshold = threshold
+        self.interval = interval
+        self.stalls_file = os.path.join(out_dir, 'stalls.jsonl')
+        # created on the loop thread, from here on the loop is expected to run the heartbeat
+        self._beat = time.monotonic()
+        self._loop_thread = threading.get_ident()
+        self._captured: List[dict] = [] # stacks sampled during the current stall
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._task = loop.create_task(self._heartbeat())
+        self._watchdog = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self._watchdog.start()
+
+    async def _heartbeat(self):
+        try:
+            while (True):
+                await asyncio.sleep(self.interval)
+                lag = max(0.0, time.monotonic() - self._beat - self.interval)
+                _LOOP_LAG.observe(lag)
+                with self._lock:
+                    captured, self._captured = self._captured, []
+                if (lag >= self.threshold):
+                    self._record(lag, captured)
+                self._beat = time.monotonic()
+        finally:
+            self._stop.set()
+
+    def _watch(self):
+        while (not self._stop.wait(self.threshold / 2)):
+            if (self.loop.is_closed()):
+                return
+            overdue = time.monotonic() - self._beat - self.interval
+            if (overdue < self.threshold):
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            if (frame is None):
+                continue
+            sample = describe_stack(frame)
+            del frame
+            with self._lock:
+                # a long stall can span several blocking calls, keep sampling
+                if (len(self._captured) < 100):
+                    self._captured.append(sample)
+
+    def _record(self, lag: float, captured: List[dict]):
+        record = {'time': time.time(), 'lag_ms': round(lag * 1000, 1), 'stage': None, 'task': None, 'stack': None}
+        if (len(captured) > 0):
+            # the stage seen most often held the loop longest, report its first stack
+            stages = collections.Counter(c['stage'] for c in captured)
+            top = stages.most_common(1)[0][0]
+            record.update(next(c for c in captured if c['stage'] == top))
+            record['samples'] = len(captured)
+            record['sampled_stages'] = {str(k): v for k, v in stages.items()}
+            record['sampled_sites'] = dict(collections.Counter(c['stack'][0] for c in captured if c['stack']))
+        _STALLS.inc(stage=record['stage'] or 'unknown')
+        logger.debug(f'event loop stalled {record["lag_ms"]}ms in {record["stage"]} / {record["task"]}')
+        with open(self.stalls_file, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def stop(self):
+        self._task.cancel()
+        self._stop.set()
+
+
+def describe_stack(frame, limit: int=20) -> dict:
+    ''' stage (innermost registered), task (outermost coroutine) and the innermost frames '''
+    frames = []
+    while (frame is not None):
+        frames.append(frame)
+        frame = frame.f_back
+    stage_name = next((_stage_codes[f.f_code] for f in frames if f.f_code in _stage_codes), None)
+    coroutines = [f for f in frames if f.f_code.co_flags & (inspect.CO_COROUTINE | inspect.CO_ASYNC_GENERATOR)]
+    return {
+        'stage': stage_name,
+        'task': _qualname(coroutines[-1].f_code) if coroutines else None,
+        'stack': [f'{f.f_code.co_filename}:{f.f_lineno} {_qualname(f.f_code)}' for f in frames[:limit]],
+    }
+
+def _qualname(code) -> str:
+    return getattr(code, 'co_qualname', code.co_name) # 3.11+
+
+
+_monitors: Dict[int, LoopMonitor] = {}
+
+def ensure_monitor():
+    ''' start the stall detector on the running loop, once. no-op if profiling is disabled '''
+    if (not enabled()):
+        return
+    loop = asyncio.get_running_loop()
+    monitor = _monitors.get(id(loop))
+    if (monitor is not None and monitor.loop is loop and not monitor._task.done()):
+        return
+    cfg = config()
+    _monitors[id(loop)] = LoopMonitor(loop, cfg.out_dir, cfg.stall_threshold)
+
+
+def _stage_report(stage_dir: str, top: int=30) -> Optional[str]:
+    files = sorted(glob.glob(os.path.join(stage_dir, '*.prof')))
+    if (len(files) == 0):
+        return None
+    out = io.StringIO()
+    stats = pstats.Stats(files[0], stream=out)
+    for path in files[1:]:
+        stats.add(path)
+    stats.sort_stats('cumulative').print_stats(top)
+    out.write('\n')
+    stats.sort_stats('tottime').print_stats(top)
+    return f'{len(files)} samples\n' + out.getvalue()
+
+def write_summary(out_dir: Optional[str]=None) -> dict:
+    ''' aggregate stalls.jsonl and the stage samples in out_dir '''
+    out_dir = out_dir or config().out_dir
+    stalls: List[dict] = []
+    stalls_file = os.path.join(out_dir, 'stalls.jsonl')
+    if (os.path.isfile(stalls_file)):
+        with open(stalls_file, 'r', encoding='utf-8') as f:
+            stalls = [json.loads(line) for line in f if line.strip()]
+
+    by_stage = collections.defaultdict(lambda: {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+    by_site = collections.defaultdict(lambda: {'count': 0, 'total_ms': 0.0}) # count: samples
+    for s in stalls:
+        entry = by_stage[s['stage'] or 'unknown']
+        entry['count'] += 1
+        entry['total_ms'] += s['lag_ms']
+        entry['max_ms'] = max(entry['max_ms'], s['lag_ms'])
+        # split the lag over the sites sampled during the stall
+        sites = s.get('sampled_sites') or ({s['stack'][0]: 1} if s['stack'] else {})
+        n = sum(sites.values())
+        for site, count in sites.items():
+            by_site[site]['count'] += count
+            by_site[site]['total_ms'] += s['lag_ms'] * count / n
+
+    samples = {}
+    for stage_dir in sorted(glob.glob(os.path.join(out_dir, '*', ''))):
+        name = os.path.basename(os.path.normpath(stage_dir))
+        report = _stage_report(stage_dir)
+        if (report is None):
+            continue
+        samples[name] = len(glob.glob(os.path.join(stage_dir, '*.prof')))
+        with open(os.path.join(out_dir, f'{name}.txt'), 'w', encoding='utf-8') as f:
+            f.write(report)
+
+    summary = {
+        'stalls': len(stalls),
+        'stall_ms': sum(s['lag_ms'] for s in stalls),
+        'by_stage': dict(by_stage),
+        'top_sites': dict(sorted(by_site.items(), key=lambda kv: -kv[1]['total_ms'])[:20]),
+        'samples': samples,
+        'loop_lag': _LOOP_LAG.stats(),
+    }
+    with open(os.path.join(out_dir, 'summary.json'), 'w', encoding='utf-8') as f:
+        json.dump(summary, f, indent=2, ensure_ascii=False)
+    return summary
+
+
+if __name__ == '__main__':
+    result = write_summary(sys.argv[1] if len(sys.argv) > 1 else 'profile')
+    print(json.dumps({k: v for k, v in result.items() if k != 'loop_lag'}, indent=2, ensure_ascii=False))
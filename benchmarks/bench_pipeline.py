@@ -0,0 +1,327 @@
+
+"""
+Benchmark: build_audio and iterate_refined_pdf_pages against local stand-ins
+
+No network: edge-tts talks to benchmarks.fake_backends.FakeTTSServer and
+ChatOpenAI to FakeLLMServer, the inputs come from benchmarks.corpora.
+Every scenario runs in a fresh subprocess and a fresh working directory,
+so caches, peak RSS and temp disk usage are per scenario.
+
+Scenarios
+- build_audio        text file -> out.mp3, wav per segment
+- build_audio_spool  same with spool=True
+- stream             build_audio_stream, time to first audio
+- refine             synthetic PDF -> iterate_refined_pdf_pages
+
+Reported: segments/s, time to first audio, LLM calls per page, tokens,
+peak RSS and peak temp disk usage. Results are stored in
+benchmarks/results/<git commit>.json, --baseline compares with an earlier run.
+
+Usage:
+    python -m benchmarks.bench_pipeline [--scenarios build_audio refine] [--latency 0.2 --jitter 0.1]
+        [--error-rate 0.05] [--payload-scale 2] [--paragraphs 100] [--pages 20] [--refine-concurrency 8]
+        [--baseline <commit or json file>] [--fail-on-regression 10]
+"""
+
+from typing import (
+    Dict,
+    List,
+    Optional,
+)
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks import corpora
+from benchmarks.fake_backends import BackendProfile, FakeLLMServer, FakeTTSServer
+
+
+SCENARIOS = ['build_audio', 'build_audio_spool', 'stream', 'refine']
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+VOICE = 'en-US-AriaNeural'
+
+# metric -> True if higher is better. metrics not listed are not compared
+METRICS = {
+    'wall_s': False,
+    'segments_per_s': True,
+    'time_to_first_audio_s': False,
+    'pages_per_s': True,
+    'llm_calls_per_page': False,
+    'llm_tokens_per_page': False,
+    'tts_requests_per_segment': False,
+    'peak_rss_mb': False,
+    'peak_temp_disk_mb': False,
+}
+
+
+class DiskSampler():
+    ''' peak size of a directory tree, sampled in the background '''
+
+    def __init__(self, path: str, interval: float=0.1):
+        self.path = path
+        self.interval = interval
+        self.peak = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def sample(self) -> int:
+        total = 0
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                try:
+                    # allocated blocks, a sparse spool only counts what is written
+                    total += os.stat(os.path.join(root, name)).st_blocks * 512
+                except OSError:
+                    pass # removed while walking
+        self.peak = max(self.peak, total)
+        return total
+
+    async def _run(self):
+        while (True):
+            self.sample()
+            await asyncio.sleep(self.interval)
+
+    def __enter__(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    def __exit__(self, *exc):
+        self._task.cancel()
+        self.sample()
+
+
+def profile_from_args(args, prefix: str) -> BackendProfile:
+    return BackendProfile(
+        latency=getattr(args, f'{prefix}_latency', None) or args.latency,
+        jitter=args.jitter, error_rate=args.error_rate, payload_scale=args.payload_scale)
+
+
+async def run_build_audio(args, workdir: str, *, spool: bool=False, stream: bool=False) -> dict:
+    from auto_podcast.audio_builder import build_audio, build_audio_stream
+    from auto_podcast.audio_builder.segmenter import Segmenter
+    from auto_podcast.audio_builder.tts_backends import ToneBackend
+    from auto_podcast.content_provider.plain_text import plain_text_gen
+
+    text_file = corpora.write_text(
+        os.path.join(workdir, 'corpus.txt'), paragraphs=args.paragraphs, cjk=args.cjk, seed=args.seed)
+    temp_dir = os.path.join(workdir, 'temp')
+    cache_dir = os.path.join(workdir, 'cache', 'tts_segments')
+    segments = 0
+    async def counted():
+        nonlocal segments
+        async for segment in plain_text_gen(text_file, VOICE):
+            segments += 1
+            yield segment
+
+    segmenter = Segmenter(max_chars=args.segment_chars) if args.segment_chars else None
+    # the tone backend renders locally, with the fake server's latency per call
+    backend = ToneBackend(latency=profile_from_args(args, 'tts').latency) if args.backend == 'tone' else None
+    result = {}
+    async with FakeTTSServer(profile_from_args(args, 'tts')) as tts:
+        tts.install()
+        with DiskSampler(workdir) as disk:
+            started = time.perf_counter()
+            if (stream):
+                first_chunk = None
+                nbytes = 0
+                async for chunk in build_audio_stream(
+                        counted(), temp_dir=temp_dir, cache_dir=cache_dir, segmenter=segmenter, pooled=not args.unpooled,
+                        backend=backend):
+                    if (first_chunk is None):
+                        first_chunk = time.perf_counter() - started
+                    nbytes += len(chunk)
+                result['time_to_first_audio_s'] = first_chunk
+                result['output_bytes'] = nbytes
+            else:
+                output_file = await build_audio(
+                    counted(), temp_dir=temp_dir, cache_dir=cache_dir, spool=spool, segmenter=segmenter,
+                    pooled=not args.unpooled, backend=backend)
+                result['output_bytes'] = os.path.getsize(output_file) if os.path.isfile(output_file) else 0
+            wall = time.perf_counter() - started
+        result.update({
+            'segments': segments,
+            'wall_s': wall,
+            'segments_per_s': segments / wall,
+            'tts_requests_per_segment': tts.stats['requests'] / max(1, segments),
+            'tts_errors': tts.stats['errors'],
+            'tts_peak_connections': tts.peak_sockets,
+            'tts_connections': tts.stats['connections'],
+            'peak_temp_disk_mb': disk.peak / 1024 ** 2,
+        })
+    return result
+
+async def run_refine(args, workdir: str) -> dict:
+    from auto_podcast.content_provider.pdf_refine import iterate_refined_pdf_pages
+
+    pdf_file = corpora.write_book_pdf(os.path.join(workdir, 'corpus.pdf'), pages=args.pages, seed=args.seed)
+    result = {}
+    async with FakeLLMServer(profile_from_args(args, 'llm')) as llm:
+        llm.install()
+        with DiskSampler(workdir) as disk:
+            started = time.perf_counter()
+            first_page = None
+            pages = 0
+            async for _ in iterate_refined_pdf_pages(
+                    pdf_file, concurrency=args.refine_concurrency, heuristics=args.refine_heuristics):
+                if (first_page is None):
+                    first_page = time.perf_counter() - started
+                pages += 1
+            wall = time.perf_counter() - started
+        result.update({
+            'pages': args.pages,
+            'wall_s': wall,
+            'pages_per_s': args.pages / wall,
+            'time_to_first_page_s': first_page,
+            'llm_calls': llm.stats['requests'],
+            'llm_calls_per_page': llm.stats['requests'] / args.pages,
+            'llm_tokens_per_page': (llm.stats['prompt_tokens'] + llm.stats['completion_tokens']) / args.pages,
+            'llm_errors': llm.stats['errors'],
+            'llm_calls_by_kind': {k[len('requests_'):]: v for k, v in llm.stats.items() if k.startswith('requests_')},
+            'peak_temp_disk_mb': disk.peak / 1024 ** 2,
+        })
+    return result
+
+async def run_scenario(name: str, args, workdir: str) -> dict:
+    if (name == 'build_audio'):
+        return await run_build_audio(args, workdir)
+    if (name == 'build_audio_spool'):
+        return await run_build_audio(args, workdir, spool=True)
+    if (name == 'stream'):
+        return await run_build_audio(args, workdir, stream=True)
+    if (name == 'refine'):
+        return await run_refine(args, workdir)
+    raise ValueError(f'unknown scenario: {name}')
+
+
+def child_main(args):
+    ''' runs one scenario in this process, prints its result as the last line of stdout '''
+    workdir = tempfile.mkdtemp(prefix=f'bench_{args.child}_')
+    repo_dir = os.getcwd()
+    sys.path.insert(0, repo_dir) # the project is imported lazily, after the chdir
+    os.chdir(workdir) # relative cache dirs (cache/llm_*) land in the workdir
+    try:
+        result = asyncio.run(run_scenario(args.child, args, workdir))
+    finally:
+        os.chdir(repo_dir)
+        if (not args.keep):
+            shutil.rmtree(workdir, ignore_errors=True)
+    # ru_maxrss is in KB on linux
+    result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    result['peak_rss_children_mb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    print(json.dumps(result))
+
+
+def run_child(name: str, argv: List[str]) -> dict:
+    cmd = [sys.executable, '-m', 'benchmarks.bench_pipeline', '--child', name] + argv
+    process = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if (process.returncode != 0):
+        return {'error': process.stderr.strip().splitlines()[-1] if process.stderr.strip() else 'failed'}
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def git_label() -> str:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True)
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True, text=True)
+        return commit.stdout.strip() + ('-dirty' if dirty.stdout.strip() else '')
+    except (OSError, subprocess.CalledProcessError):
+        return time.strftime('%Y%m%d-%H%M%S')
+
+def load_results(ref: str) -> dict:
+    path = ref if os.path.isfile(ref) else os.path.join(RESULTS_DIR, f'{ref}.json')
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def compare(baseline: dict, current: dict, threshold: float) -> List[str]:
+    ''' prints a table, returns the regressions worse than threshold percent '''
+    regressions = []
+    print(f'\n{"scenario":<18} {"metric":<26} {"baseline":>10} {"current":>10} {"change":>8}')
+    for name, result in current['scenarios'].items():
+        base = baseline['scenarios'].get(name)
+        if (base is None or 'error' in base or 'error' in result):
+            continue
+        for metric, higher_is_better in METRICS.items():
+            if (base.get(metric) is None or result.get(metric) is None or base[metric] == 0):
+                continue
+            change = (result[metric] - base[metric]) / abs(base[metric]) * 100
+            worse = -change if higher_is_better else change
+            flag = ' !' if worse > threshold else ''
+            if (flag):
+                regressions.append(f'{name}.{metric} {change:+.1f}%')
+            print(f'{name:<18} {metric:<26} {base[metric]:>10.3f} {result[metric]:>10.3f} {change:>+7.1f}%{flag}')
+    return regressions
+
+def print_results(results: Dict[str, dict]):
+    for name, result in results.items():
+        print(f'\n[{name}]')
+        for key, value in result.items():
+            if (isinstance(value, float)):
+                value = f'{value:.3f}'
+            print(f'  {key:<26} {value}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenarios', nargs='+', default=SCENARIOS, choices=SCENARIOS)
+    parser.add_argument('--latency', type=float, default=0.1, help='seconds before a backend answers')
+    parser.add_argument('--tts-latency', type=float, default=None, help='overrides --latency for TTS')
+    parser.add_argument('--llm-latency', type=float, default=None, help='overrides --latency for the LLM')
+    parser.add_argument('--jitter', type=float, default=0.05)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--payload-scale', type=float, default=1.0)
+    parser.add_argument('--paragraphs', type=int, default=100, help='size of the text corpus')
+    parser.add_argument('--cjk', action='store_true', help='chinese text corpus')
+    parser.add_argument('--pages', type=int, default=10, help='size of the PDF corpus')
+    parser.add_argument('--refine-concurrency', type=int, default=1, help='concurrent LLM calls of the refine scenario')
+    parser.add_argument('--refine-heuristics', action='store_true', help='local clean up, only low confidence pages go to the LLM')
+    parser.add_argument('--segment-chars', type=int, default=None, help='pack the text into segments of this many characters')
+    parser.add_argument('--backend', default='edge', choices=['edge', 'tone'], help='TTS backend, tone: local, no network')
+    parser.add_argument('--unpooled', action='store_true', help='one edge-tts connection per segment')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--label', default=None, help='name of the result file, the git commit by default')
+    parser.add_argument('--baseline', default=None, help='commit label or json file to compare with')
+    parser.add_argument('--fail-on-regression', type=float, default=None, metavar='PCT')
+    parser.add_argument('--keep', action='store_true', help='keep the scenario working directories')
+    parser.add_argument('--child', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if (args.child is not None):
+        child_main(args)
+        return
+
+    # the children get the same knobs
+    argv = [a for a in sys.argv[1:]]
+    results = {}
+    for name in args.scenarios:
+        print(f'running {name} ...', flush=True)
+        results[name] = run_child(name, argv)
+    print_results(results)
+
+    label = args.label or git_label()
+    report = {
+        'label': label,
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'config': {k: v for k, v in vars(args).items() if k not in ('child', 'baseline', 'fail_on_regression')},
+        'scenarios': results,
+    }
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    with open(os.path.join(RESULTS_DIR, f'{label}.json'), 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f'\nresults saved as {label}')
+
+    if (args.baseline is not None):
+        regressions = compare(load_results(args.baseline), report, args.fail_on_regression or 0.0)
+        if (args.fail_on_regression is not None and len(regressions) > 0):
+            print(f'\nregressions over {args.fail_on_regression}%: {", ".join(regressions)}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+
+"""
+Benchmark: vectorized trim_pcm vs the original sliding-window trim_mp3 loop
+
+The signal is synthetic (noise burst padded with silence) so no ffmpeg
+or mp3 decoding is involved, only the silence detection is measured.
+
+Usage: python -m benchmarks.bench_trim [--seconds 10 20 60] [--repeat 5]
+"""
+
+import argparse
+import time
+
+import numpy as np
+from pydub import AudioSegment
+
+from auto_podcast.audio_builder import audio_utils
+
+
+def legacy_trim(audio: AudioSegment, window_size: int = 50, window_interval: int = 20, silence_thr: float = -50):
+    ''' the original trim_mp3 loop, without decoding and encoding '''
+    start_trim = 0
+    end_trim = 0
+    while audio[start_trim:start_trim+window_size].dBFS < silence_thr:
+        start_trim += window_interval
+    while audio[-end_trim-window_size:].dBFS < silence_thr:
+        end_trim += window_interval
+    return audio[start_trim:-end_trim]
+
+
+def make_signal(seconds: float, frame_rate: int, silence: float=0.8) -> np.ndarray:
+    rng = np.random.default_rng(0)
+    n_silence = int(silence * frame_rate)
+    n_voice = int(seconds * frame_rate)
+    voice = rng.normal(0, 3000, n_voice)
+    quiet = rng.normal(0, 5, n_silence) # not digital zero, like real TTS output
+    return np.concatenate([quiet, voice, quiet]).astype(np.int16)[:, None]
+
+
+def best_of(fn, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', type=float, nargs='+', default=[2, 10, 60])
+    parser.add_argument('--silence', type=float, default=0.8, help='leading/trailing silence in seconds')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    frame_rate = audio_utils.DEFAULT_FRAME_RATE
+    print(f'{"seconds":>8} {"legacy ms":>10} {"numpy ms":>10} {"speedup":>8} {"match":>6}')
+    for seconds in args.seconds:
+        samples = make_signal(seconds, frame_rate, args.silence)
+        audio = AudioSegment(samples.tobytes(), frame_rate=frame_rate, sample_width=2, channels=1)
+
+        t_legacy = best_of(lambda: legacy_trim(audio), args.repeat)
+        t_numpy = best_of(lambda: audio_utils.trim_pcm(samples, frame_rate), args.repeat)
+
+        legacy_len = len(legacy_trim(audio)) # ms
+        numpy_len = audio_utils.trim_pcm(samples, frame_rate).shape[0] * 1000 / frame_rate
+        match = abs(legacy_len - numpy_len) <= 50 # within one window
+        print(f'{seconds:8.1f} {t_legacy * 1000:10.2f} {t_numpy * 1000:10.2f} {t_legacy / t_numpy:8.1f} {str(match):>6}')
+
+
+if __name__ == '__main__':
+    main()
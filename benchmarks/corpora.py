@@ -0,0 +1,171 @@
+
+"""
+Synthetic corpora for the benchmarks, deterministic for a given seed
+
+- text: paragraphs of sentences with a controllable sentence length, latin or CJK
+- pdf: a book-like PDF (running header, page numbers, chapter headings,
+  hyphenated line breaks) written without any PDF library, so the
+  benchmark only needs what the project already depends on
+"""
+
+from typing import (
+    List,
+)
+
+import random
+
+
+_WORDS = (
+    'the of and to in is was for on that with as by at from his her it an were are which this be or had '
+    'not but what all when there can one more time would about if out so up into than them only other new '
+    'some could these two may first then do any like my now over such our man me even most made after also '
+    'did many before must through back years where much your way well down should because each just those '
+    'people how too little state good very make world still own see men work long get here between both life '
+    'being under never day same another know while last might us great old year off come since against go '
+    'came right used take three river mountain harbour lantern archive letter signal winter morning'
+).split()
+_CJK = '的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定行学法所民得经十三之进着等部度家电力里如水化高自二理起小物现实加量都两体制机当使点从业本去把性好应开它合还因由其些然前外天政四日那社义事平形相全表间样与关各重新线内数正心反你明看原又么利比或但质气第向道命此变条只没结解问意建月公无系军很情者最立代想已通并提直题党程展五果料象员革位入常文总次品式活设及管特件长求老头基资边流路级少图山统接知较将组见计别她手角期根论运农指几九区强放决西被干做必战先回则任取据处队南给色光门即保治北造百规热领七海口东导器压志世金增争济阶油思术极交受联什认六共权收证改清己美再采转更单风切打白教速花带安场身车例真务具万每目至达走积示议声报斗完类八离华名确才科张信马节话米整空元况今集温传土许步群广石记需段研界拉林律叫且究观越织装影算低持音众书布复容儿须际商非验连断深难近矿千周委素技备半办青省列习响约支般史感劳便团往酸历市克何除消构府称太准精值号率族维划选标写存候毛亲快效斯院查江型眼王按格养易置派层片始却专状育厂京识适属圆包火住调满县局照参红细引听该铁价严'
+
+
+def make_sentence(rng: random.Random, words: int) -> str:
+    sentence = ' '.join(rng.choice(_WORDS) for _ in range(words))
+    return sentence[0].upper() + sentence[1:] + rng.choice('...!?')
+
+def make_cjk_sentence(rng: random.Random, chars: int) -> str:
+    return ''.join(rng.choice(_CJK) for _ in range(chars)) + rng.choice('。。。！？')
+
+def make_text(*, paragraphs: int=50, sentences_per_paragraph: int=5, words_per_sentence: int=15,
+              cjk: bool=False, seed: int=0) -> str:
+    ''' plain text, paragraphs separated by blank lines. words_per_sentence is chars per sentence for CJK '''
+    rng = random.Random(seed)
+    out = []
+    for _ in range(paragraphs):
+        sentences = []
+        for _ in range(sentences_per_paragraph):
+            # +-50% around the mean, so segment costs vary like in real text
+            n = max(1, int(words_per_sentence * rng.uniform(0.5, 1.5)))
+            sentences.append(make_cjk_sentence(rng, n) if cjk else make_sentence(rng, n))
+        out.append(('' if cjk else ' ').join(sentences))
+    return '\n\n'.join(out) + '\n'
+
+def write_text(path: str, **kwargs) -> str:
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(make_text(**kwargs))
+    return path
+
+
+def _wrap(text: str, width: int, rng: random.Random, hyphenate: float) -> List[str]:
+    ''' greedy wrap, sometimes breaking a long word with a hyphen like typeset text '''
+    lines = []
+    line = ''
+    for word in text.split():
+        if (len(line) + 1 + len(word) <= width or line == ''):
+            line = f'{line} {word}' if line else word
+            continue
+        room = width - len(line) - 2
+        if (len(word) >= 6 and room >= 3 and rng.random() < hyphenate):
+            lines.append(f'{line} {word[:room]}-')
+            line = word[room:]
+        else:
+            lines.append(line)
+            line = word
+    if (line):
+        lines.append(line)
+    return lines
+
+def make_book_pages(*, pages: int=20, lines_per_page: int=40, width: int=80, chapter_every: int=5,
+                    hyphenate: float=0.3, title: str='A Synthetic Book', seed: int=0) -> List[List[str]]:
+    ''' body lines of every page, including the running header and the page number footer '''
+    rng = random.Random(seed)
+    body = []
+    chapter = 0
+    for page in range(pages):
+        if (page % chapter_every == 0):
+            chapter += 1
+            body.append(('heading', f'Chapter {chapter}'))
+        while (len(body) < (page + 1) * (lines_per_page - 2)):
+            paragraph = ' '.join(make_sentence(rng, rng.randint(8, 25)) for _ in range(rng.randint(2, 6)))
+            for line in _wrap(paragraph, width, rng, hyphenate):
+                body.append(('text', line))
+            body.append(('text', ''))
+    per_page = lines_per_page - 2
+    result = []
+    for page in range(pages):
+        lines = [f'{title}    {page + 1}' if page % 2 else title]
+        lines += [text for _, text in body[page * per_page:(page + 1) * per_page]]
+        lines.append(str(page + 1))
+        result.append(lines)
+    return result
+
+
+def _pdf_escape(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+def write_pdf(path: str, pages: List[List[str]], *, font_size: int=10, leading: int=14,
+              title: str='A Synthetic Book', chapters: bool=True) -> str:
+    '''
+    minimal PDF 1.4: one Helvetica text stream per page.
+    chapters=True adds an outline entry for every "Chapter N" line
+    '''
+    objects: List[bytes] = [] # object i + 1
+    def add(body: bytes) -> int:
+        objects.append(body)
+        return len(objects)
+
+    catalog = add(b'') # placeholders, filled in below
+    pages_obj = add(b'')
+    font = add(b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>')
+    page_ids = []
+    headings = [] # (title, page object)
+    for lines in pages:
+        ops = [f'BT /F1 {font_size} Tf {leading} TL 50 800 Td']
+        for line in lines:
+            ops.append(f'({_pdf_escape(line)}) Tj T*')
+        ops.append('ET')
+        stream = '\n'.join(ops).encode('latin-1', 'replace')
+        content = add(b'<< /Length %d >>\nstream\n' % len(stream) + stream + b'\nendstream')
+        page_id = add(
+            b'<< /Type /Page /Parent %d 0 R /MediaBox [0 0 612 842] /Contents %d 0 R '
+            b'/Resources << /Font << /F1 %d 0 R >> >> >>' % (pages_obj, content, font))
+        page_ids.append(page_id)
+        headings += [(line, page_id) for line in lines if line.startswith('Chapter ')]
+
+    objects[pages_obj - 1] = b'<< /Type /Pages /Kids [%s] /Count %d >>' % (
+        b' '.join(b'%d 0 R' % i for i in page_ids), len(page_ids))
+    outline = b''
+    if (chapters and len(headings) > 0):
+        outlines_id = len(objects) + 1
+        first = outlines_id + 1
+        last = outlines_id + len(headings)
+        add(b'<< /Type /Outlines /First %d 0 R /Last %d 0 R /Count %d >>' % (first, last, len(headings)))
+        for i, (heading, page_id) in enumerate(headings):
+            item = first + i
+            links = b''
+            if (item > first):
+                links += b' /Prev %d 0 R' % (item - 1)
+            if (item < last):
+                links += b' /Next %d 0 R' % (item + 1)
+            add(b'<< /Title (%s) /Parent %d 0 R /Dest [%d 0 R /Fit]%s >>' % (
+                _pdf_escape(heading).encode('latin-1'), outlines_id, page_id, links))
+        outline = b' /Outlines %d 0 R /PageMode /UseOutlines' % outlines_id
+    objects[catalog - 1] = b'<< /Type /Catalog /Pages %d 0 R%s >>' % (pages_obj, outline)
+    info = add(b'<< /Title (%s) /Producer (auto_podcast benchmarks) >>' % _pdf_escape(title).encode('latin-1'))
+
+    out = bytearray(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+    offsets = []
+    for i, body in enumerate(objects):
+        offsets.append(len(out))
+        out += b'%d 0 obj\n' % (i + 1) + body + b'\nendobj\n'
+    xref = len(out)
+    out += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    for offset in offsets:
+        out += b'%010d 00000 n \n' % offset
+    out += b'trailer\n<< /Size %d /Root %d 0 R /Info %d 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (
+        len(objects) + 1, catalog, info, xref)
+    with open(path, 'wb') as f:
+        f.write(out)
+    return path
+
+def write_book_pdf(path: str, **kwargs) -> str:
+    title = kwargs.get('title', 'A Synthetic Book')
+    return write_pdf(path, make_book_pages(**kwargs), title=title)
@@ -0,0 +1,337 @@
+
+"""
+Local stand-ins for the edge-tts websocket and an OpenAI compatible chat endpoint
+
+Both speak enough of the real protocol that edge_tts.Communicate and
+ChatOpenAI talk to them unchanged, with configurable latency, jitter,
+error rate and payload size. Nothing leaves the machine.
+
+    async with FakeTTSServer(BackendProfile(latency=0.2)) as tts, FakeLLMServer() as llm:
+        tts.install()  # edge_tts connects to tts.url
+        llm.install()  # OPENAI_API_BASE -> llm.url
+        ...
+        print(tts.stats, llm.stats)
+
+The TTS server answers with a tone encoded by audio_utils.encode_pcm_chunk
+(needs ffmpeg, like build_audio itself), or with silent mp3 frames if ffmpeg
+is missing, plus one WordBoundary event per word.
+"""
+
+from typing import (
+    Dict,
+    Optional,
+)
+
+import asyncio
+import json
+import os
+import random
+import re
+import time
+import uuid
+import logging
+from collections import Counter
+from html import unescape
+
+import numpy as np
+from aiohttp import web, WSMsgType
+
+logger = logging.getLogger(__name__)
+
+
+class BackendProfile():
+    ''' how a fake backend behaves '''
+
+    def __init__(self, latency: float=0.1, jitter: float=0.05, error_rate: float=0.0, payload_scale: float=1.0,
+                 seconds_per_char: float=0.06, chunk_bytes: int=4096):
+        '''
+        latency: seconds before the first byte of a response
+        jitter: extra uniform random [0, jitter) seconds on top of latency
+        error_rate: probability that a request fails (TTS: socket closed before turn.end, LLM: HTTP 503)
+        payload_scale: multiplies the response size (TTS: audio bytes, LLM: "reasoning" text before the answer)
+        seconds_per_char: speech duration per character of TTS text
+        chunk_bytes: size of one TTS audio message
+        '''
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.payload_scale = payload_scale
+        self.seconds_per_char = seconds_per_char
+        self.chunk_bytes = chunk_bytes
+
+    def delay(self) -> float:
+        return self.latency + random.uniform(0, self.jitter)
+
+    def fails(self) -> bool:
+        return random.random() < self.error_rate
+
+    def to_dict(self) -> dict:
+        return dict(vars(self))
+
+
+class _FakeServer():
+
+    def __init__(self, profile: Optional[BackendProfile]=None, *, host: str='127.0.0.1', port: int=0):
+        self.profile = profile or BackendProfile()
+        self.host = host
+        self.port = port
+        self.stats: Counter = Counter()
+        self._runner: Optional[web.AppRunner] = None
+
+    def make_app(self) -> web.Application:
+        raise NotImplementedError
+
+    @property
+    def url(self) -> str:
+        return f'http://{self.host}:{self.port}'
+
+    async def start(self):
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        # never send local traffic through a proxy from the environment
+        os.environ['NO_PROXY'] = ','.join(filter(None, [os.environ.get('NO_PROXY'), self.host]))
+        logger.info(f'{type(self).__name__} listening on {self.url}')
+
+    async def stop(self):
+        if (self._runner is not None):
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+
+# MPEG-2 layer III, 48kbps, 24kHz, mono: the format edge-tts sends.
+# a frame with zeroed side info decodes to 576 samples of silence
+_SILENT_FRAME = bytes([0xFF, 0xF3, 0x64, 0xC0]) + bytes(140)
+_FRAME_SECONDS = 576 / 24000
+
+def make_audio_block(seconds: float=1.0, frame_rate: int=24000) -> bytes:
+    ''' about `seconds` of mp3 that concatenates cleanly: a tone if ffmpeg is available, silence otherwise '''
+    try:
+        from auto_podcast.audio_builder import audio_utils
+        t = np.arange(int(seconds * frame_rate)) / frame_rate
+        # a little pause at both ends, like real TTS output, so trimming has work to do
+        envelope = ((t > 0.1) & (t < seconds - 0.1)).astype(np.float64)
+        tone = (np.sin(2 * np.pi * 220 * t) * 8000 * envelope).astype(np.int16)
+        return audio_utils.encode_pcm_chunk(tone.tobytes(), frame_rate=frame_rate, channels=1, bitrate='48k')
+    except Exception as e:
+        logger.warning(f'cannot encode a tone ({e!r}), the fake TTS sends silent frames')
+        return _SILENT_FRAME * int(seconds / _FRAME_SECONDS)
+
+
+def _text_message(path: str, body: str='', request_id: str='') -> str:
+    return f'X-RequestId:{request_id}\r\nContent-Type:application/json; charset=utf-8\r\nPath:{path}\r\n\r\n{body}'
+
+def _audio_message(data: bytes, request_id: str='') -> bytes:
+    header = f'X-RequestId:{request_id}\r\nContent-Type:audio/mpeg\r\nPath:audio\r\n'.encode('utf-8')
+    return len(header).to_bytes(2, 'big') + header + data
+
+def _parse_message(message: str):
+    head, _, body = message.partition('\r\n\r\n')
+    headers = dict(line.split(':', 1) for line in head.split('\r\n') if ':' in line)
+    return headers, body
+
+
+class FakeTTSServer(_FakeServer):
+    ''' the edge-tts readaloud websocket: speech.config, ssml -> turn.start, audio, metadata, turn.end '''
+
+    def __init__(self, profile: Optional[BackendProfile]=None, **kwargs):
+        super().__init__(profile, **kwargs)
+        self.audio_block = make_audio_block()
+        self.active_sockets = 0
+        self.peak_sockets = 0
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/edge/v1', self.handle_ws)
+        return app
+
+    @property
+    def ws_url(self) -> str:
+        return f'ws://{self.host}:{self.port}/edge/v1?TrustedClientToken=fake'
+
+    def install(self):
+        ''' point edge_tts at this server, for the current process '''
+        import edge_tts.communicate
+        edge_tts.communicate.WSS_URL = self.ws_url
+
+    def audio_for(self, text: str) -> bytes:
+        seconds = len(text) * self.profile.seconds_per_char * self.profile.payload_scale
+        n = max(1, int(seconds * len(self.audio_block)))
+        reps = n // len(self.audio_block) + 1
+        return (self.audio_block * reps)[:n]
+
+    async def handle_ws(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.stats['connections'] += 1
+        self.active_sockets += 1
+        self.peak_sockets = max(self.peak_sockets, self.active_sockets)
+        try:
+            async for msg in ws:
+                if (msg.type != WSMsgType.TEXT):
+                    continue
+                headers, body = _parse_message(msg.data)
+                if (headers.get('Path') == 'ssml'):
+                    await self.synthesize(ws, headers.get('X-RequestId', ''), body)
+        finally:
+            self.active_sockets -= 1
+        return ws
+
+    async def synthesize(self, ws: web.WebSocketResponse, request_id: str, ssml: str):
+        started = time.perf_counter()
+        self.stats['requests'] += 1
+        match = re.search(r'<prosody[^>]*>(.*?)</prosody>', ssml, re.S)
+        text = unescape(match.group(1)) if match else ''
+        await asyncio.sleep(self.profile.delay())
+        if (self.profile.fails()):
+            self.stats['errors'] += 1
+            await ws.close(code=1011, message=b'fake error')
+            return
+
+        await ws.send_str(_text_message('turn.start', '{}', request_id))
+        audio = self.audio_for(text)
+        # one word boundary per word, spread evenly over the audio
+        words = text.split()
+        total_ticks = int(len(audio) * 8 * 10_000_000 / 48_000)
+        tick = 0
+        for word in words:
+            duration = total_ticks * len(word) // max(1, len(text))
+            await ws.send_str(_text_message('audio.metadata', json.dumps({'Metadata': [{
+                'Type': 'WordBoundary',
+                'Data': {'Offset': tick, 'Duration': duration, 'text': {'Text': word, 'Length': len(word)}},
+            }]}), request_id))
+            tick += total_ticks * (len(word) + 1) // max(1, len(text))
+        for i in range(0, len(audio), self.profile.chunk_bytes):
+            await ws.send_bytes(_audio_message(audio[i:i + self.profile.chunk_bytes], request_id))
+        await ws.send_str(_text_message('turn.end', '{}', request_id))
+        self.stats['audio_bytes'] += len(audio)
+        self.stats['busy_ms'] += int((time.perf_counter() - started) * 1000)
+
+
+def _prompt_text(messages) -> str:
+    parts = []
+    for m in messages:
+        content = m.get('content', '')
+        if (isinstance(content, list)):
+            content = ''.join(c.get('text', '') for c in content if isinstance(c, dict))
+        parts.append(content)
+    return '\n'.join(parts)
+
+def _last_code_block(prompt: str) -> str:
+    blocks = re.findall(r'```\n?(.*?)```', prompt, re.S)
+    return blocks[-1].strip('\n') if blocks else ''
+
+
+class FakeLLMServer(_FakeServer):
+    '''
+    POST /v1/chat/completions, plain and stream=True (server sent events).
+    answers are derived from the prompt, so the pdf_refine chains get well formed replies:
+    judge prompts get their json, the markdown editor echoes the page, summaries are one sentence
+    '''
+
+    def make_app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post('/v1/chat/completions', self.handle_chat)
+        app.router.add_get('/v1/stats', self.handle_stats)
+        return app
+
+    @property
+    def api_base(self) -> str:
+        return f'{self.url}/v1'
+
+    def install(self):
+        ''' point ChatOpenAI at this server, for the current process '''
+        os.environ['OPENAI_API_BASE'] = self.api_base
+        os.environ['OPENAI_BASE_URL'] = self.api_base
+        os.environ.setdefault('OPENAI_API_KEY', 'sk-fake')
+
+    def reasoning(self) -> str:
+        n = int(200 * self.profile.payload_scale)
+        return ('Let me think about it step by step. ' * (n // 36 + 1))[:n] + '\n'
+
+    def answer(self, prompt: str) -> (str, str):
+        ''' (kind, reply) '''
+        numbered = [int(n) for n in re.findall(r'^\[(\d+)\] ', prompt, re.M)]
+        if ('[{"line": 3, "remove": true/false}' in prompt):
+            return 'judge_removals', json.dumps([{'line': n, 'remove': False} for n in numbered])
+        if ('[{"line": 3, "answer": ans}' in prompt):
+            return 'judge_types', json.dumps([{'line': n, 'answer': 2} for n in numbered])
+        if ('{"remove": true/false}' in prompt):
+            return 'judge_removal', self.reasoning() + '{"remove": false}'
+        if ('{"answer": ans}' in prompt):
+            return 'judge_type', self.reasoning() + '{"answer": 2}'
+        if ('"split_after"' in prompt):
+            page = _last_code_block(prompt)
+            sentences = [s for s in re.split(r'(?<=[.!?。])\s+', page) if s.strip()]
+            sentence = sentences[len(sentences) // 2] if sentences else ''
+            return 'split', self.reasoning() + json.dumps({'split_after': sentence}, ensure_ascii=False)
+        if ('Use one sentence to describe' in prompt):
+            page = _last_code_block(prompt)
+            return 'summarize', f'The page is about {" ".join(page.split()[:8])}.'
+        if ('book editor' in prompt):
+            return 'format', _last_code_block(prompt)
+        return 'other', self.reasoning() + '{}'
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(dict(self.stats))
+
+    async def handle_chat(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        started = time.perf_counter()
+        prompt = _prompt_text(body.get('messages', []))
+        kind, reply = self.answer(prompt)
+        self.stats['requests'] += 1
+        self.stats[f'requests_{kind}'] += 1
+        await asyncio.sleep(self.profile.delay())
+        if (self.profile.fails()):
+            self.stats['errors'] += 1
+            return web.json_response({'error': {'message': 'fake overload', 'type': 'server_error'}}, status=503)
+
+        usage = {
+            'prompt_tokens': len(prompt) // 4,
+            'completion_tokens': len(reply) // 4,
+            'total_tokens': (len(prompt) + len(reply)) // 4,
+        }
+        self.stats['prompt_tokens'] += usage['prompt_tokens']
+        self.stats['completion_tokens'] += usage['completion_tokens']
+        completion_id = f'chatcmpl-{uuid.uuid4().hex}'
+        model = body.get('model', 'fake')
+        try:
+            if (not body.get('stream')):
+                return web.json_response({
+                    'id': completion_id,
+                    'object': 'chat.completion',
+                    'created': int(time.time()),
+                    'model': model,
+                    'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': reply}, 'finish_reason': 'stop'}],
+                    'usage': usage,
+                })
+
+            response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+            await response.prepare(request)
+            def event(delta: Dict, finish_reason=None) -> bytes:
+                return ('data: ' + json.dumps({
+                    'id': completion_id,
+                    'object': 'chat.completion.chunk',
+                    'created': int(time.time()),
+                    'model': model,
+                    'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}],
+                }) + '\n\n').encode('utf-8')
+            await response.write(event({'role': 'assistant', 'content': ''}))
+            for i in range(0, len(reply), 16):
+                await response.write(event({'content': reply[i:i + 16]}))
+            await response.write(event({}, 'stop'))
+            await response.write(b'data: [DONE]\n\n')
+            await response.write_eof()
+            return response
+        finally:
+            self.stats['busy_ms'] += int((time.perf_counter() - started) * 1000)
@@ -56,6 +56,8 @@ async def amain() -> None:
     """Main function"""
     print('start generation')
     await build_audio(foo_gen())
+    # one TTS request, the other rates are time stretched locally
+    # await build_audio(foo_gen(), local_variants=True)
     # await build_audio(plain_text_gen('foo.txt', VOICE_EN))
     # await build_audio(plain_pdf_gen(pdf_path, VOICE_EN, [1, 2]))
 
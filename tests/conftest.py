@@ -0,0 +1,73 @@
+import pytest
+
+from auto_podcast import kv_cache
+from auto_podcast.audio_builder import offload
+
+
+def _escape(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+def write_pdf(path: str, pages, outline=None):
+    '''
+    a PDF with one text line per line of pages (Helvetica, ascii only)
+
+    outline: (title, page, parent title or None) bookmarks, parents first
+    '''
+    objects = [
+        '<< /Type /Catalog /Pages 2 0 R >>',
+        '<< /Type /Pages /Kids [{}] /Count {} >>'.format(
+            ' '.join(f'{4 + 2 * i} 0 R' for i in range(len(pages))), len(pages)),
+        '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+    ]
+    for i, text in enumerate(pages):
+        stream = 'BT /F1 12 Tf 14 TL 72 720 Td ' + ' '.join(
+            f'({_escape(line)}) Tj T*' for line in text.split('\n')) + ' ET'
+        objects.append(f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] '
+                       f'/Resources << /Font << /F1 3 0 R >> >> /Contents {5 + 2 * i} 0 R >>')
+        objects.append(f'<< /Length {len(stream)} >>\nstream\n{stream}\nendstream')
+    data = b'%PDF-1.4\n'
+    offsets = []
+    for n, body in enumerate(objects):
+        offsets.append(len(data))
+        data += f'{n + 1} 0 obj\n{body}\nendobj\n'.encode('latin-1')
+    xref = len(data)
+    data += f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'.encode('latin-1')
+    data += ''.join(f'{offset:010d} 00000 n \n' for offset in offsets).encode('latin-1')
+    data += f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'.encode('latin-1')
+    with open(path, 'wb') as f:
+        f.write(data)
+
+    if (outline):
+        from PyPDF2 import PdfReader, PdfWriter
+        writer = PdfWriter()
+        for p in PdfReader(path).pages:
+            writer.add_page(p)
+        items = {}
+        for title, page, parent in outline:
+            items[title] = writer.add_outline_item(title, page, parent=items.get(parent))
+        with open(path, 'wb') as f:
+            writer.write(f)
+
+
+@pytest.fixture
+def default_cache(tmp_path):
+    ''' the shared kv cache, in tmp_path '''
+    cache = kv_cache.KVCache(str(tmp_path / 'cache.sqlite'))
+    kv_cache.set_default_cache(cache)
+    yield cache
+    kv_cache.set_default_cache(None)
+
+@pytest.fixture
+def inline_offload():
+    offload.configure(0)
+    yield
+    offload.configure()
+
+@pytest.fixture
+def make_pdf(tmp_path):
+    ''' make_pdf(pages, outline=None) -> path of a PDF written by write_pdf '''
+    def make(pages, outline=None, name: str='book.pdf') -> str:
+        path = str(tmp_path / name)
+        write_pdf(path, pages, outline)
+        return path
+    return make
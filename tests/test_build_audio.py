@@ -0,0 +1,208 @@
+'''
+builds with the offline ToneBackend. ffmpeg is replaced by a deterministic stand-in encoder:
+the mp3 frames carry a digest of the PCM they encode, so equal outputs mean equal audio
+'''
+
+import asyncio
+import hashlib
+import json
+import os
+
+import pytest
+
+from auto_podcast import kv_cache
+from auto_podcast.audio_builder import audio_utils, build_audio, offload
+from auto_podcast.audio_builder.segmenter import Segmenter
+from auto_podcast.audio_builder.segments import TextSegment, WhiteSpace
+from auto_podcast.audio_builder.tts_backends import ToneBackend
+
+VOICE = 'en-US-EmmaNeural'
+# MPEG-2 layer III, 64 kbit/s, 24 kHz: 192 byte frames of 576 samples
+FRAME_HEADER = bytes([0xFF, 0xF3, 0x84, 0xC4])
+FRAME_PCM_BYTES = 576 * 2
+
+
+def fake_encode_pcm_chunk(pcm: bytes, **kwargs) -> bytes:
+    payload = (hashlib.sha256(pcm).digest() * 6)[:188]
+    return (FRAME_HEADER + payload) * -(-len(pcm) // FRAME_PCM_BYTES)
+
+def fake_encode_pcm(chunks, output_file: str, **kwargs) -> int:
+    ''' raw PCM as "mp3" '''
+    with open(output_file, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+    return 0
+
+
+@pytest.fixture(autouse=True)
+def offline(monkeypatch):
+    monkeypatch.setattr(audio_utils, 'encode_pcm_chunk', fake_encode_pcm_chunk)
+    monkeypatch.setattr(audio_utils, 'encode_pcm', fake_encode_pcm)
+    offload.configure(0)
+    yield
+    offload.configure()
+
+
+def book(lines, pause: float=0.2):
+    ''' a provider reading lines, with a pause after each (if pause) '''
+    async def gen():
+        for line in lines:
+            yield TextSegment(line, VOICE)
+            if (pause):
+                yield WhiteSpace(pause)
+    return gen()
+
+def lines(n: int, start: int=0):
+    return [f'Line {i}.' for i in range(start, start + n)]
+
+def build(temp_dir, text, backend=None, pause: float=0.2, **kwargs) -> ToneBackend:
+    ''' build text into temp_dir, returns the backend '''
+    backend = backend or ToneBackend()
+    kwargs.setdefault('cache_dir', None)
+    asyncio.run(build_audio(book(text, pause), temp_dir=str(temp_dir), backend=backend, spool=True, **kwargs))
+    return backend
+
+def output(temp_dir) -> bytes:
+    with open(os.path.join(temp_dir, 'out.mp3'), 'rb') as f:
+        return f.read()
+
+def build_report(temp_dir) -> dict:
+    with open(os.path.join(temp_dir, 'build_report.json'), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def test_segment_cache_serves_a_second_build(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    first = build(tmp_path / 'first', lines(10), cache_dir=cache_dir)
+    assert first.segments == 10
+    second = build(tmp_path / 'second', lines(10) + ['A new line.'], cache_dir=cache_dir)
+    assert second.segments == 1
+    assert output(tmp_path / 'second').startswith(output(tmp_path / 'first'))
+
+
+def test_kv_segment_cache_serves_a_second_build(tmp_path):
+    kv_cache.set_default_cache(kv_cache.KVCache(str(tmp_path / 'cache.sqlite')))
+    try:
+        kwargs = {'cache_dir': str(tmp_path / 'cache'), 'cache_backend': 'kv'}
+        build(tmp_path / 'first', lines(10), **kwargs)
+        second = build(tmp_path / 'second', lines(10), **kwargs)
+    finally:
+        kv_cache.set_default_cache(None)
+    assert second.segments == 0
+    assert output(tmp_path / 'second') == output(tmp_path / 'first')
+
+
+def test_spool_holds_the_segments_in_order(tmp_path):
+    build(tmp_path, lines(5))
+    with open(tmp_path / 'spool_index.json', 'r', encoding='utf-8') as f:
+        segments = json.load(f)['segments']
+    assert [index for index, _, _ in segments] == list(range(10))
+    audio = output(tmp_path)
+    assert len(audio) == sum(nbytes for _, _, nbytes in segments)
+    position = 0
+    for index, _, nbytes in segments:
+        # text segments are sound, pauses are silence
+        assert (audio[position:position + nbytes].count(0) == nbytes) == (index % 2 == 1)
+        position += nbytes
+    assert not os.path.exists(tmp_path / '0000.wav')
+
+
+class FailingBackend(ToneBackend):
+    ''' ToneBackend that can't synthesize the lines in broken '''
+
+    def __init__(self, broken, **kwargs):
+        super().__init__(**kwargs)
+        self.broken = set(broken)
+
+    async def synthesize_batch(self, items, *, normalize=None):
+        results = await super().synthesize_batch(items, normalize=normalize)
+        return [RuntimeError('tts failed') if segment.text in self.broken else result
+                for (_, segment), result in zip(items, results)]
+
+
+def test_resume_after_a_crash(tmp_path):
+    text = lines(12)
+    build(tmp_path / 'clean', text)
+    build(tmp_path, text)
+    # the build crashed after segment 9, in the middle of writing a record
+    path = tmp_path / 'manifest.jsonl'
+    with open(path, 'r', encoding='utf-8') as f:
+        records = [json.loads(line) for line in f]
+    with open(path, 'w', encoding='utf-8') as f:
+        for record in records:
+            if (record.get('index', 0) < 10):
+                f.write(json.dumps(record) + '\n')
+        f.write('{"index": 10, "hash": ')
+
+    resumed = build(tmp_path, text)
+    # text segments 10, 12, ..., 22
+    assert resumed.segments == 7
+    assert build_report(tmp_path)['reused'] == 10
+    assert output(tmp_path) == output(tmp_path / 'clean')
+
+
+def test_failed_segments_are_rendered_again(tmp_path):
+    text = lines(6)
+    build(tmp_path / 'clean', text)
+    build(tmp_path, text, FailingBackend({'Line 3.'}), max_retries=0)
+    assert [failure['index'] for failure in build_report(tmp_path)['failures']] == [6]
+    assert output(tmp_path) != output(tmp_path / 'clean')
+
+    rerun = build(tmp_path, text)
+    assert rerun.segments == 1
+    assert build_report(tmp_path)['failures'] == []
+    assert output(tmp_path) == output(tmp_path / 'clean')
+
+
+def test_incremental_rebuild_with_inserted_and_removed_lines(tmp_path):
+    text = lines(150)
+    first = build(tmp_path, text, incremental=True)
+    assert first.segments == 150
+    with open(tmp_path / 'out_index.json', 'r', encoding='utf-8') as f:
+        chunks = json.load(f)['chunks']
+    assert len(chunks) >= 3
+
+    # edits in the first chunk (two segments per line) and at the end, the chunks between stay
+    end = chunks[0]['end'] // 2
+    edited = text[:2] + ['An inserted line.'] + text[2:end - 4] + text[end - 1:] + ['The new last line.']
+    rebuilt = build(tmp_path, edited, incremental=True)
+    assert rebuilt.segments == 2
+    report = build_report(tmp_path)
+    assert report['reused'] == 2 * len(edited) - 2 # all but the two new lines
+    assert report['splice']['reused_chunks'] >= len(chunks) - 2
+    # spliced the same as built from scratch
+    build(tmp_path / 'clean', edited, incremental=True)
+    assert output(tmp_path) == output(tmp_path / 'clean')
+    assert not os.path.exists(tmp_path / 'out.prev.mp3')
+
+
+def test_spool_is_compacted_between_rebuilds(tmp_path):
+    # every line replaced, again and again: without compaction the spool would keep every version
+    sizes = []
+    for n in range(6):
+        build(tmp_path, lines(20, start=100 * n), incremental=True)
+        sizes.append(os.path.getsize(tmp_path / 'spool.pcm'))
+    with open(tmp_path / 'spool_index.json', 'r', encoding='utf-8') as f:
+        live = sum(nbytes for _, _, nbytes in json.load(f)['segments'])
+    assert any(after < before for before, after in zip(sizes, sizes[1:]))
+    # at most half of it was dead before the build, which appended one version
+    assert sizes[-1] <= 3 * live
+
+    # a shorter book: the records past its end are dropped, the regions they referenced go with the next compaction
+    build(tmp_path, lines(5, start=300), incremental=True)
+    with open(tmp_path / 'manifest.jsonl', 'r', encoding='utf-8') as f:
+        indexes = [json.loads(line).get('index') for line in f]
+    assert max(i for i in indexes if i is not None) == 9
+    build(tmp_path / 'clean', lines(5, start=300), incremental=True)
+    assert output(tmp_path) == output(tmp_path / 'clean')
+
+
+def test_segmenter_packs_lines_into_fewer_requests(tmp_path):
+    text = ['The first sentence', 'runs over two lines.'] + lines(8)
+    backend = build(tmp_path, text, pause=None, segmenter=Segmenter(max_chars=60))
+    assert backend.segments == 2
+    with open(tmp_path / 'script.txt', 'r', encoding='utf-8') as f:
+        script = f.read()
+    assert 'The first sentence runs over two lines. Line 0. Line 1.' in script
+    with open(tmp_path / 'out.srt', 'r', encoding='utf-8') as f:
+        assert 'The first sentence runs over two lines.' in f.read()
@@ -0,0 +1,32 @@
+from auto_podcast.content_provider.concurrent_refine import reconcile_boundary
+
+
+def test_short_heading_at_boundary_is_kept():
+    prev_content = 'The introduction of the notes was brief.\nIt ended the chapter.'
+    first_page = 'Introduction\nThis chapter starts here.'
+    assert reconcile_boundary(prev_content, '', first_page) == first_page
+
+def test_repeated_heading_at_boundary_is_dropped():
+    prev_content = 'Some text.\n## Notes'
+    first_page = '\n## Notes\nThe notes start here.'
+    assert reconcile_boundary(prev_content, '', first_page) == 'The notes start here.'
+
+def test_repeated_lines_are_dropped():
+    prev_content = 'First line of the page.\nA sentence the previous shard already emitted.\nAnd the last one.'
+    first_page = 'A sentence the previous shard already emitted.\nAnd the last one!\nNew text.'
+    assert reconcile_boundary(prev_content, '', first_page) == 'New text.'
+
+def test_lines_inside_prev_content_are_not_an_overlap():
+    prev_content = 'Notes\nA paragraph after the heading.'
+    first_page = 'Notes\nAnother section.'
+    assert reconcile_boundary(prev_content, '', first_page) == first_page
+
+def test_missing_carry_over_is_restored():
+    prev_ending = 'A paragraph that nobody emitted yet, carried over.'
+    first_page = 'The next page.'
+    assert reconcile_boundary('Emitted.', prev_ending, first_page) == prev_ending + '\n' + first_page
+
+def test_reworded_carry_over_is_not_duplicated():
+    prev_ending = 'A paragraph that nobody emitted yet, carried over'
+    first_page = 'A paragraph that nobody has emitted yet, carried over.\nThe next page.'
+    assert reconcile_boundary('Emitted.', prev_ending, first_page) == first_page
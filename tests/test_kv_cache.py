@@ -0,0 +1,118 @@
+import asyncio
+import itertools
+import os
+
+import pytest
+
+from auto_podcast import kv_cache
+from auto_podcast.audio_builder.segment_cache import SCRATCH_DIR, KVSegmentCache
+from auto_podcast.content_provider import simple_caching
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    ''' every time.time() of the cache is a new second, so the LRU order is exact '''
+    ticks = itertools.count(1)
+    monkeypatch.setattr(kv_cache.time, 'time', lambda: float(next(ticks)))
+
+
+def test_namespaces(tmp_path):
+    cache = kv_cache.KVCache(str(tmp_path / 'cache.sqlite'))
+    cache.put('a', 'k', b'1')
+    cache.put_text('b', 'k', 'zwei')
+    assert cache.get('a', 'k') == b'1'
+    assert cache.get_text('b', 'k') == 'zwei'
+    assert cache.get('a', 'missing') is None
+    assert list(cache.keys('a')) == ['k']
+    cache.clear('a')
+    assert not cache.contains('a', 'k') and cache.contains('b', 'k')
+    assert cache.delete('b', 'k') and not cache.delete('b', 'k')
+    assert cache.total_bytes() == 0
+    cache.close()
+
+
+def test_entries_survive_a_restart(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    cache = kv_cache.KVCache(path)
+    value = b'the same words ' * 1000
+    cache.put('a', 'k', value)
+    assert cache.total_bytes() < len(value) # compressed
+    cache.close()
+    cache = kv_cache.KVCache(path)
+    assert cache.get('a', 'k') == value
+    assert cache.stats['disk_hits'] == 1
+    assert cache.get('a', 'k') == value
+    assert cache.stats['memory_hits'] == 1
+    cache.close()
+
+
+def test_eviction_to_the_size_cap(tmp_path, clock):
+    cache = kv_cache.KVCache(str(tmp_path / 'cache.sqlite'), max_bytes=1000, memory_items=0, compress=False)
+    for i in range(5):
+        cache.put('a', f'k{i}', bytes(200))
+    assert cache.total_bytes() == 1000
+    cache.get('a', 'k0') # k1 is now the least recently used
+    cache.put('b', 'new', bytes(200))
+    # down to 90% of the cap, the least recently used first, across namespaces
+    assert cache.total_bytes() <= 900
+    assert sorted(cache.keys('a')) == ['k0', 'k3', 'k4']
+    assert list(cache.keys('b')) == ['new']
+    assert cache.stats['evictions'] == 2
+    cache.close()
+
+
+def test_memory_hits_count_for_the_lru_order(tmp_path, clock):
+    cache = kv_cache.KVCache(str(tmp_path / 'cache.sqlite'), max_bytes=700, compress=False)
+    for i in range(3):
+        cache.put('a', f'k{i}', bytes(200))
+    assert cache.get('a', 'k0') == bytes(200) # served by the memory tier
+    cache.put('a', 'k3', bytes(200))
+    assert sorted(cache.keys('a')) == ['k0', 'k2', 'k3']
+    cache.close()
+
+
+def test_newest_entry_is_kept(tmp_path):
+    cache = kv_cache.KVCache(str(tmp_path / 'cache.sqlite'), max_bytes=100, compress=False)
+    cache.put('a', 'small', bytes(50))
+    cache.put('a', 'big', bytes(500))
+    assert list(cache.keys('a')) == ['big']
+    cache.close()
+
+
+def test_kv_segment_cache(tmp_path):
+    backend = kv_cache.KVCache(str(tmp_path / 'cache.sqlite'))
+    cache_dir = tmp_path / 'segments'
+    cache_dir.mkdir()
+    (cache_dir / 'old.wav').write_bytes(b'file layout entry')
+
+    async def build(path):
+        with open(path, 'wb') as f:
+            f.write(b'audio')
+
+    cache = KVSegmentCache(str(cache_dir), backend=backend, scratch_entries=2)
+    for key in ('a', 'b', 'c'):
+        asyncio.run(cache.fetch(key, build))
+    assert len(cache) == 3
+    assert sorted(os.listdir(cache_dir / SCRATCH_DIR)) == ['b.wav', 'c.wav']
+    assert (cache_dir / 'old.wav').read_bytes() == b'file layout entry'
+
+    # another run reads the entries back from the backend
+    cache = KVSegmentCache(str(cache_dir), backend=backend, scratch_entries=2)
+    assert os.listdir(cache_dir / SCRATCH_DIR) == []
+    path = cache.lookup('a')
+    assert path == str(cache_dir / SCRATCH_DIR / 'a.wav')
+    assert open(path, 'rb').read() == b'audio'
+    assert cache.lookup('missing') is None
+    backend.close()
+
+
+def test_text_cache_takes_over_the_file_layout(tmp_path, default_cache):
+    temp_path = tmp_path / 'llm_format_page'
+    temp_path.mkdir()
+    key = simple_caching.calculate_md5('page 1')
+    (temp_path / f'{key}.txt').write_text('formatted', encoding='utf-8')
+    assert simple_caching.get_text_cache(str(temp_path), 'page 1') == 'formatted'
+    assert default_cache.get_text('llm_format_page', key) == 'formatted'
+    simple_caching.save_text_cache(str(temp_path), 'page 2', 'other')
+    assert simple_caching.get_text_cache(str(temp_path), 'page 2') == 'other'
+    assert simple_caching.get_text_cache(str(temp_path), 'page 3') is None
@@ -0,0 +1,87 @@
+import asyncio
+
+from auto_podcast.content_provider import line_batch
+from auto_podcast.content_provider.llm_client import LLMError
+
+
+ITEM_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "line": {"type": "integer"},
+        "answer": {"type": "integer", "minimum": 1, "maximum": 6}
+    },
+    "required": ["line", "answer"]
+}
+
+
+def judge(lines, replies, rounds=3):
+    ''' judge_window with ask_llm answering from replies (an exception is raised), returns values, prompts, fallbacks '''
+    prompts = []
+    fallbacks = []
+
+    async def ask_llm(numbered):
+        prompts.append(numbered)
+        reply = replies.pop(0)
+        if (isinstance(reply, Exception)):
+            raise reply
+        return reply
+
+    async def fallback(i):
+        fallbacks.append(i)
+        return -1
+
+    values = asyncio.run(line_batch.judge_window(
+        lines, ask_llm=ask_llm, item_schema=ITEM_SCHEMA, field='answer', fallback=fallback, rounds=rounds))
+    return values, prompts, fallbacks
+
+
+def test_format_window():
+    assert line_batch.format_window(['a', 'b', 'c'], {1, 3}) == '[1] a\n    b\n[3] c'
+
+def test_all_answered():
+    values, prompts, fallbacks = judge(['a', 'b'], [[{"line": 1, "answer": 2}, {"line": 2, "answer": 3}]])
+    assert values == [2, 3]
+    assert len(prompts) == 1
+    assert fallbacks == []
+
+def test_partial_reply_asks_only_missing_lines():
+    values, prompts, fallbacks = judge(['a', 'b', 'c'], [
+        [{"line": 1, "answer": 2}],
+        [{"line": 2, "answer": 4}, {"line": 3, "answer": 5}],
+    ])
+    assert values == [2, 4, 5]
+    assert prompts[1] == '    a\n[2] b\n[3] c'
+    assert fallbacks == []
+
+def test_invalid_items_are_asked_again():
+    values, prompts, fallbacks = judge(['a', 'b'], [
+        [{"line": 1, "answer": 2}, {"line": 2, "answer": 7}, {"line": 9, "answer": 1}],
+        [{"line": 2, "answer": 6}],
+    ])
+    assert values == [2, 6]
+    assert len(prompts) == 2
+
+def test_unanswered_lines_go_to_fallback():
+    values, prompts, fallbacks = judge(['a', 'b'], [[{"line": 1, "answer": 1}], 'no json', []], rounds=3)
+    assert values == [1, -1]
+    assert len(prompts) == 3
+    assert fallbacks == [1]
+
+def test_failed_request_is_retried_then_falls_back():
+    values, prompts, fallbacks = judge(['a', 'b'], [
+        LLMError('no valid answer'),
+        [{"line": 2, "answer": 3}],
+        LLMError('no valid answer'),
+    ])
+    assert values == [-1, 3]
+    assert len(prompts) == 3
+    assert fallbacks == [0]
+
+def test_iterate_windows():
+    items = [(f'l{i}', [f'c{i}-{j}' for j in range(5)]) for i in range(5)]
+    windows = list(line_batch.iterate_windows(items, 2))
+    assert [w[0] for w in windows] == [['l0', 'l1'], ['l2', 'l3'], ['l4']]
+    lines, before, after, contexts = windows[0]
+    assert before == ['c0-0', 'c0-1']
+    assert after == ['c1-3', 'c1-4']
+    assert len(contexts) == 2
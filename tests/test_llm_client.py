@@ -0,0 +1,71 @@
+import asyncio
+
+import pytest
+
+from auto_podcast.content_provider import llm_client
+
+
+class StatusError(Exception):
+
+    def __init__(self, status_code):
+        super().__init__(f'status {status_code}')
+        self.status_code = status_code
+
+
+class FakeChain():
+    ''' answers from replies, an exception is raised '''
+
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.calls = 0
+
+    def with_config(self, config):
+        return self
+
+    async def ainvoke(self, inputs):
+        self.calls += 1
+        reply = self.replies.pop(0)
+        if (isinstance(reply, Exception)):
+            raise reply
+        return reply
+
+
+def client(**kwargs):
+    return llm_client.LLMClient(requests_per_minute=0, tokens_per_minute=0, backoff_base=0.001, **kwargs)
+
+
+def test_is_retryable():
+    assert llm_client.is_retryable(ConnectionError())
+    assert llm_client.is_retryable(StatusError(429))
+    assert llm_client.is_retryable(StatusError(503))
+    assert not llm_client.is_retryable(StatusError(400))
+    assert not llm_client.is_retryable(StatusError(401))
+
+def test_retries_server_errors():
+    chain = FakeChain([StatusError(500), StatusError(502), 'ok'])
+    assert asyncio.run(client().invoke(chain, {}, function='test')) == 'ok'
+    assert chain.calls == 3
+
+def test_rejected_request_does_not_open_the_circuit():
+    c = client(failure_threshold=2)
+    for _ in range(3):
+        chain = FakeChain([StatusError(400)])
+        with pytest.raises(llm_client.LLMError):
+            asyncio.run(c.invoke(chain, {}, function='test'))
+        assert chain.calls == 1
+    assert c.breaker.state == 'closed'
+    assert asyncio.run(c.invoke(FakeChain(['ok']), {}, function='test')) == 'ok'
+
+def test_server_errors_open_the_circuit():
+    c = client(failure_threshold=2, max_attempts=2)
+    with pytest.raises(llm_client.LLMError):
+        asyncio.run(c.invoke(FakeChain([StatusError(500), StatusError(500)]), {}, function='test'))
+    assert c.breaker.state == 'open'
+
+def test_invalid_answers_are_asked_again():
+    chain = FakeChain([{'x': 1}, {'answer': 2}])
+    def validate(answer):
+        if ('answer' not in answer):
+            raise ValueError('no answer')
+    assert asyncio.run(client().invoke(chain, {}, function='test', validate=validate)) == {'answer': 2}
+    assert chain.calls == 2
@@ -0,0 +1,81 @@
+import asyncio
+
+from auto_podcast.content_provider.llm_utils import JsonExtractor, JsonOutputParser, find_last_valid_json
+
+
+LINE_ITEM_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "line": {"type": "integer"},
+        "remove": {"type": "boolean"}
+    },
+    "required": ["line", "remove"]
+}
+
+REASONING_REPLY = (
+    'At first glance the answer would be {"remove": true}, but the line continues the paragraph '
+    'before it, so:\n{"remove": false}'
+)
+
+
+def chunks(text, size=7):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+async def agen(items):
+    for item in items:
+        yield item
+
+
+def test_find_last_valid_json():
+    assert find_last_valid_json('Sure! {"remove": true}') == {'remove': True}
+    assert find_last_valid_json('x [1,2] y {"a": "}"} z') == {'a': '}'}
+    assert find_last_valid_json('answer: {"a": "q\\"}"} done') == {'a': 'q"}'}
+    assert find_last_valid_json('no json here') is None
+    assert find_last_valid_json('[1, 2] and ]') is None
+
+def test_extractor_chunked():
+    text = 'x [1,2] y {"a": "}\\\\"} z'
+    extractor = JsonExtractor()
+    values = []
+    for chunk in chunks(text, 3):
+        values += extractor.feed(chunk)
+    assert values == [[1, 2], {'a': '}\\'}]
+    assert extractor.result() == find_last_valid_json(text)
+
+def test_reasoning_reply_takes_last_json():
+    # the single line judges reason first, streaming must agree with parse
+    parser = JsonOutputParser()
+    assert parser.parse(REASONING_REPLY) == {'remove': False}
+    assert list(parser.transform(iter(chunks(REASONING_REPLY)))) == [{'remove': False}]
+
+    async def collect():
+        return [value async for value in parser.atransform(agen(chunks(REASONING_REPLY)))]
+    assert asyncio.run(collect()) == [{'remove': False}]
+
+def test_stop_schema_stops_at_first_valid_value():
+    # LLMClient.invoke(stream=True) takes the first item of astream and closes it
+    read = []
+    async def source():
+        for chunk in ['[{"line": 1, "remove": ', 'false}]', ' and some more', ' text']:
+            read.append(chunk)
+            yield chunk
+    parser = JsonOutputParser(stop_schema={"type": "array", "items": LINE_ITEM_SCHEMA, "minItems": 1})
+
+    async def first():
+        values = parser.atransform(source())
+        try:
+            return await values.__anext__()
+        finally:
+            await values.aclose()
+    assert asyncio.run(first()) == [{'line': 1, 'remove': False}]
+    assert len(read) == 2
+
+def test_stop_schema_skips_line_numbers_in_prose():
+    reply = 'Line [3] is a page header.\n[{"line": 3, "remove": true}]'
+    parser = JsonOutputParser(stop_schema={"type": "array", "items": LINE_ITEM_SCHEMA, "minItems": 1})
+    assert list(parser.transform(iter(chunks(reply)))) == [[{'line': 3, 'remove': True}]]
+
+def test_remapping():
+    parser = JsonOutputParser(remapping={'a': 'b'}, stop_schema={"type": "object", "required": ["a"]})
+    assert parser.parse('{"a": 5}') == {'b': 5}
+    assert list(parser.transform(iter(['{"x": 1} then {"a"', ': 2} {"a": 3}']))) == [{'b': 2}]
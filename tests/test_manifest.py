@@ -0,0 +1,97 @@
+import json
+
+from auto_podcast.audio_builder.manifest import BuildManifest
+
+
+def manifest_lines(path) -> list:
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_finished_segments_are_reusable(tmp_path):
+    path = str(tmp_path / 'manifest.jsonl')
+    manifest = BuildManifest(path, mode='spool')
+    manifest.record(0, 'a', 'done', 1.0, 0, 100, [{'text': 'Hi', 'start': 0.0, 'end': 0.5}])
+    manifest.record(1, 'b', 'failed', 2.0, 100, 200)
+    manifest.close()
+
+    manifest = BuildManifest(path, mode='spool')
+    assert manifest.reusable(0, 'a')['words'][0]['text'] == 'Hi'
+    assert manifest.reusable(0, 'changed') is None
+    assert manifest.reusable(1, 'b') is None # failed, rendered again
+    assert manifest.reusable(2, 'a') is None
+    assert manifest.reusable_by_hash('a')['index'] == 0
+    assert manifest.spool_regions() == {(0, 100)}
+    manifest.close()
+
+
+def test_crash_truncated_line_is_skipped(tmp_path):
+    path = str(tmp_path / 'manifest.jsonl')
+    manifest = BuildManifest(path, mode='files')
+    manifest.record(0, 'a', 'done', 1.0)
+    manifest.record(1, 'b', 'done', 1.0)
+    manifest.close()
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write('{"index": 2, "hash": "c", "sta')
+
+    manifest = BuildManifest(path, mode='files')
+    assert sorted(manifest.previous) == [0, 1]
+    manifest.close()
+    # rewritten without the broken line
+    assert [record.get('index') for record in manifest_lines(path)] == [None, 0, 1]
+
+
+def test_latest_record_wins(tmp_path):
+    path = str(tmp_path / 'manifest.jsonl')
+    manifest = BuildManifest(path, mode='files')
+    manifest.record(0, 'a', 'failed', 1.0)
+    manifest.record(0, 'a', 'done', 1.5)
+    manifest.close()
+    manifest = BuildManifest(path, mode='files')
+    assert manifest.reusable(0, 'a')['duration'] == 1.5
+    manifest.close()
+    assert len(manifest_lines(path)) == 2
+
+
+def test_other_mode_starts_over(tmp_path):
+    path = str(tmp_path / 'manifest.jsonl')
+    manifest = BuildManifest(path, mode='files')
+    manifest.record(0, 'a', 'done', 1.0)
+    manifest.close()
+    manifest = BuildManifest(path, mode='spool')
+    assert manifest.previous == {}
+    manifest.close()
+
+
+def test_records_past_a_shorter_book_are_dropped(tmp_path):
+    path = str(tmp_path / 'manifest.jsonl')
+    manifest = BuildManifest(path, mode='spool')
+    for i in range(4):
+        manifest.record(i, f'h{i}', 'done', 1.0, 100 * i, 100)
+    manifest.close(4)
+    manifest = BuildManifest(path, mode='spool')
+    # the book lost two segments, h3 moved to index 1
+    manifest.record(1, 'h3', 'done', 1.0, 300, 100)
+    manifest.close(2)
+    manifest = BuildManifest(path, mode='spool')
+    assert sorted(manifest.previous) == [0, 1]
+    assert manifest.spool_regions() == {(0, 100), (300, 100)}
+    manifest.close()
+
+
+def test_relocate(tmp_path):
+    path = str(tmp_path / 'manifest.jsonl')
+    manifest = BuildManifest(path, mode='spool')
+    manifest.record(0, 'a', 'done', 1.0, 0, 100)
+    manifest.record(1, 'b', 'done', 1.0, 500, 100)
+    manifest.close()
+    swapped = []
+    manifest = BuildManifest(path, mode='spool')
+    manifest.relocate({500: 0}, lambda: swapped.append(True))
+    manifest.close()
+    assert swapped == [True]
+    manifest = BuildManifest(path, mode='spool')
+    # a's region was dropped by the compaction
+    assert manifest.reusable(0, 'a')['offset'] is None
+    assert manifest.reusable(1, 'b')['offset'] == 0
+    manifest.close()
@@ -0,0 +1,83 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from auto_podcast.audio_builder.pcm_spool import COMPACT_SUFFIX, PcmSpool, compact_spool, install_compacted
+
+
+def tone(n: int, value: int) -> np.ndarray:
+    return np.full(n, value, dtype=np.int16)
+
+def pcm(spool: PcmSpool, indices=None) -> bytes:
+    return b''.join(spool.iter_pcm(indices, chunk_bytes=7))
+
+
+def test_segments_in_index_order(tmp_path):
+    with PcmSpool(str(tmp_path / 'spool.pcm'), frame_rate=1000, grow_bytes=16) as spool:
+        # finished out of order, read in order
+        spool.write(2, tone(5, 3))
+        spool.write_silence(1, 0.004)
+        spool.write(0, tone(3, 1))
+        assert pcm(spool) == tone(3, 1).tobytes() + bytes(8) + tone(5, 3).tobytes()
+        assert pcm(spool, [2, 0]) == tone(5, 3).tobytes() + tone(3, 1).tobytes()
+        assert spool.duration(2) == 0.005
+        with pytest.raises(ValueError):
+            spool.write(0, tone(1, 1))
+
+
+def test_file_ends_at_the_last_region(tmp_path):
+    path = tmp_path / 'spool.pcm'
+    with PcmSpool(str(path), grow_bytes=1024) as spool:
+        spool.write(0, tone(10, 1))
+        spool.write_silence(1, 0.001)
+    assert path.stat().st_size == 20 + 2 * int(0.001 * spool.frame_rate)
+
+
+def test_resume_adopts_previous_regions(tmp_path):
+    path = str(tmp_path / 'spool.pcm')
+    with PcmSpool(path) as spool:
+        offset = spool.write(0, tone(4, 7))
+        spool.write(1, tone(4, 8))
+        spool.save_index(str(tmp_path / 'index.json'))
+    regions = {i: (o, n) for i, o, n in json.load(open(tmp_path / 'index.json'))['segments']}
+    assert regions[0] == (offset, 8)
+
+    with PcmSpool(path, resume=True) as spool:
+        spool.adopt(0, *regions[0])
+        spool.write(1, tone(4, 9)) # re-rendered, appended after the old regions
+        assert pcm(spool) == tone(4, 7).tobytes() + tone(4, 9).tobytes()
+        assert spool.index[1][0] == 16
+        with pytest.raises(ValueError):
+            spool.adopt(2, 100, 8)
+
+
+def test_compaction_keeps_live_regions(tmp_path):
+    path = str(tmp_path / 'spool.pcm')
+    with PcmSpool(path) as spool:
+        for i in range(6):
+            spool.write(i, tone(10, i + 1))
+    # only segments 1 and 4 are still referenced, 1 twice (it moved)
+    regions = [(20, 20), (80, 20), (20, 20)]
+    moves = compact_spool(path, regions)
+    assert moves == {20: 0, 80: 20}
+    install_compacted(path)
+    assert not os.path.exists(path + COMPACT_SUFFIX)
+    with PcmSpool(path, resume=True) as spool:
+        spool.adopt(0, moves[20], 20)
+        spool.adopt(1, moves[80], 20)
+        assert pcm(spool) == tone(10, 2).tobytes() + tone(10, 5).tobytes()
+
+
+def test_no_compaction_while_mostly_live(tmp_path):
+    path = str(tmp_path / 'spool.pcm')
+    with PcmSpool(path) as spool:
+        for i in range(4):
+            spool.write(i, tone(10, 1))
+    assert compact_spool(path, [(0, 20), (20, 20)]) is None
+    assert compact_spool(path, [(0, 20)], max_dead_ratio=0.9) is None
+    assert not os.path.exists(path + COMPACT_SUFFIX)
+    assert compact_spool(str(tmp_path / 'missing.pcm'), []) is None
+    with pytest.raises(ValueError):
+        compact_spool(path, [(70, 20)])
@@ -0,0 +1,82 @@
+import textwrap
+
+import pytest
+
+from auto_podcast.content_provider import pdf_heuristics
+
+
+NAMES = ['Anna', 'Boris', 'Clara', 'Dmitri', 'Elena', 'Fyodor', 'Galina', 'Igor', 'Katya', 'Lev',
+         'Marta', 'Nikolai', 'Olga', 'Pavel', 'Raisa', 'Sergei', 'Tanya', 'Vera', 'Yuri', 'Zoya']
+
+
+def prose(first: int, count: int) -> str:
+    ''' sentences that all read differently '''
+    return ' '.join(f'{NAMES[i % 20]} walked past the house of {NAMES[(i * 7 + 3) % 20]} without a word.'
+                    for i in range(first, first + count))
+
+def page(n: int, lines) -> str:
+    ''' running header with the page number in it, lines, page number footer '''
+    return '\n'.join([f'THE GREAT NOVEL {n}', ''] + lines + ['', f'- {n} -'])
+
+def book(count: int):
+    ''' pages and the lines of their text '''
+    bodies = [textwrap.wrap(prose(4 * n, 4), 60) for n in range(count)]
+    return [page(n + 1, lines) for n, lines in enumerate(bodies)], bodies
+
+
+@pytest.mark.parametrize('line', ['12', '- 12 -', 'Page 12', '(7)', '3 / 200', 'xii', '(iv)', '- XII -', 'Page IV', '第12页'])
+def test_page_numbers(line):
+    assert pdf_heuristics.is_page_number(line)
+
+@pytest.mark.parametrize('line', ['Did', 'Mild', 'Civil', 'Mix', 'mix', 'I', '1984 was a year', 'Chapter 12'])
+def test_not_page_numbers(line):
+    assert not pdf_heuristics.is_page_number(line)
+
+
+def test_running_headers_and_footers_are_removed():
+    pages, bodies = book(8)
+    for lines, body in zip(pdf_heuristics.strip_headers_footers(pages), bodies):
+        assert [line for line in lines if line.strip() != ''] == body
+
+
+def test_a_line_on_few_pages_is_kept():
+    pages, _ = book(8)
+    # a first line that only this page has
+    pages[4] = pages[4].replace('THE GREAT NOVEL 5', 'A line of its own')
+    stripped = list(pdf_heuristics.strip_headers_footers(pages))
+    assert stripped[4][0] == 'A line of its own'
+    assert 'THE GREAT NOVEL' not in '\n'.join(stripped[3])
+
+
+def test_join_lines():
+    paragraphs = pdf_heuristics.join_lines([
+        'Chapter 3', 'The rain had not stopped for three days and the river was rising',
+        'fast. Everyone in the village knew what would hap-', 'pen next.', 'Nobody spoke.', '',
+        '第一行的文字', '第二行的文字。',
+    ])
+    assert paragraphs == [
+        '# Chapter 3',
+        'The rain had not stopped for three days and the river was rising fast. '
+        'Everyone in the village knew what would happen next.',
+        'Nobody spoke.',
+        '第一行的文字第二行的文字。',
+    ]
+
+
+def test_clean_pages_moves_an_unfinished_paragraph():
+    pages, _ = book(8)
+    pages[0] = page(1, textwrap.wrap(prose(0, 3), 60) + [''] + textwrap.wrap(prose(3, 2) + ' And so it', 60))
+    pages[1] = page(2, textwrap.wrap('went on. ' + prose(5, 3), 60) + [''] + textwrap.wrap(prose(8, 2), 60))
+    cleaned = list(pdf_heuristics.clean_pages(pages))
+    assert len(cleaned) == len(pages) + 1
+    assert cleaned[0].text == prose(0, 3)
+    # the paragraph started on page 1 ends on page 2, the blank line below the header doesn't break it
+    assert cleaned[1].text == prose(3, 2) + ' And so it went on. ' + prose(5, 3) + '\n' + prose(8, 2)
+    assert cleaned[1].confidence > 0.9
+    assert cleaned[-1].text == ''
+
+
+def test_confidence_of_garbled_text():
+    assert pdf_heuristics.page_confidence('(cid:12)(cid:13)(cid:14) broken') < 0.5
+    assert pdf_heuristics.page_confidence('12 34 56\n78 90 12\n34 56 78') < 0.5
+    assert pdf_heuristics.page_confidence(prose(0, 10)) == 1.0
@@ -0,0 +1,85 @@
+import pytest
+
+from auto_podcast.content_provider import pdf_index
+
+
+HEADING_PAGES = [
+    'Preface of the book.',
+    'Chapter 1 The Beginning\nIt began on a Monday.',
+    'Still in the first chapter.',
+    'The end of the first chapter.\nChapter 2 The Middle\nIt went on.',
+    'Chapter 3 The End\nDone.',
+]
+
+OUTLINE_PAGES = ['Title page', 'Part one starts', 'More of it', 'Second chapter', 'Part two starts']
+OUTLINE = [
+    ('Part One', 1, None),
+    ('Chapter 1', 1, 'Part One'),
+    ('Chapter 2', 3, 'Part One'),
+    ('Part Two', 4, None),
+]
+
+
+def spans(index: pdf_index.PdfIndex):
+    return [(c.number, c.title, c.level, c.start_page, c.end_page) for c in index.chapters]
+
+
+def test_chapters_from_headings(make_pdf, default_cache, inline_offload):
+    path = make_pdf(HEADING_PAGES)
+    index = pdf_index.build_index(path)
+    assert spans(index) == [
+        (1, 'Chapter 1 The Beginning', 0, 1, 3),
+        (2, 'Chapter 2 The Middle', 0, 3, 4),
+        (3, 'Chapter 3 The End', 0, 4, 5),
+    ]
+    assert all(c.source == 'heading' for c in index.chapters)
+    # cut at the headings, also in the middle of a page
+    assert [index.chapter_text(c, path).split() for c in index.chapters] == [
+        'Chapter 1 The Beginning It began on a Monday. Still in the first chapter. The end of the first chapter.'.split(),
+        'Chapter 2 The Middle It went on.'.split(),
+        'Chapter 3 The End Done.'.split(),
+    ]
+
+
+def test_chapters_from_the_outline(make_pdf, default_cache, inline_offload):
+    path = make_pdf(OUTLINE_PAGES, OUTLINE)
+    index = pdf_index.build_index(path)
+    assert spans(index) == [
+        (1, 'Part One', 0, 1, 4),
+        (2, 'Chapter 1', 1, 1, 3),
+        (3, 'Chapter 2', 1, 3, 4),
+        (4, 'Part Two', 0, 4, 5),
+    ]
+    assert index.chapter_text(index.chapters[0], path).split() == 'Part one starts More of it Second chapter'.split()
+
+
+def test_selection(make_pdf, default_cache, inline_offload):
+    index = pdf_index.build_index(make_pdf(OUTLINE_PAGES, OUTLINE))
+    assert [c.number for c in index.find('Chapter 2')] == [3]
+    assert [c.number for c in index.find('chapter')] == [2, 3]
+    assert [c.number for c in index.select([4, 'Part One', 2])] == [1, 2, 4]
+    assert [c.number for c in index.select(range(2, 4))] == [2, 3]
+    assert [c.number for c in index.select(slice(-1, None))] == [4]
+    assert index.page_range(['Chapter 1', 'Part Two']) == [1, 2, 4]
+    with pytest.raises(KeyError):
+        index.find(5)
+    with pytest.raises(KeyError):
+        index.find('Epilogue')
+    with pytest.raises(TypeError):
+        index.find(True)
+
+
+def test_index_is_kept_in_the_cache(make_pdf, default_cache, inline_offload, monkeypatch):
+    path = make_pdf(OUTLINE_PAGES, OUTLINE)
+    monkeypatch.setattr(pdf_index, '_indexes', {})
+    index = pdf_index.get_index(path)
+    assert spans(pdf_index.PdfIndex.from_json(index.to_json())) == spans(index)
+
+    def fail(pdf_path):
+        raise AssertionError('built again')
+    monkeypatch.setattr(pdf_index, 'build_index', fail)
+    monkeypatch.setattr(pdf_index, '_indexes', {})
+    assert spans(pdf_index.get_index(path)) == spans(index)
+    assert pdf_index.resolve_page_range(path, None, ['Chapter 1']) == [1, 2]
+    assert pdf_index.resolve_page_range(path, range(2, 5), ['Part One']) == [2, 3]
+    assert pdf_index.resolve_page_range(path, [0], None) == [0]
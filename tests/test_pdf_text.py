@@ -0,0 +1,66 @@
+import pytest
+
+from auto_podcast.audio_builder import offload
+from auto_podcast.content_provider import pdf_text
+
+
+PAGES = [f'Page {i} of the book.\nIt has two lines.' for i in range(10)]
+
+
+def texts(path, page_range=None, **kwargs):
+    return [text.strip() for text in pdf_text.extract_text_from_pdf(path, page_range, **kwargs)]
+
+
+def test_pages_in_order(make_pdf, default_cache, inline_offload):
+    path = make_pdf(PAGES)
+    assert texts(path, cache=False) == PAGES
+    assert texts(path, [7, 2, 3], cache=False) == [PAGES[2], PAGES[3], PAGES[7]]
+
+
+def test_parallel_chunks(make_pdf, default_cache):
+    path = make_pdf(PAGES)
+    offload.configure(2, kind='thread')
+    try:
+        assert texts(path, chunk_pages=3, prefetch_chunks=2) == PAGES
+    finally:
+        offload.configure()
+
+
+def test_pages_are_parsed_once(make_pdf, default_cache, inline_offload, monkeypatch):
+    path = make_pdf(PAGES)
+    assert texts(path, range(0, 5)) == PAGES[:5]
+
+    parsed = []
+    extract_pages = pdf_text._extract_pages
+    def counting(pdf_path, pages):
+        parsed.extend(pages)
+        return extract_pages(pdf_path, pages)
+    monkeypatch.setattr(pdf_text, '_extract_pages', counting)
+    # another page range: only the pages not seen yet are parsed
+    assert texts(path, range(3, 8)) == PAGES[3:8]
+    assert parsed == [5, 6, 7]
+    # cached by content, not by path
+    copy = make_pdf(PAGES, name='copy.pdf')
+    assert texts(copy, range(0, 8)) == PAGES[:8]
+    assert parsed == [5, 6, 7]
+
+
+def test_changed_file_is_parsed_again(make_pdf, default_cache, inline_offload):
+    path = make_pdf(PAGES)
+    assert texts(path) == PAGES
+    edited = PAGES[:4] + ['An edited page.'] + PAGES[5:]
+    make_pdf(edited) # same path
+    assert texts(path) == edited
+
+
+def test_stopping_early(make_pdf, default_cache):
+    path = make_pdf(PAGES)
+    offload.configure(2, kind='thread')
+    try:
+        pages = pdf_text.extract_text_from_pdf(path, chunk_pages=1)
+        assert next(pages).strip() == PAGES[0]
+        pages.close()
+    finally:
+        offload.configure()
+    with pytest.raises(StopIteration):
+        next(pages)
@@ -0,0 +1,88 @@
+import asyncio
+
+from auto_podcast.audio_builder.scheduler import AdaptiveScheduler
+
+
+def scheduler(**kwargs) -> AdaptiveScheduler:
+    kwargs.setdefault('backoff_base', 0.001)
+    return AdaptiveScheduler(**kwargs)
+
+def run(s: AdaptiveScheduler, jobs):
+    ''' submit (index, job) pairs, then join '''
+    async def main():
+        for index, job in jobs:
+            await s.submit(index, job)
+        await s.join()
+    asyncio.run(main())
+
+
+def test_earliest_segment_first():
+    done = []
+    def job(index):
+        async def run_job():
+            done.append(index)
+        return run_job
+    s = scheduler(initial_concurrency=1, max_concurrency=1)
+    run(s, [(i, job(i)) for i in (3, 0, 2, 1)])
+    assert done == [0, 1, 2, 3]
+    assert s.completed == 4
+
+
+def test_concurrency_limit():
+    running = 0
+    peak = 0
+    async def job():
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.001)
+        running -= 1
+    s = scheduler(initial_concurrency=2, max_concurrency=3)
+    run(s, [(i, job) for i in range(30)])
+    assert s.completed == 30
+    assert 2 <= peak <= 3
+    assert s.peak_concurrency <= 3
+
+
+def test_failed_job_is_retried():
+    attempts = []
+    async def flaky():
+        attempts.append(1)
+        if (len(attempts) < 3):
+            raise ConnectionError('dropped')
+    s = scheduler(max_retries=4)
+    run(s, [(0, flaky)])
+    assert len(attempts) == 3
+    assert (s.completed, s.retries, s.failures) == (1, 2, [])
+
+
+def test_permanent_failure_is_recorded():
+    reported = []
+    async def broken():
+        raise ValueError('bad voice')
+    async def fine():
+        pass
+    s = scheduler(max_retries=2, on_failure=reported.append)
+    run(s, [(0, fine), (1, broken), (2, fine)])
+    assert s.completed == 2
+    assert [(f.index, f.attempts) for f in s.failures] == [(1, 3)]
+    assert "bad voice" in s.failures[0].error
+    assert reported == s.failures
+
+
+def test_errors_halve_the_concurrency():
+    async def broken():
+        raise ConnectionError('throttled')
+    s = scheduler(initial_concurrency=8, max_concurrency=8, max_retries=0)
+    run(s, [(0, broken)])
+    assert s.concurrency == 4
+    assert s.decreases == 1
+
+
+def test_successes_raise_the_concurrency():
+    async def job():
+        await asyncio.sleep(0)
+    s = scheduler(initial_concurrency=2, max_concurrency=4, latency_tolerance=1000)
+    run(s, [(i, job) for i in range(50)])
+    assert s.concurrency > 2
+    assert s.concurrency <= 4
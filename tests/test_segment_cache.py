@@ -0,0 +1,97 @@
+import asyncio
+import os
+
+import pytest
+
+from auto_podcast.audio_builder.segment_cache import SIDECAR_EXT, SegmentCache, segment_key
+from auto_podcast.audio_builder.segments import TextSegment
+
+
+def builder(data: bytes, calls: list, *, delay: float=0.0, words: bool=False):
+    ''' build function of SegmentCache.fetch writing data, calls collects the paths it was called with '''
+    async def build(path):
+        calls.append(path)
+        await asyncio.sleep(delay)
+        with open(path, 'wb') as f:
+            f.write(data)
+        if (words):
+            with open(path + SIDECAR_EXT, 'w', encoding='utf-8') as f:
+                f.write('[]')
+    return build
+
+
+def test_segment_key():
+    segment = TextSegment('Hello there.', 'en-US-EmmaNeural')
+    key = segment_key(segment, 'v1')
+    assert key == segment_key(TextSegment('Hello there.', 'en-US-EmmaNeural'), 'v1')
+    assert key != segment_key(TextSegment('Hello there.', 'en-US-AndrewNeural'), 'v1')
+    assert key != segment_key(TextSegment('Hello there.', 'en-US-EmmaNeural', rate=1.5), 'v1')
+    assert key != segment_key(segment, 'v2')
+    assert key != segment_key(segment, 'v1', processing='peak')
+
+
+def test_fetch_builds_only_on_miss(tmp_path):
+    cache = SegmentCache(str(tmp_path))
+    calls = []
+    path = asyncio.run(cache.fetch('a', builder(b'audio', calls)))
+    assert open(path, 'rb').read() == b'audio'
+    assert asyncio.run(cache.fetch('a', builder(b'other', calls))) == path
+    assert len(calls) == 1
+    assert (cache.stats.hits, cache.stats.misses) == (1, 1)
+    # a new process finds the entry on disk
+    assert SegmentCache(str(tmp_path)).lookup('a') == path
+
+
+def test_concurrent_fetches_share_one_build(tmp_path):
+    cache = SegmentCache(str(tmp_path))
+    calls = []
+
+    async def run():
+        build = builder(b'audio', calls, delay=0.01)
+        return await asyncio.gather(*[cache.fetch('a', build) for _ in range(5)])
+
+    paths = asyncio.run(run())
+    assert len(set(paths)) == 1
+    assert len(calls) == 1
+    assert cache.stats.dedups == 4
+
+
+def test_failed_build_leaves_nothing_behind(tmp_path):
+    cache = SegmentCache(str(tmp_path))
+
+    async def fail(path):
+        with open(path, 'wb') as f:
+            f.write(b'partial')
+        raise RuntimeError('tts failed')
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(cache.fetch('a', fail))
+    assert os.listdir(tmp_path) == []
+    assert 'a' not in cache
+    calls = []
+    asyncio.run(cache.fetch('a', builder(b'audio', calls)))
+    assert len(calls) == 1
+
+
+def test_eviction_to_max_bytes(tmp_path):
+    cache = SegmentCache(str(tmp_path), max_bytes=250)
+    calls = []
+    for key in 'abc':
+        asyncio.run(cache.fetch(key, builder(b'x' * 100, calls, words=True)))
+    # over the cap after c: a, the least recently used, goes with its word timings
+    assert 'a' not in cache
+    assert not os.path.exists(os.path.join(tmp_path, 'a.wav' + SIDECAR_EXT))
+    assert cache.total_bytes() == 200
+    assert cache.stats.evictions == 1
+
+    cache.lookup('b') # b is now more recently used than c
+    asyncio.run(cache.fetch('d', builder(b'x' * 100, calls)))
+    assert 'c' not in cache and 'b' in cache and 'd' in cache
+    assert sorted(os.listdir(tmp_path)) == ['b.wav', 'b.wav' + SIDECAR_EXT, 'd.wav']
+
+
+def test_newest_entry_is_kept_over_the_cap(tmp_path):
+    cache = SegmentCache(str(tmp_path), max_bytes=10)
+    path = asyncio.run(cache.fetch('big', builder(b'x' * 100, [])))
+    assert os.path.isfile(path)
+    assert len(cache) == 1
@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+
+from auto_podcast.audio_builder import segmenter
+from auto_podcast.audio_builder.segments import TextSegment, WhiteSpace
+
+VOICE = 'en-US-EmmaNeural'
+
+
+def run(items, **kwargs):
+    ''' segments of segmenter.segment over items (str: a line of VOICE, float: a pause, or a segment) '''
+    async def gen():
+        for item in items:
+            if (isinstance(item, str)):
+                yield TextSegment(item, VOICE)
+            elif (isinstance(item, float)):
+                yield WhiteSpace(item)
+            else:
+                yield item
+
+    async def collect():
+        return [segment async for segment in segmenter.segment(gen(), **kwargs)]
+    return asyncio.run(collect())
+
+def texts(segments):
+    return [s.text if isinstance(s, TextSegment) else s.time for s in segments]
+
+
+def test_lines_are_packed_into_sentences():
+    out = run(['The first sentence', 'runs over two lines. The second', 'one too. Short.'], max_chars=40)
+    assert texts(out) == ['The first sentence runs over two lines.', 'The second one too. Short.']
+
+
+def test_pauses_end_a_chunk_and_merge():
+    out = run(['One.', 0.5, 1.0, 'Two.', 2.0], max_chars=100, max_pause=1.5)
+    assert texts(out) == ['One.', 1.0, 'Two.', 1.5]
+
+
+def test_style_change_ends_a_chunk():
+    out = run(['Emma speaks.', TextSegment('Andrew answers.', 'en-US-AndrewNeural', rate=1.2), 'Emma again.'])
+    assert texts(out) == ['Emma speaks.', 'Andrew answers.', 'Emma again.']
+    assert [(s.voice, s.rate) for s in out][1] == ('en-US-AndrewNeural', 1.2)
+
+
+def test_long_sentences_are_cut():
+    long = 'this clause is long, ' * 5 + 'and it ends here.'
+    pieces = texts(run([long], max_chars=50))
+    assert all(len(piece) <= 50 for piece in pieces)
+    assert all(piece.endswith(',') for piece in pieces[:-1])
+    assert ' '.join(pieces) == long
+    assert segmenter.split_long('a' * 25, 10) == ['a' * 10, 'a' * 10, 'a' * 5]
+
+
+def test_join_text():
+    assert segmenter.join_text('hard wrap', 'ped line') == 'hard wrap ped line'
+    assert segmenter.join_text('hyphen-', 'ated') == 'hyphenated'
+    assert segmenter.join_text('这是第一', '行文字') == '这是第一行文字'
+    assert segmenter.join_text('', 'x') == 'x'
+
+
+def test_max_chars_must_be_positive():
+    with pytest.raises(ValueError):
+        segmenter.Segmenter(max_chars=0)
@@ -0,0 +1,97 @@
+import hashlib
+import json
+
+from auto_podcast.audio_builder import splice
+
+# MPEG-1 layer III 128 kbit/s 44.1 kHz (417 bytes, 1152 samples), MPEG-2 64 kbit/s 24 kHz (192 bytes, 576 samples)
+MPEG1_FRAME = bytes([0xFF, 0xFB, 0x90, 0xC4]) + bytes(413)
+MPEG2_FRAME = bytes([0xFF, 0xF3, 0x84, 0xC4]) + bytes(188)
+
+
+def hashes(names):
+    return [hashlib.sha256(name.encode('utf-8')).hexdigest() for name in names]
+
+def book(n: int):
+    ''' hashes and pause flags of n lines, each followed by a pause '''
+    names = [name for i in range(n) for name in (f'line {i}', 'pause')]
+    return names, [name == 'pause' for name in names]
+
+def encoder(calls: list):
+    def encode_chunk(start, end):
+        calls.append((start, end))
+        return MPEG2_FRAME * (end - start)
+    return encode_chunk
+
+
+def test_mp3_samples():
+    assert splice.mp3_samples(MPEG1_FRAME * 3) == 3 * 1152
+    assert splice.mp3_samples(MPEG2_FRAME * 2) == 2 * 576
+    # junk between frames is skipped
+    assert splice.mp3_samples(b'ID3' + MPEG2_FRAME + b'\x00\xff' + MPEG1_FRAME) == 576 + 1152
+    assert splice.mp3_samples(b'') == 0
+
+
+def test_chunk_boundaries_depend_on_content():
+    names, pauses = book(200)
+    chunks = splice.plan_chunks(hashes(names), pauses)
+    assert len(chunks) > 2
+    assert chunks[0][0] == 0 and chunks[-1][1] == len(names)
+    assert all(a[1] == b[0] for a, b in zip(chunks, chunks[1:]))
+    # an inserted line only moves the boundaries before it
+    edited = names[:10] + ['new line', 'pause'] + names[10:]
+    edited_chunks = splice.plan_chunks(hashes(edited), pauses[:10] + [False, True] + pauses[10:])
+    assert [(s + 2, e + 2) for s, e in chunks[1:]] == edited_chunks[1:]
+
+
+def test_max_segments_per_chunk():
+    names, pauses = book(100)
+    chunks = splice.plan_chunks(hashes(names), pauses, target_segments=10 ** 9, max_segments=50)
+    assert [end - start for start, end in chunks] == [50, 50, 50, 50]
+
+
+def test_unchanged_chunks_are_copied(tmp_path):
+    out, index = str(tmp_path / 'out.mp3'), str(tmp_path / 'out_index.json')
+    names, pauses = book(200)
+    chunks = splice.plan_chunks(hashes(names), pauses)
+    calls = []
+    stats = splice.splice_output(out, index, hashes(names), chunks, encoder(calls))
+    assert stats['encoded_chunks'] == len(chunks) and len(calls) == len(chunks)
+
+    names[-2] = 'edited line'
+    edited_chunks = splice.plan_chunks(hashes(names), pauses)
+    previous = str(tmp_path / 'out.prev.mp3')
+    (tmp_path / 'out.mp3').rename(previous)
+    calls = []
+    stats = splice.splice_output(out, index, hashes(names), edited_chunks, encoder(calls),
+                                 previous_file=previous, previous_index=splice.load_output_index(index))
+    assert calls == [edited_chunks[-1]]
+    assert stats['reused_chunks'] == len(edited_chunks) - 1
+    assert open(out, 'rb').read() == MPEG2_FRAME * len(names)
+    with open(index, 'r', encoding='utf-8') as f:
+        written = json.load(f)['chunks']
+    assert [(c['start'], c['end']) for c in written] == edited_chunks
+    assert [c['samples'] for c in written] == [576 * (end - start) for start, end in edited_chunks]
+
+
+def test_short_previous_output_is_encoded_again(tmp_path):
+    out, index = str(tmp_path / 'out.mp3'), str(tmp_path / 'out_index.json')
+    names, pauses = book(20)
+    chunks = splice.plan_chunks(hashes(names), pauses)
+    splice.splice_output(out, index, hashes(names), chunks, encoder([]))
+    previous = tmp_path / 'out.prev.mp3'
+    previous.write_bytes(b'')
+    calls = []
+    splice.splice_output(out, index, hashes(names), chunks, encoder(calls),
+                         previous_file=str(previous), previous_index=splice.load_output_index(index))
+    assert calls == chunks
+
+
+def test_segment_starts(tmp_path):
+    index = tmp_path / 'out_index.json'
+    index.write_text(json.dumps({'chunks': [
+        {'start': 0, 'end': 2, 'samples': 24000},
+        {'start': 2, 'end': 3, 'samples': 12000},
+    ]}))
+    delay = (splice.MP3_ENCODER_DELAY + splice.MP3_DECODER_DELAY) / 24000
+    starts = splice.segment_starts(str(index), {0: 0.5, 1: 0.25, 2: 0.4}, 24000)
+    assert starts == {0: delay, 1: delay + 0.5, 2: 1.0 + delay}
@@ -0,0 +1,31 @@
+import importlib.metadata
+
+import edge_tts.communicate as edge_communicate
+
+from auto_podcast.audio_builder import tts_backends, tts_transport
+
+
+def test_installed_edge_tts_is_supported():
+    assert tts_transport.unsupported_reason() is None
+    assert tts_backends.EdgeTTSBackend().transport is not None
+
+
+def test_missing_internal_falls_back_to_communicate(monkeypatch):
+    monkeypatch.delattr(edge_communicate, '_SSL_CTX')
+    assert '_SSL_CTX' in tts_transport.unsupported_reason()
+    assert tts_backends.EdgeTTSBackend().transport is None
+
+
+def test_missing_drm_method(monkeypatch):
+    monkeypatch.delattr(edge_communicate.DRM, 'headers_with_muid')
+    assert 'DRM.headers_with_muid' in tts_transport.unsupported_reason()
+
+
+def test_version_out_of_range(monkeypatch):
+    monkeypatch.setattr(importlib.metadata, 'version', lambda name: '8.0.0')
+    assert 'not in the supported range' in tts_transport.unsupported_reason()
+    assert tts_backends.EdgeTTSBackend(pooled=True).transport is None
+
+
+def test_split_text_escapes():
+    assert tts_transport.split_text('a < b') == ['a &lt; b']